@@ -0,0 +1,40 @@
+"""Time `awk '{s+=$3} END{print s}'` over a generated file.
+
+Run from the project root:
+    python benchmarks/awk_sum.py [<lines>] [<program>]
+
+<lines> defaults to 10,000,000; <program> to the sum above.  A hash
+aggregation to compare against `sort | uniq -c`:
+    python benchmarks/awk_sum.py 1000000 '{c[$1]+=$3} END{for(k in c) n++; print n}'
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import dabshell  # noqa: E402
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    program = sys.argv[2] if len(sys.argv) > 2 else "{s+=$3} END{print s}"
+    # Keep the shell away from the terminal.
+    dabshell.RawInput.__init__ = lambda self: setattr(self, "_old_settings", None)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.txt")
+        with open(path, "w", encoding="utf8") as f:
+            for i in range(n):
+                f.write(f"host{i % 97} GET {i % 1000} /index.html\n")
+        shell = dabshell.Dabshell()
+        shell.cwd = tmp
+        shell.outs = dabshell.StringOutput()
+        start = time.perf_counter()
+        shell.execute(f"awk '{program}' data.txt", history=False)
+        elapsed = time.perf_counter() - start
+    print(f"{n} lines: {elapsed:.2f}s  result={shell.outs.value().strip()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Time output of a 1M-line file to a pty and count the write syscalls.
+
+Run from the project root (Linux/macOS):
+    python benchmarks/cat_pty.py [<lines>]      (default 1,000,000 lines)
+
+`cat` takes the raw byte path (sendfile/copy_file_range); `grep` writes
+line by line through the buffered terminal output.  Each command is run
+with the normal buffer and with FLUSH_SIZE=0, which flushes after every
+write like the old unbuffered StdOutput did.
+"""
+
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import dabshell  # noqa: E402
+
+
+class CountingFileIO(io.FileIO):
+    writes = 0
+
+    def write(self, b):
+        CountingFileIO.writes += 1
+        return super().write(b)
+
+
+def counted(func):
+    def wrapper(*args, **kwargs):
+        CountingFileIO.writes += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def drain(fd):
+    while True:
+        try:
+            if not os.read(fd, 1 << 16):
+                return
+        except OSError:
+            return
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    # Keep the shell away from the terminal.
+    dabshell.RawInput.__init__ = lambda self: setattr(self, "_old_settings", None)
+    for name in ("sendfile", "copy_file_range"):
+        if hasattr(os, name):
+            setattr(os, name, counted(getattr(os, name)))
+    master, slave = os.openpty()
+    threading.Thread(target=drain, args=(master,), daemon=True).start()
+    tty = io.TextIOWrapper(
+        io.BufferedWriter(CountingFileIO(slave, "w", closefd=False)),
+        encoding="utf8", line_buffering=True,
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "data.txt"), "w", encoding="utf8") as f:
+            for i in range(n):
+                f.write(f"line {i} of the benchmark file\n")
+        saved = sys.stdout
+        sys.stdout = tty
+        try:
+            shell = dabshell.Dabshell()
+        finally:
+            sys.stdout = saved
+        shell.cwd = tmp
+        results = []
+        for command in ("cat data.txt", "grep line data.txt"):
+            for label, size in (("buffered", None), ("per-write flush", 0)):
+                if size is not None:
+                    shell.outs._buffer.FLUSH_SIZE = size
+                CountingFileIO.writes = 0
+                start = time.perf_counter()
+                shell.execute(command, history=False)
+                elapsed = time.perf_counter() - start
+                results.append((command, label, CountingFileIO.writes, elapsed))
+                if size is not None:
+                    del shell.outs._buffer.FLUSH_SIZE
+    for command, label, writes, elapsed in results:
+        print(f"{command:20} {label:16} {writes:9} syscalls {elapsed:7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
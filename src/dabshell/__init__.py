@@ -1,16 +1,29 @@
+import array
+import codecs
 import collections
+import concurrent.futures
 import contextlib
 import ctypes
 import datetime
-import difflib
+import functools
 import glob
+import hashlib
+import heapq
 import io
+import itertools
+import math
+import mmap
+import operator
 import os
 import platform
 import re
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import tomllib
 
@@ -141,6 +154,9 @@ class RawInput:
             self._enter_raw()
 
     def getch(self):
+        # Whatever is buffered for the terminal must be visible before we
+        # wait for the user.
+        _flush_stream_buffers()
         if IS_WIN:
             ch = msvcrt.getwch()
             n = ord(ch)
@@ -739,6 +755,24 @@ def _is_binary(raw):
     return non_text / min(len(raw), 8192) > 0.10
 
 
+def _parse_size(s):
+    """Parse a size like '512', '64K' or '1.5G' into a number of bytes."""
+    s = s.strip()
+    if not s:
+        raise ValueError("empty size")
+    mult = 1
+    suffix = s[-1].upper()
+    if suffix in "BKMGTP":
+        mult = {"B": 1, "K": 1024, "M": 1024**2, "G": 1024**3,
+                "T": 1024**4, "P": 1024**5}[suffix]
+        s = s[:-1]
+    try:
+        value = float(s)
+    except ValueError:
+        raise ValueError(f"invalid size {s!r}")
+    return int(value * mult)
+
+
 def _collect_files(shell, args):
     """Expand args (with glob support) into a list of absolute file paths."""
     files = []
@@ -794,28 +828,213 @@ class Env:
             self.set(name, value)
 
 
+def _raw_fd(out):
+    """Flush text stream *out* and return its file descriptor, or None if
+    it is not backed by one."""
+    try:
+        fd = out.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    out.flush()
+    return fd
+
+
+def _copy_to_fd(infile, fd):
+    """Copy the rest of binary file *infile* to file descriptor *fd*.
+
+    The copy stays in the kernel where possible: copy_file_range between
+    regular files, sendfile otherwise, and a plain read/write loop with
+    large buffers where neither is supported.
+    """
+    src = infile.fileno()
+    offset = infile.tell()
+    methods = []
+    if hasattr(os, "copy_file_range") and _is_regular_fd(fd):
+        methods.append(
+            lambda count: os.copy_file_range(src, fd, count, offset_src=offset)
+        )
+    if hasattr(os, "sendfile"):
+        methods.append(lambda count: os.sendfile(fd, src, offset, count))
+    for copy in methods:
+        try:
+            while True:
+                copied = copy(_COPY_CHUNK)
+                if not copied:
+                    infile.seek(offset)
+                    return
+                offset += copied
+        except OSError:
+            # Not supported for this pair of files; try the next way,
+            # continuing from where this one stopped.
+            pass
+    infile.seek(offset)
+    while True:
+        data = infile.read(_COPY_CHUNK)
+        if not data:
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def _is_regular_fd(fd):
+    try:
+        return stat.S_ISREG(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+_COPY_CHUNK = 1024**2
+
+
+class _StreamBuffer:
+    """Collects text for a real stream (stdout, stderr) and writes it in
+    large pieces rather than flushing after every line.
+
+    Buffered text goes out once FLUSH_SIZE characters have collected, on
+    flush() - the shell flushes after every command, before running a
+    subprocess and before reading a key - and at the latest FLUSH_DELAY
+    seconds after it was written, so slow producers still show output
+    promptly.  Before writing to one stream, text pending for another is
+    flushed, which keeps stdout and stderr interleaved in order.
+    """
+
+    FLUSH_SIZE = 64 * 1024
+    FLUSH_DELAY = 0.05
+
+    _last = None            # the buffer written to most recently
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._parts = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pending = threading.Event()   # set while text is buffered
+        self._flusher = None
+
+    def write(self, s):
+        last = _StreamBuffer._last
+        if last is not self:
+            if last is not None:
+                last.flush()
+            _StreamBuffer._last = self
+        with self._lock:
+            self._parts.append(s)
+            self._size += len(s)
+            if self._size >= self.FLUSH_SIZE:
+                self._write_out()
+            else:
+                self._pending.set()
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_later, daemon=True,
+                    )
+                    self._flusher.start()
+
+    def flush(self):
+        with self._lock:
+            if self._parts:
+                self._write_out()
+
+    def _write_out(self):
+        data = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._pending.clear()
+        self.stream.write(data)
+        self.stream.flush()
+
+    def _flush_later(self):
+        while True:
+            self._pending.wait()
+            time.sleep(self.FLUSH_DELAY)
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                pass
+
+
+_STREAM_BUFFERS = {}
+
+
+def _stream_buffer(stream):
+    """Return the buffer shared by all outputs writing to *stream*."""
+    buffer = _STREAM_BUFFERS.get(id(stream))
+    if buffer is None or buffer.stream is not stream:
+        buffer = _STREAM_BUFFERS[id(stream)] = _StreamBuffer(stream)
+    return buffer
+
+
+def _flush_stream_buffers():
+    for buffer in list(_STREAM_BUFFERS.values()):
+        buffer.flush()
+
+
+def _before_fork():
+    # Worker processes (sort, awk, wc -j) are forked while the flushers
+    # run.  Holding every buffer's lock across the fork means no flusher
+    # is in the middle of a write when it happens; the child gets fresh
+    # locks and no flusher thread (it has no threads but the forking one).
+    for buffer in list(_STREAM_BUFFERS.values()):
+        buffer._lock.acquire()
+
+
+def _after_fork_in_parent():
+    for buffer in list(_STREAM_BUFFERS.values()):
+        buffer._lock.release()
+
+
+def _after_fork_in_child():
+    for buffer in list(_STREAM_BUFFERS.values()):
+        buffer._lock = threading.Lock()
+        buffer._pending = threading.Event()
+        buffer._flusher = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=_before_fork,
+        after_in_parent=_after_fork_in_parent,
+        after_in_child=_after_fork_in_child,
+    )
+
+
 class StdOutput:
     def __init__(self):
         self.out = sys.stdout
+        self._buffer = _stream_buffer(self.out)
 
     def write(self, s):
-        self.out.write(s)
-        self.out.flush()
+        self._buffer.write(s)
 
     def print(self, s=""):
-        print(s, file=self.out)
+        self._buffer.write(f"{s}\n")
+
+    def flush(self):
+        self._buffer.flush()
+
+    def raw_fd(self):
+        """Flush and return the fd behind stdout for raw byte copies, or
+        None.  Windows consoles need text, so never there."""
+        if IS_WIN:
+            return None
+        self._buffer.flush()
+        return _raw_fd(self.out)
 
 
 class StdError:
     def __init__(self):
         self.out = sys.stderr
+        self._buffer = _stream_buffer(self.out)
 
     def write(self, s):
-        self.out.write(s)
-        self.out.flush()
+        self._buffer.write(s)
 
     def print(self, s=""):
-        print(s, file=self.out)
+        self._buffer.write(f"{s}\n")
+
+    def flush(self):
+        self._buffer.flush()
 
 
 class FileOutput:
@@ -829,6 +1048,13 @@ class FileOutput:
     def print(self, s=""):
         print(s, file=self.out)
 
+    def raw_fd(self):
+        """Flush and return the file's fd for raw byte copies."""
+        return _raw_fd(self.out)
+
+    def flush(self):
+        self.out.flush()
+
     def close(self):
         if self.out and not self.out.closed:
             self.out.close()
@@ -906,6 +1132,7 @@ class Dabshell:
             self.options = {
                 "echo": "off",
                 "stop-on-error": "on",
+                "cache-dir": os.path.expanduser("~/.dabshell-cache"),
             }
             for name in os.environ:
                 self.env.set("env:" + name, os.environ.get(name, ""))
@@ -936,6 +1163,7 @@ class Dabshell:
             self.init_cmd(CmdTee())
             self.init_cmd(CmdFind())
             self.init_cmd(CmdHash())
+            self.init_cmd(CmdDupes())
             self.init_cmd(CmdJson())
             self.init_cmd(CmdFetch())
             self.init_cmd(CmdTar())
@@ -1005,6 +1233,7 @@ class Dabshell:
         if _VT_ENABLED:
             # OSC 0 sequence: works on Linux/macOS terminals and
             # Windows 10+ console with VT processing enabled.
+            _flush_stream_buffers()
             sys.stdout.write(f"\033]0;{title}\007")
             sys.stdout.flush()
         elif IS_WIN:
@@ -1013,6 +1242,14 @@ class Dabshell:
     def option_set(self, name):
         return self.options.get(name) in ["on", "yes", "y", "1", "true"]
 
+    def cache_dir(self, name):
+        """Return the directory for the cache *name* (created on first
+        write by its user), or None if caching is switched off."""
+        base = self.options.get("cache-dir", "")
+        if base in ["", "off", "no", "n", "0", "false"]:
+            return None
+        return os.path.join(base, name)
+
     def prompt(self):
         s = ""
         clean_s = ""
@@ -1229,6 +1466,7 @@ class Dabshell:
             # Trim the un-highlighted match_str to the available space
             match_str = visible_match[:avail]
         prompt = prefix + match_str
+        _flush_stream_buffers()
         self.outp.out.write(f"{esc}[1000D")   # move to column 0
         self.outp.out.write(prompt)
         self.outp.out.write(f"{esc}[0K")       # erase to end of line
@@ -1236,6 +1474,9 @@ class Dabshell:
 
     def _redraw_line(self):
         """Write the current self.line to the terminal at the cursor position."""
+        # The editor writes to the terminal directly; buffered output (e.g.
+        # a completion list) must come out first.
+        _flush_stream_buffers()
         self.outp.out.write(f"{esc}[1000D")
         line = self.line
         index = self.index
@@ -1350,6 +1591,7 @@ class Dabshell:
                         self._search_active = False
                         self._search_query  = ""
                         self._search_pos    = -1
+                        _flush_stream_buffers()
                         self.outp.out.write(f"{esc}[1000D{esc}[0K")
                         self.outp.out.flush()
                         # self.line is unchanged — it held the pre-search content
@@ -1376,6 +1618,7 @@ class Dabshell:
                         self._search_active = False
                         self._search_query  = ""
                         self._search_pos    = -1
+                        _flush_stream_buffers()
                         self.outp.out.write(f"{esc}[1000D{esc}[0K")
                         self.outp.out.flush()
                         self.line  = matched_cmd
@@ -1662,20 +1905,31 @@ class Dabshell:
             return parts
 
         cmds = split_and_and(line)
-        for cmd_segment in cmds:
-            # Handle 'exit' before pipeline parsing so it returns False cleanly
-            if cmd_segment.strip() == "exit":
-                return False
-            stages = parse_pipeline(cmd_segment)
-            try:
-                self.execute_pipeline(stages, history=history)
-            except CommandFailedException:
-                if self.option_set("stop-on-error"):
-                    raise
-            except KeyboardInterrupt:
-                pass
+        try:
+            for cmd_segment in cmds:
+                # Handle 'exit' before pipeline parsing so it returns False
+                # cleanly
+                if cmd_segment.strip() == "exit":
+                    return False
+                stages = parse_pipeline(cmd_segment)
+                try:
+                    self.execute_pipeline(stages, history=history)
+                except CommandFailedException:
+                    if self.option_set("stop-on-error"):
+                        raise
+                except KeyboardInterrupt:
+                    pass
+        finally:
+            self.flush_outputs()
         return True
 
+    def flush_outputs(self):
+        """Write out whatever the shell's outputs have buffered."""
+        for out in (self.outs, self.oute, self.outp):
+            flush = getattr(out, "flush", None)
+            if flush is not None:
+                flush()
+
     # ------------------------------------------------------------------
     # Pipeline execution
     # ------------------------------------------------------------------
@@ -1893,6 +2147,8 @@ class Dabshell:
             oute_direct = isinstance(self.oute, (StdError, StdOutput, FileOutput))
             use_capture = (not outs_direct) or (not oute_direct)
 
+            # The child writes straight to the streams, after our output.
+            self.flush_outputs()
             with self.inp.cooked():
                 if use_capture:
                     p = subprocess.run(
@@ -2805,20 +3061,7 @@ class CmdDu(Cmd):
         return f"{s:.2f}{units[i]}"
 
     def _parse_size(self, s):
-        s = s.strip()
-        if not s:
-            raise ValueError("empty size")
-        mult = 1
-        suffix = s[-1].upper()
-        if suffix in "BKMGTP":
-            mult = {"B": 1, "K": 1024, "M": 1024**2, "G": 1024**3,
-                    "T": 1024**4, "P": 1024**5}[suffix]
-            s = s[:-1]
-        try:
-            value = float(s)
-        except ValueError:
-            raise ValueError(f"invalid size {s!r}")
-        return int(value * mult)
+        return _parse_size(s)
 
 
 class CmdCd(Cmd):
@@ -2928,6 +3171,14 @@ class CmdCat(Cmd):
                 filename,
                 "rb"
             ) as infile:
+                # Files and real stdout get the bytes as they are, copied
+                # in the kernel; other outputs (pipes between internal
+                # commands, captured output) need decoded text.
+                raw_fd = getattr(shell.outs, "raw_fd", None)
+                fd = raw_fd() if raw_fd is not None else None
+                if fd is not None:
+                    _copy_to_fd(infile, fd)
+                    continue
                 encoding = "utf8"
                 for line in infile:
                     try:
@@ -2943,26 +3194,485 @@ class CmdCat(Cmd):
                             pass
 
 
+def _file_digest(path, algo="sha256"):
+    """Return the digest of the contents of file *path*."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, algo).digest()
+
+
+class _HashCache:
+    """Persistent cache of file content digests.
+
+    Digests are stored in an sqlite database in the cache directory,
+    keyed by the file's device, inode, size and mtime_ns, so a file is
+    only read again once one of those changed.  Every hit refreshes the
+    entry's last use; when the cache is closed, all but the MAX_ENTRIES
+    most recently used entries are dropped.  The cache may be shared by
+    the threads of a pool, and any database error just means a miss.
+    Changes are committed every COMMIT_EVERY writes, so other shells
+    using the cache are not locked out for long.
+    """
+
+    MAX_ENTRIES = 100_000
+    COMMIT_EVERY = 100
+    # Files modified this recently are not cached: a write within the same
+    # mtime tick would go unnoticed.
+    MIN_AGE_NS = 2 * 10**9
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,"
+            " algo TEXT, digest BLOB, used INTEGER,"
+            " PRIMARY KEY (dev, ino, size, mtime_ns, algo))"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)"
+        )
+
+    @classmethod
+    def open(cls, shell):
+        """Return the cache of *shell*, or a null context if caching is
+        switched off or the database cannot be opened."""
+        cache_dir = shell.cache_dir("hashes")
+        if cache_dir is None:
+            return contextlib.nullcontext()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            return cls(os.path.join(cache_dir, "hashes.sqlite"))
+        except (OSError, sqlite3.Error):
+            return contextlib.nullcontext()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _key(st, algo):
+        # sqlite integers are signed 64 bit; some file systems use all 64.
+        return (
+            st.st_dev % (1 << 63), st.st_ino % (1 << 63),
+            st.st_size, st.st_mtime_ns, algo,
+        )
+
+    def digest(self, path, algo="sha256"):
+        """Return the digest of file *path*, from the cache if possible."""
+        st = os.stat(path)
+        key = self._key(st, algo)
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=?"
+                    " AND mtime_ns=? AND algo=?", key,
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE hashes SET used=? WHERE dev=? AND ino=?"
+                        " AND size=? AND mtime_ns=? AND algo=?",
+                        (time.time_ns(), *key),
+                    )
+                    self._wrote()
+                    return row[0]
+            except sqlite3.Error:
+                pass
+        digest = _file_digest(path, algo)
+        # Only remember digests of files that did not change meanwhile.
+        if (
+            self._key(os.stat(path), algo) == key
+            and time.time_ns() - st.st_mtime_ns >= self.MIN_AGE_NS
+        ):
+            with self._lock:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?)",
+                        (*key, digest, time.time_ns()),
+                    )
+                    self._wrote()
+                except sqlite3.Error:
+                    pass
+        return digest
+
+    def _wrote(self):
+        # Called with the lock held.
+        self._writes += 1
+        if self._writes >= self.COMMIT_EVERY:
+            self._writes = 0
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            try:
+                self._db.execute(
+                    "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM"
+                    " hashes ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.MAX_ENTRIES,),
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                pass
+            self._db.close()
+
+
+def _common_prefix(a, b, off1, lim1, off2, lim2):
+    """Length of the common prefix of a[off1:lim1] and b[off2:lim2].
+
+    Compares slices of doubling (then halving) length, so long runs of
+    equal lines are skipped by list comparison instead of line by line.
+    """
+    limit = min(lim1 - off1, lim2 - off2)
+    n = 0
+    step = 1
+    while n < limit:
+        step = min(step, limit - n)
+        if a[off1 + n:off1 + n + step] == b[off2 + n:off2 + n + step]:
+            n += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step //= 2
+    return n
+
+
+def _common_suffix(a, b, off1, lim1, off2, lim2):
+    """Length of the common suffix of a[off1:lim1] and b[off2:lim2]."""
+    limit = min(lim1 - off1, lim2 - off2)
+    n = 0
+    step = 1
+    while n < limit:
+        step = min(step, limit - n)
+        if a[lim1 - n - step:lim1 - n] == b[lim2 - n - step:lim2 - n]:
+            n += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step //= 2
+    return n
+
+
+def _diff_split(a, b, off1, lim1, off2, lim2, max_cost):
+    """Find a point (i1, i2) on a shortest edit path through the box
+    a[off1:lim1], b[off2:lim2], which must differ in its first and last
+    lines.
+
+    This is the middle snake search of Myers' linear space algorithm,
+    run from both corners on diagonals d = i1 - i2.  After *max_cost*
+    rounds the furthest point reached so far is used instead, which
+    keeps huge, very different inputs fast at the price of a diff that
+    may not be minimal.
+    """
+    dmin, dmax = off1 - lim2, lim1 - off2
+    fmid, bmid = off1 - off2, lim1 - lim2
+    odd = (fmid - bmid) & 1
+    base = 1 - dmin
+    kvdf = [0] * (dmax - dmin + 3)
+    kvdb = [0] * (dmax - dmin + 3)
+    kvdf[fmid + base] = off1
+    kvdb[bmid + base] = lim1
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    ec = 0
+    while True:
+        ec += 1
+        # Forward: extend every diagonal by one edit, then follow the snake.
+        if fmin > dmin:
+            fmin -= 1
+            kvdf[fmin - 1 + base] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            kvdf[fmax + 1 + base] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            if kvdf[d - 1 + base] >= kvdf[d + 1 + base]:
+                i1 = kvdf[d - 1 + base] + 1
+            else:
+                i1 = kvdf[d + 1 + base]
+            i2 = i1 - d
+            while i1 < lim1 and i2 < lim2 and a[i1] == b[i2]:
+                i1 += 1
+                i2 += 1
+            kvdf[d + base] = i1
+            if odd and bmin <= d <= bmax and kvdb[d + base] <= i1:
+                return i1, i2
+        # Backward, from the bottom right corner.
+        if bmin > dmin:
+            bmin -= 1
+            kvdb[bmin - 1 + base] = sys.maxsize
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            kvdb[bmax + 1 + base] = sys.maxsize
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            if kvdb[d - 1 + base] < kvdb[d + 1 + base]:
+                i1 = kvdb[d - 1 + base]
+            else:
+                i1 = kvdb[d + 1 + base] - 1
+            i2 = i1 - d
+            while i1 > off1 and i2 > off2 and a[i1 - 1] == b[i2 - 1]:
+                i1 -= 1
+                i2 -= 1
+            kvdb[d + base] = i1
+            if not odd and fmin <= d <= fmax and i1 <= kvdf[d + base]:
+                return i1, i2
+        if ec >= max_cost:
+            # Too expensive: split where one of the searches got furthest.
+            fbest = fbest1 = -1
+            for d in range(fmax, fmin - 1, -2):
+                i1 = min(kvdf[d + base], lim1)
+                i2 = i1 - d
+                if i2 > lim2:
+                    i1, i2 = lim2 + d, lim2
+                if i1 + i2 > fbest:
+                    fbest, fbest1 = i1 + i2, i1
+            bbest = bbest1 = sys.maxsize
+            for d in range(bmax, bmin - 1, -2):
+                i1 = max(off1, kvdb[d + base])
+                i2 = i1 - d
+                if i2 < off2:
+                    i1, i2 = off2 + d, off2
+                if i1 + i2 < bbest:
+                    bbest, bbest1 = i1 + i2, i1
+            if (lim1 + lim2) - bbest < fbest - (off1 + off2):
+                return fbest1, fbest - fbest1
+            return bbest1, bbest - bbest1
+
+
+def _diff_blocks(a, b, max_cost=sys.maxsize):
+    """Return the matching blocks of the sequences *a* and *b* like
+    difflib's get_matching_blocks(): (i, j, n) triples in order, ending
+    with (len(a), len(b), 0).
+
+    Items that occur in only one of the sequences can never match, so
+    they are dropped before the search and the blocks found for the rest
+    are mapped back.  Each box is shrunk by its common prefix and suffix,
+    and the rest is split at a point on a shortest edit path
+    (_diff_split) until nothing is left, so the result is a minimal diff
+    unless *max_cost* cut a search short.
+    """
+    common = set(a).intersection(b)
+    keep1 = [i for i, x in enumerate(a) if x in common]
+    keep2 = [j for j, x in enumerate(b) if x in common]
+    if len(keep1) == len(a) and len(keep2) == len(b):
+        return _diff_blocks_of(a, b, max_cost)
+    blocks = []
+    for i, j, n in _diff_blocks_of(
+        [a[i] for i in keep1], [b[j] for j in keep2], max_cost
+    )[:-1]:
+        # A run of matches stays a block only while no dropped item
+        # interrupts it on either side.
+        start = 0
+        for t in range(1, n + 1):
+            if (
+                t == n
+                or keep1[i + t] != keep1[i + t - 1] + 1
+                or keep2[j + t] != keep2[j + t - 1] + 1
+            ):
+                blocks.append((keep1[i + start], keep2[j + start], t - start))
+                start = t
+    blocks.append((len(a), len(b), 0))
+    return blocks
+
+
+def _diff_blocks_of(a, b, max_cost):
+    blocks = []
+
+    def add(i, j, n):
+        if blocks:
+            pi, pj, pn = blocks[-1]
+            if pi + pn == i and pj + pn == j:
+                blocks[-1] = (pi, pj, pn + n)
+                return
+        blocks.append((i, j, n))
+
+    todo = [(0, len(a), 0, len(b))]
+    while todo:
+        item = todo.pop()
+        if len(item) == 3:
+            add(*item)
+            continue
+        off1, lim1, off2, lim2 = item
+        n = _common_prefix(a, b, off1, lim1, off2, lim2)
+        if n:
+            add(off1, off2, n)
+            off1 += n
+            off2 += n
+        n = _common_suffix(a, b, off1, lim1, off2, lim2)
+        if n:
+            lim1 -= n
+            lim2 -= n
+            todo.append((lim1, lim2, n))
+        if off1 < lim1 and off2 < lim2:
+            i1, i2 = _diff_split(a, b, off1, lim1, off2, lim2, max_cost)
+            todo.append((i1, lim1, i2, lim2))
+            todo.append((off1, i1, off2, i2))
+    blocks.append((len(a), len(b), 0))
+    return blocks
+
+
+def _diff_hunks(blocks, context):
+    """Group the changes between matching *blocks* into unified diff hunks.
+
+    Yields (i1, i2, j1, j2, changes): the line ranges the hunk covers in
+    both sequences and the changed ranges (i1, i2, j1, j2) inside it.
+    Changes separated by at most 2 * *context* equal lines share a hunk.
+    """
+    changes = []
+    i = j = 0
+    for bi, bj, n in blocks:
+        if bi > i or bj > j:
+            changes.append((i, bi, j, bj))
+        i, j = bi + n, bj + n
+    len_a, len_b = i, j
+    group = []
+    for change in changes + [None]:
+        if group and (change is None or change[0] - group[-1][1] > 2 * context):
+            first, last = group[0], group[-1]
+            before = min(context, first[0])
+            after = min(context, len_a - last[1])
+            yield (
+                first[0] - before, last[1] + after,
+                first[2] - before, last[3] + after,
+                group,
+            )
+            group = []
+        if change is not None:
+            group.append(change)
+
+
+def _diff_range(start, stop):
+    """Format a hunk range the way unified diffs do."""
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    if length == 0:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def _diff_read_lines(path):
+    """Read file *path* as a list of lines without their newlines.
+
+    Returns (lines, eol): *eol* is False when the last line has no
+    newline.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    lines = data.split(b"\n")
+    eol = lines[-1] == b""
+    if eol:
+        lines.pop()
+    return lines, eol
+
+
+def _decode_line(raw):
+    try:
+        return raw.decode("utf8")
+    except UnicodeDecodeError:
+        return raw.decode("Latin1")
+
+
+def _scan_tree(root):
+    """Map the relative path of every entry below directory *root* to
+    (is_dir, size, mtime_ns).  Symlinked directories are not followed;
+    entries that cannot be stat'ed, and ones that are neither directories
+    nor regular files (also through a symlink), are left out."""
+    entries = {}
+    todo = [""]
+    while todo:
+        rel = todo.pop()
+        try:
+            it = os.scandir(os.path.join(root, rel))
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                path = os.path.join(rel, entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        entries[path] = (True, 0, 0)
+                        todo.append(path)
+                    else:
+                        st = entry.stat()
+                        if stat.S_ISREG(st.st_mode):
+                            entries[path] = (False, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+    return entries
+
+
 class CmdDiff(Cmd):
+    # Edit rounds after which the diff search settles for a good split
+    # instead of a minimal one; raised to the square root of the number of
+    # lines for large files.
+    MAX_COST = 256
+
     def __init__(self):
         Cmd.__init__(self, "diff")
 
     def help(self):
         return (
-            "<file1> <file2>"
-            " : shows the differences between the two text files"
+            "[-q] [-u <n>] [-r [-j <n>]] [--no-cache] <path1> <path2>"
+            " : shows the differences between the two text files "
+            "or, with -r, directory trees"
         )
 
     def execute(self, shell, args):
+        quiet = False
+        recursive = False
+        use_cache = True
+        jobs = os.cpu_count() or 1
+        context = 3
         files = []
-        for filename in args:
-            if not os.path.isabs(filename):
-                filename = shell.canon(os.path.join(shell.cwd, filename))
-            allfiles = sorted(glob.glob(filename))
-            if allfiles:
-                files.extend(allfiles)
+        idx = 0
+        while idx < len(args):
+            arg = args[idx]
+            if arg == "-q":
+                quiet = True
+            elif arg == "-r":
+                recursive = True
+            elif arg == "--no-cache":
+                use_cache = False
+            elif arg == "-j" or (arg.startswith("-j") and arg[2:].isdigit()):
+                value = arg[2:]
+                if not value:
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: diff: -j requires an argument")
+                        return
+                    value = args[idx + 1]
+                    idx += 1
+                if not value.isdigit() or int(value) < 1:
+                    shell.oute.print(f"ERR: diff: invalid number of workers {value!r}")
+                    return
+                jobs = int(value)
+            elif arg == "-u" or arg.startswith("-u") and arg[2:].isdigit():
+                value = arg[2:]
+                if not value and idx + 1 < len(args) and args[idx + 1].isdigit():
+                    value = args[idx + 1]
+                    idx += 1
+                if value:
+                    context = int(value)
             else:
-                files.append(filename)
+                filename = arg
+                if not os.path.isabs(filename):
+                    filename = shell.canon(os.path.join(shell.cwd, filename))
+                allfiles = sorted(glob.glob(filename))
+                if allfiles:
+                    files.extend(allfiles)
+                else:
+                    files.append(filename)
+            idx += 1
         if len(files) < 2:
             shell.oute.print("ERR: diff requires two files")
             return
@@ -2975,99 +3685,431 @@ class CmdDiff(Cmd):
         if not os.path.exists(file2):
             shell.oute.print(f"ERR: {file2} not found")
             return
-        lines1 = []
-        with open(file1, "rb") as infile:
-            encoding = "utf8"
-            for line in infile:
-                try:
-                    lines1.append(line.decode(encoding))
-                except Exception:
-                    if encoding == "utf8":
-                        encoding = "Latin1"
-                    else:
-                        encoding = "utf8"
-                    try:
-                        lines1.append(line.decode(encoding))
-                    except Exception:
-                        raise ValueError(f"ERR: {file1} unknown encoding")
-        lines2 = []
-        with open(file2, "rb") as infile:
-            encoding = "utf8"
-            for line in infile:
+        name1, name2 = [
+            fn[len(cwd)+1:] if fn.startswith(cwd + os.sep) else fn
+            for fn in (file1, file2)
+        ]
+        opened = _HashCache.open(shell) if use_cache else contextlib.nullcontext()
+        with opened as cache:
+            digest = cache.digest if cache else _file_digest
+            self._diff(
+                shell, file1, file2, name1, name2,
+                quiet, recursive, context, jobs, digest,
+            )
+
+    def _diff(
+        self, shell, file1, file2, name1, name2,
+        quiet, recursive, context, jobs, digest,
+    ):
+        if os.path.isdir(file1) or os.path.isdir(file2):
+            if not (os.path.isdir(file1) and os.path.isdir(file2)):
+                shell.oute.print(
+                    f"ERR: diff: {name1} and {name2} are not both directories"
+                )
+            elif not recursive:
+                shell.oute.print(
+                    f"ERR: diff: {name1} and {name2} are directories, use -r"
+                )
+            else:
+                self._diff_dirs(
+                    shell, file1, file2, name1, name2,
+                    quiet, context, jobs, digest,
+                )
+            return
+        if self._same_content(file1, file2, digest):
+            return
+        self._report(shell, file1, file2, name1, name2, quiet, context)
+
+    def _same_content(self, file1, file2, digest=_file_digest):
+        if os.path.getsize(file1) != os.path.getsize(file2):
+            return False
+        return digest(file1) == digest(file2)
+
+    def _report(self, shell, file1, file2, name1, name2, quiet, context):
+        """Show how the two files, which are known to differ, differ."""
+        if quiet:
+            shell.outs.print(f"Files {name1} and {name2} differ")
+        elif self._binary(file1) or self._binary(file2):
+            shell.outs.print(f"Binary files {name1} and {name2} differ")
+        else:
+            self._unified(shell, file1, file2, name1, name2, context)
+
+    def _binary(self, path):
+        with open(path, "rb") as f:
+            return _is_binary(f.read(8192))
+
+    def _diff_dirs(
+        self, shell, dir1, dir2, name1, name2, quiet, context, jobs, digest,
+    ):
+        """Compare two directory trees.
+
+        Both trees are walked once and their entries paired by relative
+        path.  Files with the same size and modification time are taken
+        to be identical, files of different size to differ; the others are
+        compared by content hash on a thread pool.  Only files that differ
+        get a line diff.  Results are printed in path order as they become
+        available.
+        """
+        tree1 = _scan_tree(dir1)
+        tree2 = _scan_tree(dir2)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            pending = {}
+            for rel, (is_dir1, size1, mtime1) in tree1.items():
+                other = tree2.get(rel)
+                if other is None or is_dir1 or other[0]:
+                    continue
+                is_dir2, size2, mtime2 = other
+                if size1 != size2:
+                    pending[rel] = False
+                elif mtime1 != mtime2:
+                    pending[rel] = pool.submit(
+                        self._same_content,
+                        os.path.join(dir1, rel), os.path.join(dir2, rel), digest,
+                    )
+            only = None  # directory already reported as existing on one side
+            # Sorted by components, so a directory's entries follow it.
+            rels = sorted(tree1.keys() | tree2.keys(), key=lambda r: r.split(os.sep))
+            for rel in rels:
+                if only is not None and rel.startswith(only):
+                    continue
+                entry1 = tree1.get(rel)
+                entry2 = tree2.get(rel)
+                path1 = os.path.join(name1, rel)
+                path2 = os.path.join(name2, rel)
+                if entry1 is None or entry2 is None:
+                    name, entry = (name2, entry2) if entry1 is None else (name1, entry1)
+                    parent, base = os.path.split(os.path.join(name, rel))
+                    shell.outs.print(f"Only in {parent}: {base}")
+                    if entry[0]:
+                        only = rel + os.sep
+                    continue
+                if entry1[0] != entry2[0]:
+                    kinds = ["regular file", "directory"]
+                    shell.outs.print(
+                        f"File {path1} is a {kinds[entry1[0]]} while file "
+                        f"{path2} is a {kinds[entry2[0]]}"
+                    )
+                    continue
+                file1 = os.path.join(dir1, rel)
+                file2 = os.path.join(dir2, rel)
+                # A file that went away or can't be read is reported and
+                # the comparison goes on with the next pair.
                 try:
-                    lines2.append(line.decode(encoding))
-                except Exception:
-                    if encoding == "utf8":
-                        encoding = "Latin1"
-                    else:
-                        encoding = "utf8"
-                    try:
-                        lines2.append(line.decode(encoding))
-                    except Exception:
-                        raise ValueError(f"ERR: {file2} unknown encoding")
-        shell.outs.print("".join(difflib.ndiff(lines1, lines2)))
+                    same = pending.get(rel, True)
+                    if not isinstance(same, bool):
+                        same = same.result()
+                    if not same:
+                        self._report(
+                            shell, file1, file2, path1, path2, quiet, context,
+                        )
+                except OSError as e:
+                    path = path2 if e.filename == file2 else path1
+                    shell.oute.print(f"ERR: diff: {path}: {e.strerror or e}")
+
+    def _unified(self, shell, file1, file2, name1, name2, context):
+        lines1, eol1 = _diff_read_lines(file1)
+        lines2, eol2 = _diff_read_lines(file2)
+        # Compare small ints instead of lines: equal lines share an id.  A
+        # last line without newline differs from the same text with one.
+        ids = {}
+        ids1 = [ids.setdefault(line, len(ids)) for line in lines1]
+        ids2 = [ids.setdefault(line, len(ids)) for line in lines2]
+        if lines1 and not eol1:
+            ids1[-1] = ids.setdefault(lines1[-1] + b"\n", len(ids))
+        if lines2 and not eol2:
+            ids2[-1] = ids.setdefault(lines2[-1] + b"\n", len(ids))
+        max_cost = max(self.MAX_COST, math.isqrt(len(ids1) + len(ids2)))
+        blocks = _diff_blocks(ids1, ids2, max_cost)
+        out = shell.outs
+        header = False
+
+        def emit(prefix, lines, idx, eol):
+            out.write(prefix + _decode_line(lines[idx]) + "\n")
+            if not eol and idx == len(lines) - 1:
+                out.write("\\ No newline at end of file\n")
+
+        for i1, i2, j1, j2, changes in _diff_hunks(blocks, context):
+            if not header:
+                out.write(f"--- {name1}\n+++ {name2}\n")
+                header = True
+            out.write(
+                f"@@ -{_diff_range(i1, i2)} +{_diff_range(j1, j2)} @@\n"
+            )
+            pos = i1
+            for c1, c2, d1, d2 in changes:
+                for idx in range(pos, c1):
+                    emit(" ", lines1, idx, eol1)
+                for idx in range(c1, c2):
+                    emit("-", lines1, idx, eol1)
+                for idx in range(d1, d2):
+                    emit("+", lines2, idx, eol2)
+                pos = c2
+            for idx in range(pos, i2):
+                emit(" ", lines1, idx, eol1)
+
+
+_UTF8_CONTINUATION = bytes(range(0x80, 0xC0))
+
+
+def _wc_count(path, lines=True, words=False, chars=False):
+    """Return (lines, words, chars, bytes) for file *path*.
+
+    Reads fixed-size chunks, so memory use is constant: newlines are
+    counted with bytes.count, words with bytes.split (joining words cut
+    by a chunk boundary), and UTF-8 characters as the bytes that are not
+    continuation bytes.  Counts not asked for are 0; with only the byte
+    count wanted the file is not read at all.  As before, a last line
+    without a newline still counts as a line.
+    """
+    if not (lines or words or chars):
+        return 0, 0, 0, os.path.getsize(path)
+    nlines = nwords = nchars = nbytes = 0
+    in_word = False
+    last = b"\n"
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CmdWc.CHUNK)
+            if not chunk:
+                break
+            nbytes += len(chunk)
+            nlines += chunk.count(b"\n")
+            if words:
+                n = len(chunk.split())
+                if in_word and not chunk[:1].isspace():
+                    n -= 1
+                nwords += n
+                in_word = not chunk[-1:].isspace()
+            if chars:
+                nchars += len(chunk.translate(None, _UTF8_CONTINUATION))
+            last = chunk[-1:]
+    if last != b"\n":
+        nlines += 1
+    return nlines, nwords, nchars, nbytes
 
 
 class CmdWc(Cmd):
+    # Bytes read per chunk while counting.
+    CHUNK = 1024**2
+
     def __init__(self):
         Cmd.__init__(self, "wc")
 
     def help(self):
         return (
-            "<file> ... "
-            " : returns the number of lines of the files"
+            "[-l] [-w] [-m] [-c] [-j <n>] <file> ... "
+            " : counts lines (words, characters, bytes) of the files"
         )
 
     def execute(self, shell, args):
+        wanted = ""
+        jobs = 1
         files = []
-        for filename in args:
-            if not os.path.isabs(filename):
-                filename = shell.canon(os.path.join(shell.cwd, filename))
-            allfiles = sorted(glob.glob(filename))
+        idx = 0
+        while idx < len(args):
+            arg = args[idx]
+            if arg == "-j" or (arg.startswith("-j") and arg[2:].isdigit()):
+                value = arg[2:]
+                if not value:
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: wc: -j requires an argument")
+                        return
+                    value = args[idx + 1]
+                    idx += 1
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    shell.oute.print(f"ERR: wc: invalid number of workers {value!r}")
+                    return
+                if jobs < 1:
+                    shell.oute.print("ERR: wc: -j must be >= 1")
+                    return
+                idx += 1
+                continue
+            if len(arg) > 1 and arg[0] == "-" and all(c in "lwmc" for c in arg[1:]):
+                wanted += arg[1:]
+                idx += 1
+                continue
+            if not os.path.isabs(arg):
+                arg = shell.canon(os.path.join(shell.cwd, arg))
+            allfiles = sorted(glob.glob(arg))
             if allfiles:
                 files.extend(allfiles)
             else:
-                files.append(filename)
+                files.append(arg)
+            idx += 1
+        # Columns in the order lines, words, chars, bytes; lines only by
+        # default.
+        columns = [i for i, c in enumerate("lwmc") if c in (wanted or "l")]
+
+        def fmt(name, counts):
+            return " ".join([name] + [str(counts[i]) for i in columns])
+
         # If no files given and we have piped stdin, count that instead
         if not files and shell.current_stdin is not None:
-            count = sum(1 for _ in shell.current_stdin)
-            shell.outs.print(f"(stdin) {count}")
+            counts = [0, 0, 0, 0]
+            for line in shell.current_stdin:
+                counts[0] += 1
+                if 1 in columns:
+                    counts[1] += len(line.split())
+                counts[2] += len(line)
+                if 3 in columns:
+                    counts[3] += len(line.encode("utf8", errors="surrogatepass"))
+            shell.outs.print(fmt("(stdin)", counts))
             return
         cwd = shell.canon(shell.cwd)
-        total = 0
-        counted = 0
+        todo = []
         for filename in files:
             if not os.path.exists(filename):
                 shell.oute.print(f"ERR: {filename} not found")
                 continue
             if os.path.isdir(filename):
                 continue  # silently skip directories
+            todo.append(filename)
+        flags = (0 in columns, 1 in columns, 2 in columns)
+        total = [0, 0, 0, 0]
+        for filename, counts in zip(todo, self._count(todo, flags, jobs)):
             fname = filename
             if fname.startswith(cwd):
                 fname = fname[len(cwd)+1:]
-            with open(filename, "rb") as infile:
-                lines = infile.readlines()
-                count = len(lines)
-                shell.outs.print(f"{fname} {count}")
-                total += count
-                counted += 1
-        if counted > 1:
-            shell.outs.print(f"Total {total}")
+            shell.outs.print(fmt(fname, counts))
+            total = [t + c for t, c in zip(total, counts)]
+        if len(todo) > 1:
+            shell.outs.print(fmt("Total", total))
+
+    def _count(self, files, flags, jobs):
+        """Yield the counts of *files* in order, using up to *jobs* worker
+        processes when there are several files."""
+        if jobs > 1 and len(files) > 1:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                    min(jobs, len(files))
+                ) as pool:
+                    results = list(pool.map(
+                        _wc_count, files, *[itertools.repeat(f) for f in flags]
+                    ))
+            except (OSError, concurrent.futures.BrokenExecutor):
+                # No worker processes available here; count in-process.
+                results = None
+            if results is not None:
+                yield from results
+                return
+        for filename in files:
+            yield _wc_count(filename, *flags)
 
 
-class CmdTail(Cmd):
-    def __init__(self):
-        Cmd.__init__(self, "tail")
+class _Inotify:
+    """A minimal inotify(7) binding through ctypes.
 
-    def help(self):
-        return (
-            "[-n <lines>] [--lines=<lines>] [-f] <file> ... "
-            " : prints the last lines of each file"
-        )
+    Only used to sleep until something may have changed: events are
+    drained and discarded, and the caller re-checks its files.  create()
+    returns None where inotify is unavailable, so callers can poll.
+    """
 
-    def execute(self, shell, args):
-        n = 20
-        filenames = []
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    DIR_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE)
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self.fd = fd
+        self._watched = set()
+
+    @classmethod
+    def create(cls):
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def watch_dir(self, path):
+        """Report changes to *path* and the files in it; False on failure."""
+        if path in self._watched:
+            return True
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), self.DIR_MASK
+        )
+        if wd < 0:
+            return False
+        self._watched.add(path)
+        return True
+
+    def wait(self, timeout):
+        """Block until an event arrives or *timeout* seconds pass."""
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if ready:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(ready)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _FollowedFile:
+    """A file followed by tail -f: the open file and its text decoder."""
+
+    def __init__(self, path, infile, encoding):
+        self.path = path
+        self.file = infile
+        self.encoding = encoding
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+
+    def read(self):
+        data = self.file.read()
+        return self.decoder.decode(data) if data else ""
+
+    def reopen(self):
+        """Switch to whatever file now exists at self.path."""
+        self.close()
+        self.file = open(self.path, "rb")
+        self.decoder = codecs.getincrementaldecoder(self.encoding)(
+            errors="replace"
+        )
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CmdTail(Cmd):
+    # tail -f re-checks its files at least this often (seconds), which also
+    # covers events inotify cannot report (e.g. a file moved elsewhere).
+    FOLLOW_INTERVAL = 1.0
+    # Polling interval where inotify is not available.
+    POLL_INTERVAL = 0.1
+    # _tail_bytes reads at least CHUNK and at most MAX_CHUNK bytes at a time.
+    CHUNK = 64 * 1024
+    MAX_CHUNK = 16 * 1024**2
+
+    def __init__(self):
+        Cmd.__init__(self, "tail")
+
+    def help(self):
+        return (
+            "[-n <lines>] [--lines=<lines>] [-f | -F] <file> ... "
+            " : prints the last lines of each file"
+        )
+
+    def execute(self, shell, args):
+        n = 20
+        follow = False
+        by_name = False
+        filenames = []
         after_args = False
         idx = 0
         while idx < len(args):
@@ -3078,11 +4120,29 @@ class CmdTail(Cmd):
             ):
                 if arg == "--":
                     after_args = True
-                elif arg == "-n":
-                    n = int(args[idx+1])
-                    idx += 1
-                elif arg.startswith("--lines="):
-                    n = int(arg[len("--lines="):])
+                elif arg == "-n" or arg.startswith("--lines="):
+                    if arg == "-n":
+                        if idx + 1 >= len(args):
+                            shell.oute.print(
+                                "ERR: tail: -n requires an argument"
+                            )
+                            return
+                        value = args[idx + 1]
+                        idx += 1
+                    else:
+                        value = arg[len("--lines="):]
+                    # A count, optionally with a + sign as int() allows;
+                    # deque(maxlen=n) rejects negative ones.
+                    if not value.removeprefix("+").isdigit():
+                        shell.oute.print(
+                            f"ERR: tail: invalid number of lines {value!r}"
+                        )
+                        return
+                    n = int(value)
+                elif arg in ("-f", "--follow"):
+                    follow = True
+                elif arg == "-F":
+                    follow = by_name = True
             else:
                 filenames.append(arg)
             idx += 1
@@ -3096,19 +4156,25 @@ class CmdTail(Cmd):
                 files.extend(allfiles)
             else:
                 files.append(filename)
-        # If no files and we have piped stdin, buffer and tail it
+        # If no files and we have piped stdin, keep only the last n lines
         if not files and shell.current_stdin is not None:
-            lines = list(shell.current_stdin)
-            for line in lines[-n:]:
+            for line in collections.deque(shell.current_stdin, maxlen=n):
                 shell.outs.write(line)
             return
+        headers = follow and len(files) > 1
+        followed = []
         for filename in files:
             if not os.path.exists(filename):
                 shell.oute.print(f"ERR: {filename} not found")
+                if by_name:
+                    # -F keeps waiting for the file to appear.
+                    followed.append(_FollowedFile(filename, None, "utf8"))
                 continue
             if os.path.isdir(filename):
                 continue  # silently skip directories
-            with open(filename, "rb") as infile:
+            infile = open(filename, "rb")
+            with contextlib.ExitStack() as stack:
+                stack.callback(infile.close)
                 tail_bytes = self._tail_bytes(infile, n)
                 encoding = "utf8"
                 try:
@@ -3116,24 +4182,82 @@ class CmdTail(Cmd):
                 except UnicodeDecodeError:
                     encoding = "Latin1"
                     text = tail_bytes.decode(encoding)
+                if headers:
+                    sep = "\n" if followed else ""
+                    shell.outs.write(f"{sep}==> {filename} <==\n")
                 shell.outs.write(text)
-                if "-f" in args or "--follow" in args:
-                    while True:
-                        try:
-                            line = infile.readline()
-                            if line:
-                                try:
-                                    shell.outs.write(line.decode(encoding))
-                                except Exception:
-                                    encoding = "Latin1" if encoding == "utf8" else "utf8"
-                                    try:
-                                        shell.outs.write(line.decode(encoding))
-                                    except Exception:
-                                        pass
-                            else:
-                                time.sleep(1)
-                        except KeyboardInterrupt:
-                            break
+                if follow:
+                    followed.append(_FollowedFile(filename, infile, encoding))
+                    stack.pop_all()
+        if followed:
+            self._follow(shell, followed, by_name)
+
+    def _follow(self, shell, followed, by_name, stop=None):
+        """Print data appended to the *followed* files as it arrives, until
+        interrupted or *stop* returns True.
+
+        Sleeps on inotify events for the files' directories (or polls),
+        then reads every file: a file that shrank was truncated and is
+        read again from the start, and with *by_name* a file replaced at
+        its path (rotation) is drained and the new one followed.
+        """
+        watcher = _Inotify.create()
+        current = followed[-1]
+        try:
+            while stop is None or not stop():
+                for entry in followed:
+                    if watcher is not None:
+                        watcher.watch_dir(os.path.dirname(entry.path))
+                    text = self._follow_read(shell, entry, by_name)
+                    if not text:
+                        continue
+                    if len(followed) > 1 and entry is not current:
+                        shell.outs.write(f"\n==> {entry.path} <==\n")
+                    current = entry
+                    shell.outs.write(text)
+                if watcher is not None:
+                    watcher.wait(self.FOLLOW_INTERVAL)
+                else:
+                    time.sleep(self.POLL_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if watcher is not None:
+                watcher.close()
+            for entry in followed:
+                entry.close()
+
+    def _follow_read(self, shell, entry, by_name):
+        """Return the new text of one followed file."""
+        if entry.file is None:
+            try:
+                entry.reopen()
+            except OSError:
+                return ""
+            shell.oute.print(f"tail: {entry.path} has appeared; following new file")
+            return entry.read()
+        st = os.fstat(entry.file.fileno())
+        if st.st_size < entry.file.tell():
+            shell.oute.print(f"tail: {entry.path}: file truncated")
+            entry.file.seek(0)
+        text = entry.read()
+        if by_name:
+            try:
+                now = os.stat(entry.path)
+            except OSError:
+                # Rotated away and not recreated yet: keep the old file.
+                return text
+            if (now.st_dev, now.st_ino) != (st.st_dev, st.st_ino):
+                text += entry.read()
+                try:
+                    entry.reopen()
+                except OSError:
+                    return text
+                shell.oute.print(
+                    f"tail: {entry.path} has been replaced; following new file"
+                )
+                text += entry.read()
+        return text
 
     def _tail_bytes(self, infile, n):
         """Return the raw bytes of the last *n* lines of *infile*.
@@ -3141,12 +4265,15 @@ class CmdTail(Cmd):
         Seeks backwards through the file in chunks so that only a small
         portion of a large file is ever read into memory.  The file must
         be opened in binary mode and support seeking (regular files do).
+        Newlines are counted with bytes.count, and once the last chunk is
+        known the cut point is found with rfind from its end, so no Python
+        code runs per byte and no line is copied.  Chunks grow with the
+        estimated distance still to go, based on the line lengths seen so
+        far.
         """
-        if n == 0:
+        if n <= 0:
             return b""
 
-        CHUNK = 1024 * 8
-
         infile.seek(0, 2)           # seek to end
         file_size = infile.tell()
         if file_size == 0:
@@ -3164,21 +4291,29 @@ class CmdTail(Cmd):
         # We need to find n newlines to isolate the last n lines.
         newlines_found = 0
         pos = scan_end          # current scan position (exclusive upper bound)
-        start = 0               # byte offset of first desired line (default: whole file)
+        chunk_size = self.CHUNK
 
         while pos > 0:
-            chunk_size = min(CHUNK, pos)
+            chunk_size = min(chunk_size, pos)
             pos -= chunk_size
             infile.seek(pos)
             chunk = infile.read(chunk_size)
-            for i in range(len(chunk) - 1, -1, -1):
-                if chunk[i] == ord(b"\n"):
-                    newlines_found += 1
-                    if newlines_found == n:
-                        start = pos + i + 1
-                        infile.seek(start)
-                        return infile.read()
-            # Haven't found enough newlines yet; keep going
+            count = chunk.count(b"\n")
+            if newlines_found + count >= n:
+                # The wanted newline is in this chunk.
+                cut = len(chunk)
+                for _ in range(n - newlines_found):
+                    cut = chunk.rfind(b"\n", 0, cut)
+                infile.seek(pos + cut + 1)
+                return infile.read()
+            newlines_found += count
+            scanned = scan_end - pos
+            if newlines_found:
+                per_line = scanned / newlines_found
+                chunk_size = int(per_line * (n - newlines_found) * 1.25)
+            else:
+                chunk_size *= 2
+            chunk_size = min(max(chunk_size, self.CHUNK), self.MAX_CHUNK)
 
         # Reached the beginning of the file before finding n newlines:
         # the file has fewer than n lines — return everything.
@@ -3262,6 +4397,169 @@ class CmdHead(Cmd):
                             pass
 
 
+class _LineIndex:
+    """Byte offsets of the lines of a file, for random access by line number.
+
+    ``offsets[i]`` is where line *i* (0-based) starts and a last entry
+    holds the file size, so line *i* is the bytes between ``offsets[i]``
+    and ``offsets[i+1]``.  The offsets are found by scanning chunks with
+    bytes.split, without keeping any line around.  Indexes of large files
+    are saved in the cache directory, keyed by the file's path, size and
+    modification time, so the next command on the same file skips the
+    scan.  The least recently used indexes are removed once the cache
+    grows past CACHE_MAX_SIZE.
+    """
+
+    # Bytes read per chunk while scanning.
+    CHUNK = 1024**2
+    # Only files at least this large get their index cached; smaller ones
+    # are rescanned faster than a cache file can be looked up.
+    CACHE_MIN_SIZE = 8 * 1024**2
+    # Total size of the cached indexes (about 8 bytes per line) before the
+    # least recently used ones are removed.
+    CACHE_MAX_SIZE = 256 * 1024**2
+
+    def __init__(self, offsets, complete=True):
+        self.offsets = offsets
+        # An incomplete index covers the file only up to `_pos`; its last
+        # offset is the start of a line whose end has not been seen yet.
+        self.complete = complete
+        self._pos = offsets[-1]
+        self._cache = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def scan(cls, f):
+        """Index the whole binary file object *f*."""
+        index = cls(array.array("Q", [0]), complete=False)
+        while index.scan_more(f):
+            pass
+        return index
+
+    def scan_more(self, f):
+        """Index the next chunk of *f*.  Returns False once the index is
+        complete."""
+        if self.complete:
+            return False
+        f.seek(self._pos)
+        chunk = f.read(self.CHUNK)
+        if not chunk:
+            if self.offsets[-1] != self._pos:
+                self.offsets.append(self._pos)
+            self.complete = True
+            if self._cache:
+                self._save(*self._cache)
+            return False
+        lengths = map(len, chunk.split(b"\n")[:-1])
+        starts = itertools.accumulate(
+            map((1).__add__, lengths), initial=self._pos
+        )
+        next(starts)  # `_pos` itself is already the last offset
+        self.offsets.extend(starts)
+        self._pos += len(chunk)
+        return True
+
+    @classmethod
+    def open(cls, f, cache_dir=None, lazy=False):
+        """Index the binary file *f*, using and updating the cache in
+        *cache_dir* when it is given.  With *lazy*, an incomplete index is
+        returned that the caller extends with scan_more()."""
+        index = cls(array.array("Q", [0]), complete=False)
+        st = os.fstat(f.fileno())
+        if cache_dir and st.st_size >= cls.CACHE_MIN_SIZE:
+            key = (st.st_size, st.st_mtime_ns)
+            name = hashlib.sha1(
+                os.path.abspath(f.name).encode("utf8", "surrogateescape")
+            )
+            cache = os.path.join(cache_dir, name.hexdigest() + ".idx")
+            cached = cls._load(cache, key)
+            if cached is not None:
+                return cached
+            index._cache = (cache, key)
+        if not lazy:
+            while index.scan_more(f):
+                pass
+        return index
+
+    @classmethod
+    def _load(cls, cache, key):
+        try:
+            with open(cache, "rb") as infile:
+                data = infile.read()
+        except OSError:
+            return None
+        header = array.array("Q")
+        header.frombytes(data[:3 * header.itemsize])
+        if len(header) != 3 or tuple(header[:2]) != key:
+            return None
+        offsets = array.array("Q")
+        offsets.frombytes(data[3 * header.itemsize:])
+        if len(offsets) != header[2]:
+            return None
+        # The modification time records the last use, for eviction.
+        with contextlib.suppress(OSError):
+            os.utime(cache)
+        return cls(offsets)
+
+    def _save(self, cache, key):
+        # Write under a temporary name and rename, so that a concurrent
+        # reader never sees a half-written index.
+        header = array.array("Q", [*key, len(self.offsets)])
+        try:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            outfile = tempfile.NamedTemporaryFile(
+                "wb", dir=os.path.dirname(cache), delete=False
+            )
+        except OSError:
+            return  # no cache then
+        try:
+            with outfile:
+                outfile.write(header.tobytes())
+                outfile.write(self.offsets.tobytes())
+            os.replace(outfile.name, cache)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(outfile.name)
+            return
+        self._evict(os.path.dirname(cache), cache)
+
+    @classmethod
+    def _evict(cls, cache_dir, keep):
+        """Remove the least recently used indexes in *cache_dir* (but not
+        *keep*) until they take at most CACHE_MAX_SIZE bytes."""
+        entries = []
+        total = 0
+        try:
+            with os.scandir(cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".idx"):
+                        with contextlib.suppress(OSError):
+                            st = entry.stat()
+                            entries.append(
+                                (st.st_mtime_ns, entry.path, st.st_size)
+                            )
+                            total += st.st_size
+        except OSError:
+            return
+        entries.sort()
+        for _, path, size in entries:
+            if total <= cls.CACHE_MAX_SIZE:
+                break
+            if path == keep:
+                continue
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+
+    def read(self, f, lo, hi):
+        """Return the raw bytes of lines *lo* to *hi* (0-based, exclusive)
+        of the binary file *f*."""
+        f.seek(self.offsets[lo])
+        return f.read(self.offsets[hi] - self.offsets[lo])
+
+
 class CmdLines(Cmd):
     def __init__(self):
         Cmd.__init__(self, "lines")
@@ -3370,12 +4668,15 @@ class CmdLines(Cmd):
                     break
                 encoding = self._write_line(shell, raw, encoding)
             return
-        lines = infile.readlines()
-        resolved = self._resolve(start, end, len(lines))
+        # Negative or open ranges need the line count: index the file and
+        # seek straight to the first wanted line.
+        index = _LineIndex.open(infile, shell.cache_dir("lines"))
+        resolved = self._resolve(start, end, len(index))
         if resolved is None:
             return
         lo, hi = resolved
-        for raw in lines[lo-1:hi]:
+        infile.seek(index.offsets[lo-1])
+        for raw in itertools.islice(infile, hi - lo + 1):
             encoding = self._write_line(shell, raw, encoding)
 
     def _emit_from_iter(self, shell, stdin, start, end):
@@ -3987,13 +5288,72 @@ class CmdGrep(Cmd):
                 yield path
 
 
+def _sort_decorate(lines, field, numeric):
+    """Return [(key, line), ...] for *lines* as ordered by `sort`.
+
+    Each line is split and converted at most once, rather than once per
+    key lookup.
+    """
+    if field is None:
+        values = lines
+    else:
+        i = field - 1
+        values = [
+            p[i] if len(p) > i else ""
+            for p in [line.split(None, field) for line in lines]
+        ]
+    if not numeric:
+        return list(zip(values, lines))
+    keys = []
+    for v in values:
+        try:
+            keys.append((0, float(v)))
+        except ValueError:
+            keys.append((1, v))  # non-numeric sorts after numeric
+    return list(zip(keys, lines))
+
+
+def _sort_pairs(pairs, numeric, reverse):
+    """Sort decorated (key, line) *pairs* stably; returns the sorted list."""
+    if not numeric:
+        pairs.sort(key=operator.itemgetter(0), reverse=reverse)
+        return pairs
+    # Sort numbers and non-numbers separately so each sort compares plain
+    # floats or plain strs (which list.sort special-cases) instead of
+    # (flag, value) tuples.
+    nums = [p for p in pairs if p[0][0] == 0]
+    others = [p for p in pairs if p[0][0] != 0]
+    value = lambda p: p[0][1]
+    nums.sort(key=value, reverse=reverse)
+    others.sort(key=value, reverse=reverse)
+    return others + nums if reverse else nums + others
+
+
+def _sort_chunk(lines, field, numeric, reverse):
+    """Decorate and sort one chunk; module level so pool workers can run it."""
+    return _sort_pairs(_sort_decorate(lines, field, numeric), numeric, reverse)
+
+
 class CmdSort(Cmd):
+    # Estimated in-memory size above which input is sorted in runs that are
+    # spilled to temporary files and merged (override with -S).
+    DEFAULT_BUFFER = 256 * 1024**2
+    # Maximum number of runs merged at once; more runs are merged in passes
+    # so we never hold more than this many temp files open.
+    MERGE_FANIN = 64
+    # With --parallel, chunks smaller than this are sorted in-process since
+    # shipping them to a worker costs more than sorting them.
+    PARALLEL_MIN = 20000
+    # Lines read (and decorated, for runs) per batch.
+    READ_BATCH = 4096
+
     def __init__(self):
         Cmd.__init__(self, "sort")
 
     def help(self):
         return (
-            "[-r] [-n] [-u] [-k <field>] [<file>...]"
+            "[-r] [-n] [-u] [-k <field>] [-S <size>] [-T <dir>] "
+            "[--parallel <n>] [<file>...]"
             "   : sorts lines from files or stdin"
         )
 
@@ -4002,6 +5362,9 @@ class CmdSort(Cmd):
         numeric = False
         unique = False
         key = None
+        buffer_size = self.DEFAULT_BUFFER
+        temp_dir = None
+        parallel = 1
         filenames = []
         idx = 0
         after_args = False
@@ -4031,6 +5394,53 @@ class CmdSort(Cmd):
                         shell.oute.print("ERR: sort: field must be >= 1")
                         return
                     idx += 1
+                elif arg == "-S":
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: sort: -S requires an argument")
+                        return
+                    try:
+                        buffer_size = _parse_size(args[idx + 1])
+                    except ValueError as e:
+                        shell.oute.print(f"ERR: sort: {e}")
+                        return
+                    if buffer_size < 1:
+                        shell.oute.print("ERR: sort: buffer size must be > 0")
+                        return
+                    idx += 1
+                elif arg == "-T":
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: sort: -T requires an argument")
+                        return
+                    temp_dir = args[idx + 1]
+                    if not os.path.isabs(temp_dir):
+                        temp_dir = shell.canon(os.path.join(shell.cwd, temp_dir))
+                    if not os.path.isdir(temp_dir):
+                        shell.oute.print(
+                            f"ERR: sort: {temp_dir} is not a directory"
+                        )
+                        return
+                    idx += 1
+                elif arg == "--parallel" or arg.startswith("--parallel="):
+                    if arg == "--parallel":
+                        if idx + 1 >= len(args):
+                            shell.oute.print(
+                                "ERR: sort: --parallel requires an argument"
+                            )
+                            return
+                        value = args[idx + 1]
+                        idx += 1
+                    else:
+                        value = arg[len("--parallel="):]
+                    try:
+                        parallel = int(value)
+                    except ValueError:
+                        shell.oute.print(
+                            f"ERR: sort: invalid number of workers {value!r}"
+                        )
+                        return
+                    if parallel < 1:
+                        shell.oute.print("ERR: sort: --parallel must be >= 1")
+                        return
                 else:
                     shell.oute.print(f"ERR: sort: unknown option {arg!r}")
                     return
@@ -4038,65 +5448,232 @@ class CmdSort(Cmd):
                 filenames.append(arg)
             idx += 1
 
-        lines = []
-        if filenames:
-            for fn in filenames:
-                if not os.path.isabs(fn):
-                    fn = shell.canon(os.path.join(shell.cwd, fn))
-                if not os.path.exists(fn):
-                    shell.oute.print(f"ERR: {fn} not found")
-                    continue
-                if os.path.isdir(fn):
-                    shell.oute.print(f"ERR: {fn}: is a directory")
-                    continue
-                with open(fn, encoding="utf8", errors="replace") as f:
-                    for line in f:
-                        lines.append(line.rstrip("\n").rstrip("\r"))
-        elif shell.current_stdin is not None:
-            for line in shell.current_stdin:
-                lines.append(line.rstrip("\n").rstrip("\r"))
+        def read_batches(source):
+            while True:
+                batch = list(itertools.islice(source, self.READ_BATCH))
+                if not batch:
+                    return
+                yield [line.rstrip("\n").rstrip("\r") for line in batch]
 
-        def field_value(line):
-            if key is None:
-                return line
-            parts = line.split()
-            if key - 1 < len(parts):
-                return parts[key - 1]
-            return ""
+        def read_lines():
+            """Yield the input as batches of lines with line endings removed."""
+            if filenames:
+                for fn in filenames:
+                    if not os.path.isabs(fn):
+                        fn = shell.canon(os.path.join(shell.cwd, fn))
+                    if not os.path.exists(fn):
+                        shell.oute.print(f"ERR: {fn} not found")
+                        continue
+                    if os.path.isdir(fn):
+                        shell.oute.print(f"ERR: {fn}: is a directory")
+                        continue
+                    with open(fn, encoding="utf8", errors="replace") as f:
+                        yield from read_batches(f)
+            elif shell.current_stdin is not None:
+                yield from read_batches(shell.current_stdin)
 
-        def sort_key(line):
-            v = field_value(line)
-            if numeric:
-                try:
-                    return (0, float(v))
-                except ValueError:
-                    return (1, v)  # non-numeric sorts after numeric
-            return (0, v)
+        opts = (key, numeric, reverse, unique)
+        runs = []
+        try:
+            with contextlib.ExitStack() as stack:
+                pool = None
+                if parallel > 1:
+                    pool = stack.enter_context(
+                        concurrent.futures.ProcessPoolExecutor(parallel)
+                    )
+                # With -u the chunk holds (key, line) pairs: lines are
+                # decorated and deduplicated against a hash set of keys as
+                # they are read, so duplicates never reach the sort and each
+                # key is computed once.  The set is per chunk; duplicates
+                # spread across spilled runs are dropped while merging.
+                items = []
+                seen = set()
+                size = 0
+                for batch in read_lines():
+                    if unique:
+                        fresh = []
+                        for pair in _sort_decorate(batch, key, numeric):
+                            if pair[0] not in seen:
+                                seen.add(pair[0])
+                                fresh.append(pair)
+                        items.extend(fresh)
+                        size += sum(sys.getsizeof(line) for _, line in fresh)
+                    else:
+                        items.extend(batch)
+                        size += sum(map(sys.getsizeof, batch))
+                    if size >= buffer_size:
+                        pairs = self._sort(items, opts, pool, parallel)
+                        runs.append(self._write_run(pairs, temp_dir))
+                        items = []
+                        seen.clear()
+                        size = 0
+                pairs = self._sort(items, opts, pool, parallel)
+            if runs:
+                # Keep the last chunk in memory and merge it with the runs.
+                while len(runs) + 1 > self.MERGE_FANIN:
+                    batch = runs[:self.MERGE_FANIN]
+                    merged = self._merge_runs(batch, opts, temp_dir)
+                    for path in batch:
+                        self._remove_run(path)
+                    # The merged runs came first, so their result does too:
+                    # _merge keeps equal keys in source order.
+                    runs = [merged] + runs[self.MERGE_FANIN:]
+                with contextlib.ExitStack() as stack:
+                    sources = [
+                        self._read_run(stack.enter_context(self._open_run(p)), opts)
+                        for p in runs
+                    ]
+                    sources.append(pairs)
+                    for _, line in self._merge(sources, opts):
+                        shell.outs.print(line)
+            else:
+                for _, line in pairs:
+                    shell.outs.print(line)
+        finally:
+            for path in runs:
+                self._remove_run(path)
 
-        lines.sort(key=sort_key, reverse=reverse)
+    def _sort(self, items, opts, pool, parallel):
+        """Return *items* sorted as decorated (key, line) pairs.
 
+        *items* are plain lines, or already decorated pairs with -u.
+        """
+        key, numeric, reverse, unique = opts
         if unique:
-            seen = set()
-            deduped = []
-            for line in lines:
-                k = sort_key(line)
-                if k not in seen:
-                    seen.add(k)
-                    deduped.append(line)
-            lines = deduped
+            func, extra = _sort_pairs, (numeric, reverse)
+        else:
+            func, extra = _sort_chunk, (key, numeric, reverse)
+        if pool is not None and len(items) >= self.PARALLEL_MIN:
+            step = -(-len(items) // parallel)
+            chunks = [items[i:i + step] for i in range(0, len(items), step)]
+            try:
+                parts = list(pool.map(
+                    func, chunks, *[itertools.repeat(a) for a in extra],
+                ))
+            except (OSError, concurrent.futures.BrokenExecutor):
+                # No worker processes available here; sort in-process.
+                parts = [func(items, *extra)]
+            # Timsort finds the sorted chunks as runs and merges them in C,
+            # which is much cheaper than a Python-level heapq.merge here.
+            return _sort_pairs(
+                list(itertools.chain.from_iterable(parts)), numeric, reverse,
+            )
+        return func(items, *extra)
 
-        for line in lines:
-            shell.outs.print(line)
+    def _merge(self, sources, opts):
+        """k-way merge sorted (key, line) streams, stable across *sources*."""
+        _, _, reverse, unique = opts
+        merged = heapq.merge(
+            *sources, key=operator.itemgetter(0), reverse=reverse,
+        )
+        if unique:
+            merged = self._unique(merged)
+        return merged
+
+    def _unique(self, pairs):
+        """Drop pairs whose key equals that of the previous pair.
+
+        Input must already be sorted, so equal keys are adjacent."""
+        prev = None
+        first = True
+        for pair in pairs:
+            if first or pair[0] != prev:
+                yield pair
+                prev = pair[0]
+                first = False
+
+    def _open_run(self, path, mode="r"):
+        # newline="\n" keeps embedded \r intact; surrogatepass lets any str
+        # that came in through stdin round-trip unchanged.
+        return open(path, mode, encoding="utf8", errors="surrogatepass",
+                    newline="\n")
+
+    def _read_run(self, f, opts):
+        """Yield (key, line) pairs from a run file, decorating in batches."""
+        key, numeric, _, _ = opts
+        while True:
+            lines = [line[:-1] for line in itertools.islice(f, self.READ_BATCH)]
+            if not lines:
+                return
+            yield from _sort_decorate(lines, key, numeric)
+
+    def _write_run(self, pairs, temp_dir):
+        """Write sorted (key, line) *pairs* to a new temp file; return its path."""
+        fd, path = tempfile.mkstemp(prefix="dsh-sort-", dir=temp_dir)
+        os.close(fd)
+        with self._open_run(path, "w") as f:
+            for _, line in pairs:
+                f.write(line)
+                f.write("\n")
+        return path
+
+    def _merge_runs(self, paths, opts, temp_dir):
+        """k-way merge the run files in *paths* into a new run file."""
+        with contextlib.ExitStack() as stack:
+            sources = [
+                self._read_run(stack.enter_context(self._open_run(p)), opts)
+                for p in paths
+            ]
+            return self._write_run(self._merge(sources, opts), temp_dir)
+
+    def _remove_run(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    May report a string as present that was never added (at roughly
+    *error_rate* once *capacity* strings are in), never the reverse.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        nbits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nbits = nbits
+        self.k = max(1, round(nbits / capacity * math.log(2)))
+        self.bits = bytearray((nbits + 7) // 8)
+
+    def _positions(self, s):
+        # Double hashing: two 64-bit halves of one digest give all k probes.
+        d = hashlib.blake2b(
+            s.encode("utf8", errors="surrogatepass"), digest_size=16,
+        ).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.k)]
+
+    def add(self, s):
+        """Add *s*; return True if it was (probably) already present."""
+        present = True
+        bits = self.bits
+        for pos in self._positions(s):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+        return present
 
 
 class CmdUniq(Cmd):
+    # Distinct lines remembered exactly by --global before it either stops
+    # tracking new lines or, with --approx, switches to a Bloom filter.
+    MAX_EXACT = 1_000_000
+    # The Bloom filter is sized for this many times MAX_EXACT further lines.
+    APPROX_FACTOR = 10
+
     def __init__(self):
         Cmd.__init__(self, "uniq")
 
     def help(self):
         return (
-            "[-c] [-d] [-u] [-i] [<file>]"
-            "   : collapse adjacent duplicate lines"
+            "[-c] [-d] [-u] [-i] [-g [--max-exact <n>] [--approx]] "
+            "[-a [--top <n>]] [<file>]"
+            "   : collapse adjacent duplicate lines "
+            "(-g/--global: drop all repeated lines, keeping input order; "
+            "-a/--count-all: count all lines, most frequent first)"
         )
 
     def execute(self, shell, args):
@@ -4104,6 +5681,11 @@ class CmdUniq(Cmd):
         only_dups = False
         only_unique = False
         ignore_case = False
+        global_mode = False
+        max_exact = self.MAX_EXACT
+        approx = False
+        count_all = False
+        top = None
         filename = None
         idx = 0
         after_args = False
@@ -4120,6 +5702,45 @@ class CmdUniq(Cmd):
                     only_unique = True
                 elif arg == "-i":
                     ignore_case = True
+                elif arg in ("-g", "--global"):
+                    global_mode = True
+                elif arg == "--approx":
+                    approx = True
+                elif arg in ("-a", "--count-all"):
+                    count_all = True
+                elif arg == "--top":
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: uniq: --top requires an argument")
+                        return
+                    try:
+                        top = int(args[idx + 1])
+                    except ValueError:
+                        shell.oute.print(
+                            f"ERR: uniq: invalid number {args[idx + 1]!r}"
+                        )
+                        return
+                    if top < 1:
+                        shell.oute.print("ERR: uniq: --top must be >= 1")
+                        return
+                    count_all = True
+                    idx += 1
+                elif arg == "--max-exact":
+                    if idx + 1 >= len(args):
+                        shell.oute.print(
+                            "ERR: uniq: --max-exact requires an argument"
+                        )
+                        return
+                    try:
+                        max_exact = int(args[idx + 1])
+                    except ValueError:
+                        shell.oute.print(
+                            f"ERR: uniq: invalid number {args[idx + 1]!r}"
+                        )
+                        return
+                    if max_exact < 1:
+                        shell.oute.print("ERR: uniq: --max-exact must be >= 1")
+                        return
+                    idx += 1
                 else:
                     shell.oute.print(f"ERR: uniq: unknown option {arg!r}")
                     return
@@ -4130,6 +5751,12 @@ class CmdUniq(Cmd):
                 filename = arg
             idx += 1
 
+        if global_mode and (count_mode or only_dups or only_unique or count_all):
+            shell.oute.print(
+                "ERR: uniq: --global cannot be combined with -c, -d, -u or -a"
+            )
+            return
+
         if filename is not None:
             fn = filename
             if not os.path.isabs(fn):
@@ -4145,6 +5772,19 @@ class CmdUniq(Cmd):
         else:
             return
 
+        if global_mode or count_all:
+            try:
+                if global_mode:
+                    self._global(shell, source, ignore_case, max_exact, approx)
+                else:
+                    self._count_all(
+                        shell, source, ignore_case, top, only_dups, only_unique,
+                    )
+            finally:
+                if close_after:
+                    source.close()
+            return
+
         prev = None
         prev_key = None
         count = 0
@@ -4181,6 +5821,70 @@ class CmdUniq(Cmd):
             if close_after:
                 source.close()
 
+    def _count_all(self, shell, source, ignore_case, top, only_dups, only_unique):
+        """Count every distinct line in one pass, input need not be sorted.
+
+        Prints counts like -c, most frequent first (ties in first-seen
+        order).  Memory is proportional to the number of distinct lines;
+        with *top* only the *top* most frequent are selected, via a heap.
+        """
+        lines = (line.rstrip("\n").rstrip("\r") for line in source)
+        if ignore_case:
+            # Count lowercased keys but show the first spelling seen.
+            first = {}
+            counts = collections.Counter()
+            for line in lines:
+                key = line.lower()
+                if key not in first:
+                    first[key] = line
+                counts[key] += 1
+        else:
+            first = None
+            counts = collections.Counter(lines)
+        items = counts.items()
+        if only_dups:
+            items = [(k, c) for k, c in items if c > 1]
+        elif only_unique:
+            items = [(k, c) for k, c in items if c == 1]
+        if top is not None:
+            ranked = heapq.nlargest(top, items, key=operator.itemgetter(1))
+        else:
+            ranked = sorted(items, key=operator.itemgetter(1), reverse=True)
+        for key, count in ranked:
+            line = first[key] if first is not None else key
+            shell.outs.print(f"{count:7} {line}")
+
+    def _global(self, shell, source, ignore_case, max_exact, approx):
+        """Print each line the first time its key is seen, in input order.
+
+        Keys are kept in an exact set up to *max_exact* entries.  After
+        that new keys go into a Bloom filter when *approx* is set (a rare
+        false positive drops a line that was not a duplicate), or are no
+        longer tracked, so later repeats of them are printed again.
+        """
+        seen = set()
+        bloom = None
+        warned = False
+        for line in source:
+            line = line.rstrip("\n").rstrip("\r")
+            key = line.lower() if ignore_case else line
+            if key in seen:
+                continue
+            if len(seen) < max_exact:
+                seen.add(key)
+            elif approx:
+                if bloom is None:
+                    bloom = _BloomFilter(max_exact * self.APPROX_FACTOR)
+                if bloom.add(key):
+                    continue
+            elif not warned:
+                shell.oute.print(
+                    f"ERR: uniq: more than {max_exact} distinct lines; "
+                    "further repeats are not removed (use --approx)"
+                )
+                warned = True
+            shell.outs.print(line)
+
 
 class CmdCut(Cmd):
     def __init__(self):
@@ -4188,14 +5892,13 @@ class CmdCut(Cmd):
 
     def help(self):
         return (
-            "(-f <list> [-d <delim>] | -c <list>) [<file>...]"
-            "   : extract fields or characters from each line"
+            "(-f <list> [-d <delim>] | -c <list> | -b <list>) [<file>...]"
+            "   : extract fields, characters or bytes from each line"
         )
 
     def execute(self, shell, args):
         delim = "\t"
-        fields_spec = None
-        chars_spec = None
+        specs = {}
         filenames = []
         idx = 0
         after_args = False
@@ -4210,17 +5913,11 @@ class CmdCut(Cmd):
                         return
                     delim = args[idx + 1]
                     idx += 1
-                elif arg == "-f":
-                    if idx + 1 >= len(args):
-                        shell.oute.print("ERR: cut: -f requires an argument")
-                        return
-                    fields_spec = args[idx + 1]
-                    idx += 1
-                elif arg == "-c":
+                elif arg in ("-f", "-c", "-b"):
                     if idx + 1 >= len(args):
-                        shell.oute.print("ERR: cut: -c requires an argument")
+                        shell.oute.print(f"ERR: cut: {arg} requires an argument")
                         return
-                    chars_spec = args[idx + 1]
+                    specs[arg] = args[idx + 1]
                     idx += 1
                 else:
                     shell.oute.print(f"ERR: cut: unknown option {arg!r}")
@@ -4229,33 +5926,36 @@ class CmdCut(Cmd):
                 filenames.append(arg)
             idx += 1
 
-        if (fields_spec is None) == (chars_spec is None):
-            shell.oute.print("ERR: cut: specify exactly one of -f or -c")
+        if len(specs) != 1:
+            shell.oute.print("ERR: cut: specify exactly one of -f, -c or -b")
+            return
+        (mode, spec), = specs.items()
+        if mode == "-f" and delim == "":
+            shell.oute.print("ERR: cut: the delimiter must not be empty")
             return
 
         try:
-            ranges = self._parse_ranges(fields_spec or chars_spec)
+            slices = self._normalize(self._parse_ranges(spec))
         except ValueError as e:
             shell.oute.print(f"ERR: cut: {e}")
             return
 
-        def select(seq):
-            out = []
-            n = len(seq)
-            taken = [False] * n
-            for lo, hi in ranges:
-                end = n if hi is None else min(hi, n)
-                for i in range(lo - 1, end):
-                    if not taken[i]:
-                        out.append(seq[i])
-                        taken[i] = True
-            return out
-
-        def process_line(line):
-            if chars_spec is not None:
-                return "".join(select(list(line)))
-            parts = line.split(delim)
-            return delim.join(select(parts))
+        if mode == "-f":
+            process_line = self._field_cutter(slices, delim)
+        elif len(slices) == 1:
+            (start, stop), = slices
+            process_line = lambda line: line[start:stop]
+        else:
+            empty = b"" if mode == "-b" else ""
+            process_line = lambda line: empty.join(
+                [line[start:stop] for start, stop in slices]
+            )
+        if mode == "-b":
+            # Bytes are cut from the raw line; only the result is decoded.
+            cut_text = process_line
+            process_line = lambda line: cut_text(line).decode(
+                "utf8", errors="replace"
+            )
 
         if filenames:
             for fn in filenames:
@@ -4264,6 +5964,12 @@ class CmdCut(Cmd):
                 if not os.path.exists(fn):
                     shell.oute.print(f"ERR: {fn} not found")
                     continue
+                if mode == "-b":
+                    with open(fn, "rb") as f:
+                        for line in f:
+                            line = line.rstrip(b"\n").rstrip(b"\r")
+                            shell.outs.print(process_line(line))
+                    continue
                 with open(fn, encoding="utf8", errors="replace") as f:
                     for line in f:
                         line = line.rstrip("\n").rstrip("\r")
@@ -4271,8 +5977,52 @@ class CmdCut(Cmd):
         elif shell.current_stdin is not None:
             for line in shell.current_stdin:
                 line = line.rstrip("\n").rstrip("\r")
+                if mode == "-b":
+                    line = line.encode("utf8", errors="surrogatepass")
                 shell.outs.print(process_line(line))
 
+    def _normalize(self, ranges):
+        """Turn 1-based inclusive (lo, hi) ranges into sorted, merged,
+        0-based (start, stop) slice bounds; stop None means to the end.
+        Like POSIX cut, the selection is output in input order."""
+        result = []
+        for lo, hi in sorted(ranges, key=operator.itemgetter(0)):
+            start = lo - 1
+            if result and (result[-1][1] is None or start <= result[-1][1]):
+                prev_start, prev_stop = result[-1]
+                if prev_stop is None or hi is None:
+                    result[-1] = (prev_start, None)
+                else:
+                    result[-1] = (prev_start, max(prev_stop, hi))
+            else:
+                result.append((start, hi))
+        return result
+
+    def _field_cutter(self, slices, delim):
+        """Return a function cutting the fields in *slices* from a line."""
+        last = slices[-1][1]
+        # Without an open-ended range only the leading fields are needed,
+        # so the split stops there and the rest of the line stays intact.
+        maxsplit = -1 if last is None else last
+        if len(slices) == 1:
+            (start, stop), = slices
+            return lambda line: delim.join(line.split(delim, maxsplit)[start:stop])
+
+        def pieces(parts):
+            return [p for start, stop in slices for p in parts[start:stop]]
+        if last is None:
+            return lambda line: delim.join(pieces(line.split(delim)))
+        getter = operator.itemgetter(
+            *[i for start, stop in slices for i in range(start, stop)]
+        )
+
+        def cut(line):
+            parts = line.split(delim, maxsplit)
+            if len(parts) >= last:
+                return delim.join(getter(parts))
+            return delim.join(pieces(parts))
+        return cut
+
     def _parse_ranges(self, spec):
         """Parse a comma-separated list like '1,3-5,7-' into list of (lo, hi)
         tuples, hi=None means open-ended."""
@@ -4296,10 +6046,17 @@ class CmdCut(Cmd):
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# awk: a small subset (no arrays, no loops, no user functions)
+# awk: a subset (no getline, no I/O redirection)
 # ─────────────────────────────────────────────────────────────────────────────
 
-_AWK_KEYWORDS = {"BEGIN", "END", "if", "else", "next", "print", "printf"}
+_AWK_KEYWORDS = {
+    "BEGIN", "END", "if", "else", "next", "print", "printf",
+    "while", "do", "for", "in", "break", "continue", "delete",
+    "function", "return",
+}
+
+# Joins the subscripts of a[i, j] into a single key, as in POSIX awk.
+_AWK_SUBSEP = "\x1c"
 
 
 def _awk_lex(src):
@@ -4394,16 +6151,21 @@ def _awk_lex(src):
             expect_regex = False
             continue
         two = src[i:i + 2]
-        if two in ("==", "!=", "<=", ">=", "&&", "||", "!~",
-                   "+=", "-=", "*=", "/=", "%="):
+        if two in ("++", "--"):
+            tokens.append((two, two))
+            i += 2
+            expect_regex = False
+            continue
+        if two in ("==", "!=", "<=", ">=", "&&", "||", "!~",
+                   "+=", "-=", "*=", "/=", "%="):
             tokens.append((two, two))
             i += 2
             expect_regex = True
             continue
-        if ch in "+-*/%=<>!~,(){}$":
+        if ch in "+-*/%=<>!~,(){}[]$":
             tokens.append((ch, ch))
             i += 1
-            expect_regex = ch not in ")}"
+            expect_regex = ch not in ")]"
             continue
         raise ValueError(f"unexpected character {ch!r} in awk program")
     tokens.append(("EOF", None))
@@ -4438,13 +6200,40 @@ class _AwkParser:
         while self.peek()[0] == "SEP":
             self.advance()
 
+    def skip_newlines(self):
+        while self.peek() == ("SEP", "\n"):
+            self.advance()
+
     def parse_program(self):
         rules = []
+        funcs = {}
         self.skip_seps()
         while self.peek()[0] != "EOF":
-            rules.append(self.parse_rule())
+            if self.peek()[0] == "function":
+                name, params, body = self.parse_function()
+                if name in funcs:
+                    raise ValueError(f"awk: function {name!r} redefined")
+                funcs[name] = (params, body)
+            else:
+                rules.append(self.parse_rule())
             self.skip_seps()
-        return ("Prog", rules)
+        return ("Prog", rules, funcs)
+
+    def parse_function(self):
+        self.expect("function")
+        name = self.expect("IDENT")[1]
+        self.expect("(")
+        params = []
+        if self.peek()[0] != ")":
+            params.append(self.expect("IDENT")[1])
+            while self.accept(","):
+                self.skip_newlines()
+                params.append(self.expect("IDENT")[1])
+        self.expect(")")
+        if len(set(params)) != len(params):
+            raise ValueError(f"awk: duplicate parameter in function {name!r}")
+        self.skip_newlines()
+        return name, params, self.parse_block()
 
     def parse_rule(self):
         pattern = None
@@ -4469,6 +6258,9 @@ class _AwkParser:
                 break
             if self.peek()[0] == "SEP":
                 self.skip_seps()
+            elif self.toks[self.i - 1][0] == "}":
+                # A statement ending in a block needs no separator.
+                continue
             elif self.peek()[0] == "EOF":
                 raise ValueError("awk: unterminated block")
             else:
@@ -4482,6 +6274,39 @@ class _AwkParser:
         t = self.peek()
         if t[0] == "if":
             return self.parse_if()
+        if t[0] == "while":
+            self.advance()
+            self.expect("(")
+            cond = self.parse_expr()
+            self.expect(")")
+            self.skip_seps()
+            return ("While", cond, self.parse_stmt())
+        if t[0] == "do":
+            self.advance()
+            self.skip_seps()
+            body = self.parse_stmt()
+            self.skip_seps()
+            self.expect("while")
+            self.expect("(")
+            cond = self.parse_expr()
+            self.expect(")")
+            return ("DoWhile", body, cond)
+        if t[0] == "for":
+            return self.parse_for()
+        if t[0] in ("break", "continue"):
+            self.advance()
+            return (t[0].capitalize(),)
+        if t[0] == "return":
+            self.advance()
+            value = None
+            if self.peek()[0] not in ("SEP", "}", "EOF"):
+                value = self.parse_expr()
+            return ("Return", value)
+        if t[0] == "delete":
+            self.advance()
+            name = self.expect("IDENT")[1]
+            subs = self.parse_subscripts() if self.peek()[0] == "[" else None
+            return ("Delete", name, subs)
         if t[0] == "print":
             self.advance()
             exprs = []
@@ -4503,6 +6328,38 @@ class _AwkParser:
             return self.parse_block()
         return ("ExprStmt", self.parse_expr())
 
+    def parse_for(self):
+        self.expect("for")
+        self.expect("(")
+        kinds = [tok[0] for tok in self.toks[self.i:self.i + 4]]
+        if kinds == ["IDENT", "in", "IDENT", ")"]:
+            var = self.advance()[1]
+            self.advance()
+            name = self.advance()[1]
+            self.advance()
+            self.skip_seps()
+            return ("ForIn", ("Var", var), name, self.parse_stmt())
+        init = cond = step = None
+        if self.peek()[0] != "SEP":
+            init = self.parse_expr()
+        self.expect("SEP")
+        if self.peek()[0] != "SEP":
+            cond = self.parse_expr()
+        self.expect("SEP")
+        if self.peek()[0] != ")":
+            step = self.parse_expr()
+        self.expect(")")
+        self.skip_seps()
+        return ("For", init, cond, step, self.parse_stmt())
+
+    def parse_subscripts(self):
+        self.expect("[")
+        subs = [self.parse_expr()]
+        while self.accept(","):
+            subs.append(self.parse_expr())
+        self.expect("]")
+        return subs
+
     def parse_if(self):
         self.expect("if")
         self.expect("(")
@@ -4536,12 +6393,14 @@ class _AwkParser:
     def parse_or(self):
         left = self.parse_and()
         while self.accept("||"):
+            self.skip_newlines()
             left = ("BinOp", "||", left, self.parse_and())
         return left
 
     def parse_and(self):
         left = self.parse_not()
         while self.accept("&&"):
+            self.skip_newlines()
             left = ("BinOp", "&&", left, self.parse_not())
         return left
 
@@ -4552,8 +6411,11 @@ class _AwkParser:
 
     def parse_match(self):
         left = self.parse_compare()
-        while self.peek()[0] in ("~", "!~"):
+        while self.peek()[0] in ("~", "!~", "in"):
             op = self.advance()[0]
+            if op == "in":
+                left = ("In", [left], self.expect("IDENT")[1])
+                continue
             if self.peek()[0] == "REGEX":
                 rhs = ("Regex", self.advance()[1])
             else:
@@ -4595,7 +6457,21 @@ class _AwkParser:
             return ("UnaryOp", "-", self.parse_unary())
         if self.accept("+"):
             return self.parse_unary()
-        return self.parse_primary()
+        if self.peek()[0] in ("++", "--"):
+            op = self.advance()[0]
+            return ("IncDec", op, self._lvalue(self.parse_unary()), True)
+        return self.parse_postfix()
+
+    def parse_postfix(self):
+        e = self.parse_primary()
+        if self.peek()[0] in ("++", "--") and e[0] in ("Var", "Field", "Index"):
+            return ("IncDec", self.advance()[0], e, False)
+        return e
+
+    def _lvalue(self, e):
+        if e[0] not in ("Var", "Field", "Index"):
+            raise ValueError("awk: invalid increment target")
+        return e
 
     def parse_primary(self):
         t = self.peek()
@@ -4616,6 +6492,14 @@ class _AwkParser:
         if k == "(":
             self.advance()
             e = self.parse_expr()
+            if self.peek()[0] == ",":
+                # (i, j) in a
+                subs = [e]
+                while self.accept(","):
+                    subs.append(self.parse_expr())
+                self.expect(")")
+                self.expect("in")
+                return ("In", subs, self.expect("IDENT")[1])
             self.expect(")")
             return e
         if k == "IDENT":
@@ -4623,35 +6507,48 @@ class _AwkParser:
             if self.accept("("):
                 args = []
                 if self.peek()[0] != ")":
-                    args.append(self.parse_expr())
+                    args.append(self.parse_arg())
                     while self.accept(","):
-                        args.append(self.parse_expr())
+                        self.skip_newlines()
+                        args.append(self.parse_arg())
                 self.expect(")")
                 return ("Call", name, args)
+            if self.peek()[0] == "[":
+                return ("Index", name, self.parse_subscripts())
             return ("Var", name)
         raise ValueError(f"awk: unexpected token in expression: {t[0]!r}")
 
+    def parse_arg(self):
+        # A bare /re/ argument stays a regex (for split, sub, gsub)
+        # rather than becoming a match against $0.
+        if self.peek()[0] == "REGEX" and self.toks[self.i + 1][0] in (",", ")"):
+            return ("Regex", self.advance()[1])
+        return self.parse_expr()
+
 
 def _awk_to_num(v):
-    if isinstance(v, bool):
-        return 1 if v else 0
-    if isinstance(v, (int, float)):
+    t = type(v)
+    if t is int or t is float:
         return v
-    if isinstance(v, str):
-        s = v.strip()
-        if not s:
-            return 0
+    if t is str:
         try:
-            f = float(s)
-            if f.is_integer() and "." not in s and "e" not in s and "E" not in s:
-                return int(f)
-            return f
+            return int(v)
+        except ValueError:
+            pass
+        try:
+            return float(v)
         except ValueError:
             return 0
+    if t is bool:
+        return 1 if v else 0
+    if t is dict:
+        raise ValueError("can't use an array in a scalar context")
     return 0
 
 
 def _awk_to_str(v):
+    if type(v) is str:
+        return v
     if isinstance(v, bool):
         return "1" if v else "0"
     if isinstance(v, int):
@@ -4660,6 +6557,8 @@ def _awk_to_str(v):
         if v.is_integer():
             return str(int(v))
         return format(v, "g")
+    if type(v) is dict:
+        raise ValueError("can't use an array in a scalar context")
     return str(v)
 
 
@@ -4668,22 +6567,52 @@ def _awk_truthy(v):
         return v != 0
     if isinstance(v, str):
         return v != ""
+    if type(v) is dict:
+        raise ValueError("can't use an array in a scalar context")
     return bool(v)
 
 
-def _awk_is_numlike(v):
+def _awk_as_number(v):
+    """Return *v* as a number if it is one or looks like one, else None."""
     if isinstance(v, (int, float)):
-        return True
+        return v
     if isinstance(v, str):
-        s = v.strip()
-        if not s:
-            return False
         try:
-            float(s)
-            return True
+            return int(v)
         except ValueError:
-            return False
-    return False
+            pass
+        try:
+            return float(v)
+        except ValueError:
+            return None
+    return None
+
+
+def _awk_div(a, b):
+    if b == 0:
+        raise ValueError("division by zero")
+    r = a / b
+    if isinstance(a, int) and isinstance(b, int) and r.is_integer():
+        return int(r)
+    return r
+
+
+def _awk_mod(a, b):
+    if b == 0:
+        raise ValueError("division by zero")
+    return a % b
+
+
+_AWK_COMPARE = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+}
+
+_AWK_ASSIGN_OPS = {
+    "+=": operator.add, "-=": operator.sub, "*=": operator.mul,
+    "/=": _awk_div, "%=": _awk_mod,
+}
 
 
 def _awk_sprintf(fmt, args):
@@ -4740,7 +6669,110 @@ class _AwkNext(Exception):
     pass
 
 
+class _AwkBreak(Exception):
+    pass
+
+
+class _AwkContinue(Exception):
+    pass
+
+
+class _AwkReturn(Exception):
+    def __init__(self, value):
+        Exception.__init__(self)
+        self.value = value
+
+
+def _awk_compare(op, a, b):
+    """Compare awk values *a* and *b* with comparison operator *op*:
+    numerically if both look like numbers, else as strings."""
+    compare = _AWK_COMPARE[op]
+    an, bn = _awk_as_number(a), _awk_as_number(b)
+    if an is not None and bn is not None:
+        return compare(an, bn)
+    return compare(_awk_to_str(a), _awk_to_str(b))
+
+
+def _awk_array_names(node, names):
+    """Collect into *names* every name that *node* uses as an array."""
+    if isinstance(node, list):
+        for x in node:
+            _awk_array_names(x, names)
+        return
+    if not isinstance(node, tuple) or not node:
+        return
+    tag = node[0]
+    if tag in ("Index", "Delete"):
+        names.add(node[1])
+    elif tag in ("In", "ForIn"):
+        names.add(node[2])
+    elif tag == "Call" and node[1] == "split" and len(node[2]) >= 2:
+        if node[2][1][0] == "Var":
+            names.add(node[2][1][1])
+    for x in node[1:]:
+        if isinstance(x, (tuple, list)):
+            _awk_array_names(x, names)
+
+
+def _awk_split(s, fs):
+    """split() semantics: " " splits on whitespace, any other single
+    character literally, and anything longer is a regular expression."""
+    if s == "":
+        return []
+    if fs is None or fs == " ":
+        return s.split()
+    if len(fs) == 1:
+        return s.split(fs)
+    return re.split(fs, s)
+
+
+def _awk_sub_template(repl):
+    """Translate an awk sub/gsub replacement into a re.sub template:
+    & is the matched text, \\& a literal ampersand."""
+    out = []
+    i = 0
+    while i < len(repl):
+        ch = repl[i]
+        if ch == "\\" and i + 1 < len(repl) and repl[i + 1] in "&\\":
+            out.append("&" if repl[i + 1] == "&" else "\\\\")
+            i += 2
+            continue
+        if ch == "&":
+            out.append("\\g<0>")
+        elif ch == "\\":
+            out.append("\\\\")
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
 class _AwkEvaluator:
+    """Runs a parsed awk program.
+
+    The tuple tree built by _AwkParser is compiled once, up front, into
+    nested closures; running a line then only calls those closures rather
+    than dispatching on node tags for every node of every line.
+
+    Records are split into fields lazily, on the first $n or NF access.
+    If the program only ever uses constant field numbers, the split also
+    stops after the highest one it references.
+
+    Arrays are plain dicts stored under their name in self.vars (or in
+    the current call frame for function parameters), so aggregations
+    like {c[$1] += $2} are a single dict update per record.
+    """
+
+    # Patterns computed at run time (e.g. $0 ~ $1) compiled and kept per
+    # match expression.
+    REGEX_CACHE_SIZE = 256
+
+    _SPECIAL_VARS = ("NR", "NF", "FS", "OFS")
+    _BUILTINS = (
+        "length", "substr", "index", "tolower", "toupper", "int",
+        "sprintf", "split", "sub", "gsub",
+    )
+
     def __init__(self, prog, fs, write_line, write_raw):
         self.prog = prog
         self.fs = fs
@@ -4748,23 +6780,85 @@ class _AwkEvaluator:
         self.write_line = write_line
         self.write_raw = write_raw
         self.vars = {}
-        self.fields = [""]
+        self.record = ""
+        self.fields = None          # [$0, $1, ...] once split, else None
+        self._record_fs = fs        # FS in effect when the record was read
         self.NR = 0
-
-    def _split_fields(self, line):
-        if line == "":
-            return []
-        if self.fs is None or self.fs == " ":
-            return line.split()
-        return line.split(self.fs)
+        # Highest constant $n in the program; None once anything needs
+        # every field (NF, $expr, assigning to a field).
+        self._max_field = 0
+        self._full_split = False
+        # Function calls: self.frame holds the parameters of the running
+        # call; _locals/_loop_depth/_in_function describe the code being
+        # compiled.
+        self.frame = {}
+        self._locals = ()
+        self._loop_depth = 0
+        self._in_function = False
+        self._func_defs = prog[2]
+        self._func_arrays = {}
+        for name, (params, body) in self._func_defs.items():
+            if name in self._BUILTINS:
+                raise ValueError(f"function name {name!r} is a builtin")
+            used = set()
+            _awk_array_names(body, used)
+            self._func_arrays[name] = used.intersection(params)
+        self.funcs = {}
+        for name, (params, body) in self._func_defs.items():
+            self._locals = frozenset(params)
+            self._in_function = True
+            self.funcs[name] = self.compile_stmt(body)
+        self._locals = ()
+        self._in_function = False
+        self.begin_actions = []
+        self.rules = []
+        self.end_actions = []
+        for _, pattern, action in prog[1]:
+            act = self.compile_stmt(action) if action is not None else None
+            if pattern == "BEGIN":
+                if act is not None:
+                    self.begin_actions.append(act)
+            elif pattern == "END":
+                if act is not None:
+                    self.end_actions.append(act)
+            else:
+                pat = self.compile_cond(pattern) if pattern is not None else None
+                self.rules.append((pat, act))
+        self.split_limit = None if self._full_split else self._max_field
 
     def set_line(self, line):
         self.NR += 1
-        self.fields = [line] + self._split_fields(line)
+        self.record = line
+        self.fields = None
+        self._record_fs = self.fs
+
+    def _split(self):
+        """Split the current record into self.fields and return it."""
+        line = self.record
+        limit = self.split_limit
+        if line == "" or limit == 0:
+            parts = []
+        else:
+            fs = self._record_fs
+            if fs is None or fs == " ":
+                fs = None
+            if limit is None:
+                parts = line.split(fs)
+            else:
+                parts = line.split(fs, limit)[:limit]
+        parts.insert(0, line)
+        self.fields = parts
+        return parts
+
+    def _all_fields(self):
+        fields = self.fields
+        if fields is None:
+            fields = self._split()
+        return fields
 
     def _get_var(self, name):
         if name == "NR":  return self.NR
-        if name == "NF":  return len(self.fields) - 1
+        if name == "NF":  return len(self._all_fields()) - 1
         if name == "FS":  return self.fs if self.fs is not None else " "
         if name == "OFS": return self.ofs
         return self.vars.get(name, "")
@@ -4783,211 +6877,961 @@ class _AwkEvaluator:
 
     def _get_field(self, idx_v):
         idx = int(_awk_to_num(idx_v))
-        if idx < 0 or idx >= len(self.fields):
+        if idx == 0:
+            return self.record
+        fields = self._all_fields()
+        if idx < 0 or idx >= len(fields):
             return ""
-        return self.fields[idx]
+        return fields[idx]
 
     def _set_field(self, idx_v, value):
         idx = int(_awk_to_num(idx_v))
         if idx < 0:
             return
-        while len(self.fields) <= idx:
-            self.fields.append("")
-        self.fields[idx] = _awk_to_str(value)
         if idx == 0:
-            self.fields[1:] = self._split_fields(self.fields[0])
+            self.record = _awk_to_str(value)
+            self.fields = None
+            self._record_fs = self.fs
+            return
+        fields = self._all_fields()
+        while len(fields) <= idx:
+            fields.append("")
+        fields[idx] = _awk_to_str(value)
+        self.record = fields[0] = self.ofs.join(fields[1:])
+
+    # ── compilation ───────────────────────────────────────────────────────
+
+    def compile_cond(self, e):
+        """Compile *e* into a closure returning its truth value as a bool."""
+        if e[0] == "MatchOp":
+            return self._compile_match(e)
+        f = self.compile_expr(e)
+        return lambda: _awk_truthy(f())
+
+    def _compile_match(self, e):
+        _, lhs, rhs, negate = e
+        if rhs[0] == "Regex":
+            search = re.compile(rhs[1]).search
         else:
-            self.fields[0] = self.ofs.join(self.fields[1:])
-
-    def eval_expr(self, e):
+            regex_f = self._compile_regex(rhs)
+
+            def search(text):
+                return regex_f().search(text)
+        if lhs == ("Field", ("Num", 0)):
+            # The common bare /re/ pattern: match the record directly.
+            if negate:
+                return lambda: search(self.record) is None
+            return lambda: search(self.record) is not None
+        text_f = self.compile_expr(lhs)
+        if negate:
+            return lambda: search(_awk_to_str(text_f())) is None
+        return lambda: search(_awk_to_str(text_f())) is not None
+
+    def _compile_regex(self, e):
+        """Compile *e* into a closure returning a compiled pattern: a
+        /re/ literal is compiled once, dynamic strings through a cache."""
+        if e[0] == "Regex":
+            rx = re.compile(e[1])
+            return lambda: rx
+        pat_f = self.compile_expr(e)
+        compile_ = functools.lru_cache(self.REGEX_CACHE_SIZE)(re.compile)
+        return lambda: compile_(_awk_to_str(pat_f()))
+
+    def _compile_array(self, name):
+        """Compile a closure returning the dict for array *name*."""
+        if name in self._SPECIAL_VARS:
+            raise ValueError(f"can't use {name} as an array")
+        local = name in self._locals
+
+        def array():
+            scope = self.frame if local else self.vars
+            a = scope.get(name)
+            if a is None:
+                a = scope[name] = {}
+            elif type(a) is not dict:
+                raise ValueError(f"can't use scalar {name!r} as an array")
+            return a
+        return array
+
+    def _compile_key(self, subs):
+        """Compile array subscripts into a closure returning the key."""
+        parts = [self.compile_expr(x) for x in subs]
+        if len(parts) == 1:
+            part = parts[0]
+
+            def key():
+                v = part()
+                return v if type(v) is str else _awk_to_str(v)
+            return key
+        return lambda: _AWK_SUBSEP.join([_awk_to_str(p()) for p in parts])
+
+    def _compile_lvalue(self, target):
+        """Compile an assignable node into (ref, get, put): ref() locates
+        the target once, get(loc) reads it and put(loc, value) writes it."""
+        k = target[0]
+        if k == "Var":
+            name = target[1]
+            if name in self._SPECIAL_VARS:
+                return (lambda: name), self._get_var, self._set_var
+            if name in self._locals:
+                return ((lambda: self.frame),
+                        lambda loc: loc.get(name, ""),
+                        lambda loc, v: loc.__setitem__(name, v))
+            vars_ = self.vars
+            return ((lambda: name),
+                    lambda loc: vars_.get(loc, ""),
+                    vars_.__setitem__)
+        if k == "Field":
+            if target[1] != ("Num", 0):
+                self._full_split = True
+            return self.compile_expr(target[1]), self._get_field, self._set_field
+        if k == "Index":
+            array = self._compile_array(target[1])
+            key = self._compile_key(target[2])
+            return ((lambda: (array(), key())),
+                    lambda loc: loc[0].get(loc[1], ""),
+                    lambda loc, v: loc[0].__setitem__(loc[1], v))
+        raise ValueError("invalid assignment target")
+
+    def compile_expr(self, e):
+        """Compile expression node *e* into a zero-argument closure."""
         k = e[0]
-        if k == "Num":   return e[1]
-        if k == "Str":   return e[1]
-        if k == "Var":   return self._get_var(e[1])
-        if k == "Field": return self._get_field(self.eval_expr(e[1]))
+        if k in ("Num", "Str"):
+            value = e[1]
+            return lambda: value
+        if k == "Var":
+            name = e[1]
+            if name in self._locals:
+                return lambda: self.frame.get(name, "")
+            if name in self._SPECIAL_VARS:
+                if name == "NF":
+                    self._full_split = True
+                return lambda: self._get_var(name)
+            vars_ = self.vars
+            return lambda: vars_.get(name, "")
+        if k == "Field":
+            if e[1][0] == "Num":
+                i = int(_awk_to_num(e[1][1]))
+                if i < 0:
+                    return lambda: ""
+                if i == 0:
+                    return lambda: self.record
+                self._max_field = max(self._max_field, i)
+
+                def field():
+                    fields = self.fields
+                    if fields is None:
+                        fields = self._split()
+                    return fields[i] if i < len(fields) else ""
+                return field
+            self._full_split = True
+            idx_f = self.compile_expr(e[1])
+            return lambda: self._get_field(idx_f())
         if k == "UnaryOp":
-            v = self.eval_expr(e[2])
-            if e[1] == "-": return -_awk_to_num(v)
-            if e[1] == "!": return 0 if _awk_truthy(v) else 1
+            f = self.compile_expr(e[2])
+            if e[1] == "-":
+                return lambda: -_awk_to_num(f())
+            return lambda: 0 if _awk_truthy(f()) else 1
         if k == "BinOp":
-            op = e[1]
-            if op == "&&":
-                return 1 if (_awk_truthy(self.eval_expr(e[2]))
-                             and _awk_truthy(self.eval_expr(e[3]))) else 0
-            if op == "||":
-                return 1 if (_awk_truthy(self.eval_expr(e[2]))
-                             or _awk_truthy(self.eval_expr(e[3]))) else 0
-            a = self.eval_expr(e[2])
-            b = self.eval_expr(e[3])
-            if op == "concat":
-                return _awk_to_str(a) + _awk_to_str(b)
-            if op in ("+", "-", "*", "/", "%"):
-                an, bn = _awk_to_num(a), _awk_to_num(b)
-                if op == "+": return an + bn
-                if op == "-": return an - bn
-                if op == "*": return an * bn
-                if op == "/":
-                    if bn == 0:
-                        raise ValueError("division by zero")
-                    r = an / bn
-                    return int(r) if isinstance(an, int) and isinstance(bn, int) and r.is_integer() else r
-                if op == "%":
-                    if bn == 0:
-                        raise ValueError("division by zero")
-                    return an % bn
-            if _awk_is_numlike(a) and _awk_is_numlike(b):
-                av, bv = _awk_to_num(a), _awk_to_num(b)
-            else:
-                av, bv = _awk_to_str(a), _awk_to_str(b)
-            if op == "==": return 1 if av == bv else 0
-            if op == "!=": return 1 if av != bv else 0
-            if op == "<":  return 1 if av <  bv else 0
-            if op == "<=": return 1 if av <= bv else 0
-            if op == ">":  return 1 if av >  bv else 0
-            if op == ">=": return 1 if av >= bv else 0
+            return self._compile_binop(e[1], e[2], e[3])
         if k == "MatchOp":
-            _, lhs, rhs, negate = e
-            text = _awk_to_str(self.eval_expr(lhs))
-            if rhs[0] == "Regex":
-                pat = rhs[1]
-            else:
-                pat = _awk_to_str(self.eval_expr(rhs))
-            m = re.search(pat, text)
-            return (0 if m else 1) if negate else (1 if m else 0)
+            cond = self._compile_match(e)
+            return lambda: 1 if cond() else 0
         if k == "Regex":
-            m = re.search(e[1], self.fields[0])
-            return 1 if m else 0
+            return self._compile_match(("MatchOp", ("Field", ("Num", 0)), e, False))
         if k == "Assign":
-            _, op, target, valexpr = e
-            new = self.eval_expr(valexpr)
-            if op != "=":
-                old = self.eval_expr(target)
-                on, nn = _awk_to_num(old), _awk_to_num(new)
-                if   op == "+=": new = on + nn
-                elif op == "-=": new = on - nn
-                elif op == "*=": new = on * nn
-                elif op == "/=":
-                    if nn == 0:
-                        raise ValueError("division by zero")
-                    new = on / nn
-                elif op == "%=":
-                    if nn == 0:
-                        raise ValueError("division by zero")
-                    new = on % nn
-            if target[0] == "Var":
-                self._set_var(target[1], new)
-            elif target[0] == "Field":
-                self._set_field(self.eval_expr(target[1]), new)
-            else:
-                raise ValueError("invalid assignment target")
-            return new
+            return self._compile_assign(e[1], e[2], e[3])
+        if k == "IncDec":
+            return self._compile_incdec(e[1], e[2], e[3])
+        if k == "Index":
+            array = self._compile_array(e[1])
+            key = self._compile_key(e[2])
+            # Referencing an element creates it, as in POSIX awk.
+            return lambda: array().setdefault(key(), "")
+        if k == "In":
+            array = self._compile_array(e[2])
+            key = self._compile_key(e[1])
+            return lambda: 1 if key() in array() else 0
         if k == "Call":
-            return self._call(e[1], [self.eval_expr(a) for a in e[2]])
+            if e[1] in self._func_defs and e[1] not in self._BUILTINS:
+                return self._compile_user_call(e[1], e[2])
+            return self._compile_call(e[1], e[2])
         raise ValueError(f"unknown expr {k!r}")
 
-    def _call(self, name, args):
+    def _compile_binop(self, op, lhs, rhs):
+        a = self.compile_expr(lhs)
+        b = self.compile_expr(rhs)
+        num = _awk_to_num
+        if op == "&&":
+            return lambda: 1 if _awk_truthy(a()) and _awk_truthy(b()) else 0
+        if op == "||":
+            return lambda: 1 if _awk_truthy(a()) or _awk_truthy(b()) else 0
+        if op == "concat":
+            return lambda: _awk_to_str(a()) + _awk_to_str(b())
+        if op == "+":
+            return lambda: num(a()) + num(b())
+        if op == "-":
+            return lambda: num(a()) - num(b())
+        if op == "*":
+            return lambda: num(a()) * num(b())
+        if op == "/":
+            return lambda: _awk_div(num(a()), num(b()))
+        if op == "%":
+            return lambda: _awk_mod(num(a()), num(b()))
+        compare = _AWK_COMPARE[op]
+
+        def cmp():
+            av, bv = a(), b()
+            an, bn = _awk_as_number(av), _awk_as_number(bv)
+            if an is not None and bn is not None:
+                return 1 if compare(an, bn) else 0
+            return 1 if compare(_awk_to_str(av), _awk_to_str(bv)) else 0
+        return cmp
+
+    def _compile_assign(self, op, target, valexpr):
+        val = self.compile_expr(valexpr)
+        if op == "=":
+            combine = None
+        else:
+            combine = _AWK_ASSIGN_OPS[op]
+        if target[0] == "Index" and combine is not None:
+            # The hot path of hash aggregations such as c[$1] += $2.
+            array = self._compile_array(target[1])
+            key = self._compile_key(target[2])
+
+            def assign_index():
+                a = array()
+                k = key()
+                new = a[k] = combine(
+                    _awk_to_num(a.get(k, "")), _awk_to_num(val())
+                )
+                return new
+            return assign_index
+        if (target[0] == "Var" and target[1] not in self._SPECIAL_VARS
+                and target[1] not in self._locals):
+            name = target[1]
+            vars_ = self.vars
+            if combine is None:
+                def assign():
+                    new = vars_[name] = val()
+                    return new
+            else:
+                def assign():
+                    new = combine(
+                        _awk_to_num(vars_.get(name, "")), _awk_to_num(val())
+                    )
+                    vars_[name] = new
+                    return new
+            return assign
+        ref, get, put = self._compile_lvalue(target)
+
+        def assign():
+            loc = ref()
+            new = val()
+            if combine is not None:
+                new = combine(_awk_to_num(get(loc)), _awk_to_num(new))
+            put(loc, new)
+            return new
+        return assign
+
+    def _compile_incdec(self, op, target, prefix):
+        delta = 1 if op == "++" else -1
+        if target[0] == "Index":
+            array = self._compile_array(target[1])
+            key = self._compile_key(target[2])
+
+            def incdec_index():
+                a = array()
+                k = key()
+                old = _awk_to_num(a.get(k, ""))
+                new = a[k] = old + delta
+                return new if prefix else old
+            return incdec_index
+        ref, get, put = self._compile_lvalue(target)
+
+        def incdec():
+            loc = ref()
+            old = _awk_to_num(get(loc))
+            put(loc, old + delta)
+            return old + delta if prefix else old
+        return incdec
+
+    def _compile_user_call(self, name, arg_nodes):
+        params = self._func_defs[name][0]
+        if len(arg_nodes) > len(params):
+            raise ValueError(f"function {name!r} called with too many arguments")
+        arrays = self._func_arrays[name]
+        bindings = []
+        for param, node in zip(params, arg_nodes):
+            if param in arrays and node[0] == "Var":
+                # Arrays are passed by reference, creating them if needed.
+                bindings.append((param, self._compile_array(node[1])))
+            else:
+                bindings.append((param, self.compile_expr(node)))
+        funcs = self.funcs
+
+        def call():
+            frame = {param: f() for param, f in bindings}
+            saved = self.frame
+            self.frame = frame
+            try:
+                funcs[name]()
+            except _AwkReturn as r:
+                return r.value
+            finally:
+                self.frame = saved
+            return ""
+        return call
+
+    def _compile_call(self, name, arg_nodes):
+        if name == "split":
+            return self._compile_split(arg_nodes)
+        if name in ("sub", "gsub"):
+            return self._compile_sub(arg_nodes, 0 if name == "gsub" else 1)
+        args = [self.compile_expr(a) for a in arg_nodes]
         if name == "length":
-            v = args[0] if args else self.fields[0]
-            return len(_awk_to_str(v))
+            if not args:
+                return lambda: len(self.record)
+            a = args[0]
+
+            def length():
+                v = a()
+                return len(v) if type(v) is dict else len(_awk_to_str(v))
+            return length
         if name == "substr":
-            s = _awk_to_str(args[0])
-            start = int(_awk_to_num(args[1]))
-            if len(args) >= 3:
-                length = int(_awk_to_num(args[2]))
-                lo = max(start, 1) - 1
-                hi = start - 1 + length
-                return s[lo:hi]
-            return s[max(start - 1, 0):]
+            def substr():
+                s = _awk_to_str(args[0]())
+                start = int(_awk_to_num(args[1]()))
+                if len(args) >= 3:
+                    length = int(_awk_to_num(args[2]()))
+                    lo = max(start, 1) - 1
+                    hi = start - 1 + length
+                    return s[lo:hi]
+                return s[max(start - 1, 0):]
+            return substr
         if name == "index":
-            s = _awk_to_str(args[0])
-            t = _awk_to_str(args[1])
-            if not t:
-                return 0
-            p = s.find(t)
-            return p + 1 if p >= 0 else 0
-        if name == "tolower": return _awk_to_str(args[0]).lower()
-        if name == "toupper": return _awk_to_str(args[0]).upper()
-        if name == "int":     return int(_awk_to_num(args[0]))
+            def index():
+                s = _awk_to_str(args[0]())
+                t = _awk_to_str(args[1]())
+                if not t:
+                    return 0
+                return s.find(t) + 1
+            return index
+        if name == "tolower":
+            return lambda: _awk_to_str(args[0]()).lower()
+        if name == "toupper":
+            return lambda: _awk_to_str(args[0]()).upper()
+        if name == "int":
+            return lambda: int(_awk_to_num(args[0]()))
         if name == "sprintf":
-            return _awk_sprintf(_awk_to_str(args[0]), args[1:])
-        raise ValueError(f"unknown function {name!r}")
+            return lambda: _awk_sprintf(
+                _awk_to_str(args[0]()), [a() for a in args[1:]]
+            )
 
-    def exec_stmt(self, s):
+        def unknown():
+            raise ValueError(f"unknown function {name!r}")
+        return unknown
+
+    def _compile_split(self, arg_nodes):
+        if len(arg_nodes) not in (2, 3) or arg_nodes[1][0] != "Var":
+            raise ValueError("usage: split(string, array [, fs])")
+        text = self.compile_expr(arg_nodes[0])
+        array = self._compile_array(arg_nodes[1][1])
+        if len(arg_nodes) == 3 and arg_nodes[2][0] == "Regex":
+            regex = re.compile(arg_nodes[2][1])
+            split_f = lambda s: regex.split(s) if s else []
+        elif len(arg_nodes) == 3:
+            fs_f = self.compile_expr(arg_nodes[2])
+            split_f = lambda s: _awk_split(s, _awk_to_str(fs_f()))
+        else:
+            split_f = lambda s: _awk_split(s, self.fs)
+
+        def split():
+            parts = split_f(_awk_to_str(text()))
+            a = array()
+            a.clear()
+            a.update(zip(map(str, range(1, len(parts) + 1)), parts))
+            return len(parts)
+        return split
+
+    def _compile_sub(self, arg_nodes, count):
+        if len(arg_nodes) not in (2, 3):
+            raise ValueError("usage: sub(regex, replacement [, target])")
+        regex = self._compile_regex(arg_nodes[0])
+        repl_f = self.compile_expr(arg_nodes[1])
+        target = arg_nodes[2] if len(arg_nodes) == 3 else ("Field", ("Num", 0))
+        ref, get, put = self._compile_lvalue(target)
+        templates = {}
+
+        def sub():
+            repl = _awk_to_str(repl_f())
+            template = templates.get(repl)
+            if template is None:
+                template = templates[repl] = _awk_sub_template(repl)
+            loc = ref()
+            new, n = regex().subn(template, _awk_to_str(get(loc)), count)
+            if n:
+                put(loc, new)
+            return n
+        return sub
+
+    def compile_stmt(self, s):
+        """Compile statement node *s* into a zero-argument closure."""
         k = s[0]
         if k == "Print":
+            write_line = self.write_line
             if not s[1]:
-                self.write_line(self.fields[0])
-            else:
-                parts = [_awk_to_str(self.eval_expr(e)) for e in s[1]]
-                self.write_line(self.ofs.join(parts))
-            return
+                return lambda: write_line(self.record)
+            parts = [self.compile_expr(e) for e in s[1]]
+            if len(parts) == 1:
+                part = parts[0]
+                return lambda: write_line(_awk_to_str(part()))
+            return lambda: write_line(
+                self.ofs.join([_awk_to_str(p()) for p in parts])
+            )
         if k == "Printf":
-            vals = [self.eval_expr(e) for e in s[1]]
-            self.write_raw(_awk_sprintf(_awk_to_str(vals[0]), vals[1:]))
-            return
+            parts = [self.compile_expr(e) for e in s[1]]
+            fmt, rest = parts[0], parts[1:]
+            return lambda: self.write_raw(
+                _awk_sprintf(_awk_to_str(fmt()), [p() for p in rest])
+            )
         if k == "Next":
-            raise _AwkNext()
+            def next_():
+                raise _AwkNext()
+            return next_
         if k == "Block":
-            for st in s[1]:
-                self.exec_stmt(st)
-            return
+            stmts = [self.compile_stmt(st) for st in s[1]]
+            if len(stmts) == 1:
+                return stmts[0]
+
+            def block():
+                for st in stmts:
+                    st()
+            return block
         if k == "If":
             _, cond, then_s, else_s = s
-            if _awk_truthy(self.eval_expr(cond)):
-                self.exec_stmt(then_s)
-            elif else_s is not None:
-                self.exec_stmt(else_s)
-            return
+            test = self.compile_cond(cond)
+            then_f = self.compile_stmt(then_s)
+            if else_s is None:
+                def if_():
+                    if test():
+                        then_f()
+                return if_
+            else_f = self.compile_stmt(else_s)
+
+            def if_else():
+                if test():
+                    then_f()
+                else:
+                    else_f()
+            return if_else
+        if k in ("While", "DoWhile", "For", "ForIn"):
+            return self._compile_loop(s)
+        if k in ("Break", "Continue"):
+            if not self._loop_depth:
+                raise ValueError(f"{k.lower()} outside a loop")
+            exc = _AwkBreak if k == "Break" else _AwkContinue
+
+            def jump():
+                raise exc()
+            return jump
+        if k == "Return":
+            if not self._in_function:
+                raise ValueError("return outside a function")
+            value_f = self.compile_expr(s[1]) if s[1] is not None else None
+
+            def return_():
+                raise _AwkReturn(value_f() if value_f is not None else "")
+            return return_
+        if k == "Delete":
+            array = self._compile_array(s[1])
+            if s[2] is None:
+                return lambda: array().clear()
+            key = self._compile_key(s[2])
+            return lambda: array().pop(key(), None)
         if k == "ExprStmt":
-            self.eval_expr(s[1])
-            return
+            return self.compile_expr(s[1])
         raise ValueError(f"unknown stmt {k!r}")
 
-    def _run_pattern_rules(self):
-        return [r for r in self.prog[1] if r[1] not in ("BEGIN", "END")]
+    def _compile_loop(self, s):
+        k = s[0]
+        self._loop_depth += 1
+        try:
+            body = self.compile_stmt(s[-1] if k != "DoWhile" else s[1])
+        finally:
+            self._loop_depth -= 1
+        if k == "ForIn":
+            ref, _, put = self._compile_lvalue(s[1])
+            array = self._compile_array(s[2])
+
+            def for_in():
+                for key in list(array()):
+                    put(ref(), key)
+                    try:
+                        body()
+                    except _AwkBreak:
+                        break
+                    except _AwkContinue:
+                        pass
+            return for_in
+        if k == "For":
+            init = self.compile_expr(s[1]) if s[1] is not None else None
+            test = self.compile_cond(s[2]) if s[2] is not None else (lambda: True)
+            step = self.compile_expr(s[3]) if s[3] is not None else None
+
+            def for_():
+                if init is not None:
+                    init()
+                while test():
+                    try:
+                        body()
+                    except _AwkBreak:
+                        break
+                    except _AwkContinue:
+                        pass
+                    if step is not None:
+                        step()
+            return for_
+        test = self.compile_cond(s[1] if k == "While" else s[2])
+        first = k == "DoWhile"
+
+        def while_():
+            run = first
+            while run or test():
+                run = False
+                try:
+                    body()
+                except _AwkBreak:
+                    break
+                except _AwkContinue:
+                    pass
+        return while_
+
+    # ── running ───────────────────────────────────────────────────────────
 
     def run_begin(self):
-        for r in self.prog[1]:
-            if r[1] == "BEGIN" and r[2] is not None:
-                self.exec_stmt(r[2])
+        for action in self.begin_actions:
+            action()
 
     def run_end(self):
-        for r in self.prog[1]:
-            if r[1] == "END" and r[2] is not None:
-                self.exec_stmt(r[2])
+        for action in self.end_actions:
+            action()
 
     def run_line(self, line):
         self.set_line(line)
         try:
-            for rule in self._run_pattern_rules():
-                pat = rule[1]
-                matched = True if pat is None else _awk_truthy(self.eval_expr(pat))
-                if matched:
-                    if rule[2] is None:
-                        self.write_line(self.fields[0])
+            for pat, action in self.rules:
+                if pat is None or pat():
+                    if action is None:
+                        self.write_line(self.record)
                     else:
-                        self.exec_stmt(rule[2])
+                        action()
         except _AwkNext:
             pass
 
 
+class _AwkParallelPlan:
+    """Decides whether an awk program can run over chunks of its input in
+    separate processes, and which variables to merge afterwards.
+
+    The rules (everything but BEGIN and END) may carry no state from one
+    record to the next except accumulators: variables or arrays that are
+    only changed by +=, -=, ++ or -- statements and never read by the
+    rules otherwise, or running minimums and maximums kept by
+    ``if (E > x) x = E`` or a rule ``E > x { x = E }`` (with any of <,
+    <=, > and >=, either way round; there is no ?: in this awk).
+    ``accumulators`` maps their names to "+" for sums, for which workers
+    start empty and the parent adds up the results, or to the comparison
+    that makes a value replace the current one, for which workers start
+    from the value BEGIN left and the parent keeps the extreme of the
+    results.  Anything else the rules assign is a per-record scratch
+    value that must be set before it is read, and END may not use it.
+    Raises ValueError naming the first problem found.
+    """
+
+    # Comparisons with their operands swapped.
+    _FLIPPED = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+    def __init__(self, prog):
+        self.funcs = prog[2]
+        self.accumulators = {}
+        self.written = set()
+        self.stale = set()          # read before this record set them
+        self.defined = set()
+        self.locals = frozenset()
+        self.visited = set()
+        end_names = set()
+        for _, pattern, action in prog[1]:
+            if pattern == "BEGIN":
+                continue
+            if pattern == "END":
+                if action is not None:
+                    self._end_names(action, end_names)
+                continue
+            self.defined = set()
+            if pattern is not None and action is not None:
+                if self.extreme(pattern, action, False):
+                    continue
+            if pattern is not None:
+                self.expr(pattern, False)
+            if action is not None:
+                self.stmt(action, False)
+        for name in sorted(self.accumulators.keys() & self.written):
+            raise ValueError(f"{name!r} is both accumulated and assigned")
+        for name in sorted(self.accumulators.keys() & self.stale):
+            raise ValueError(f"the rules read the running total {name!r}")
+        for name in sorted(self.written & self.stale):
+            raise ValueError(f"{name!r} carries state from one record to the next")
+        for name in sorted(self.written & end_names):
+            raise ValueError(f"END uses {name!r}, which is set per record")
+        if "$" in end_names or "NF" in end_names:
+            raise ValueError("END uses the last record")
+
+    def _end_names(self, node, names):
+        if isinstance(node, list):
+            for x in node:
+                self._end_names(x, names)
+            return
+        if not isinstance(node, tuple) or not node:
+            return
+        tag = node[0]
+        if tag == "Var":
+            names.add(node[1])
+        elif tag == "Field":
+            names.add("$")
+        elif tag in ("Index", "Delete"):
+            names.add(node[1])
+        elif tag in ("In", "ForIn"):
+            names.add(node[2])
+        elif tag == "Call" and node[1] in self.funcs and node[1] not in self.visited:
+            self.visited.add(node[1])
+            self._end_names(self.funcs[node[1]][1], names)
+        for x in node[1:]:
+            if isinstance(x, (tuple, list)):
+                self._end_names(x, names)
+
+    def read(self, name):
+        if name in self.locals:
+            return
+        if name == "NR":
+            raise ValueError("the rules use NR")
+        if name not in self.defined:
+            self.stale.add(name)
+
+    def write(self, name, define):
+        if name in self.locals:
+            return
+        if name in ("NR", "FS", "OFS"):
+            raise ValueError(f"the rules assign {name}")
+        self.written.add(name)
+        if define:
+            self.defined.add(name)
+
+    def accumulate(self, target, op):
+        name = target[1]
+        if name in _AwkEvaluator._SPECIAL_VARS:
+            raise ValueError(f"the rules assign {name}")
+        if self.accumulators.setdefault(name, op) != op:
+            raise ValueError(f"{name!r} is accumulated in different ways")
+
+    def extreme(self, test, action, cond):
+        """Take ``if (test) action`` as a running minimum or maximum if it
+        is one (see the class docstring); return whether it was."""
+        if action[0] == "Block" and len(action[1]) == 1:
+            action = action[1][0]
+        if test[0] != "BinOp" or test[1] not in self._FLIPPED:
+            return False
+        if action[0] != "ExprStmt" or action[1][0] != "Assign":
+            return False
+        _, op, target, value = action[1]
+        if op != "=" or target[0] not in ("Var", "Index"):
+            return False
+        if target[1] in self.locals:
+            return False
+        _, compare, lhs, rhs = test
+        if rhs == target and lhs == value:
+            op = compare                    # value > x: replace
+        elif lhs == target and rhs == value:
+            op = self._FLIPPED[compare]     # x < value: replace
+        else:
+            return False
+        if self._mentions(value, target[1]):
+            return False
+        self.expr(value, cond)
+        if target[0] == "Index":
+            for x in target[2]:
+                self.expr(x, cond)
+        self.accumulate(target, op)
+        return True
+
+    def _mentions(self, node, name):
+        """Whether expression *node* may use the variable *name*."""
+        if isinstance(node, list):
+            return any(self._mentions(x, name) for x in node)
+        if not isinstance(node, tuple) or not node:
+            return False
+        tag = node[0]
+        if tag in ("Var", "Index") and node[1] == name:
+            return True
+        if tag == "In" and node[2] == name:
+            return True
+        if tag == "Call" and node[1] in self.funcs:
+            return True
+        return any(self._mentions(x, name) for x in node[1:])
+
+    def target(self, e, cond, define):
+        """Walk an assignment target; *define* if it is fully replaced."""
+        if e[0] == "Field":
+            self.expr(e[1], cond)
+        elif e[0] == "Index":
+            for x in e[2]:
+                self.expr(x, cond)
+            self.write(e[1], False)
+        else:
+            self.write(e[1], define and not cond)
+
+    def stmt(self, s, cond):
+        k = s[0]
+        if k == "Block":
+            for st in s[1]:
+                self.stmt(st, cond)
+        elif k == "ExprStmt":
+            e = s[1]
+            if ((e[0] == "Assign" and e[1] in ("+=", "-=") or e[0] == "IncDec")
+                    and e[2][0] in ("Var", "Index")
+                    and e[2][1] not in self.locals):
+                target = e[2]
+                if e[0] == "Assign":
+                    self.expr(e[3], cond)
+                if target[0] == "Index":
+                    for x in target[2]:
+                        self.expr(x, cond)
+                self.accumulate(target, "+")
+            else:
+                self.expr(e, cond)
+        elif k in ("Print", "Printf"):
+            for e in s[1]:
+                self.expr(e, cond)
+        elif k == "If":
+            if s[3] is None and self.extreme(s[1], s[2], cond):
+                return
+            self.expr(s[1], cond)
+            self.stmt(s[2], True)
+            if s[3] is not None:
+                self.stmt(s[3], True)
+        elif k == "While":
+            self.expr(s[1], cond)
+            self.stmt(s[2], True)
+        elif k == "DoWhile":
+            self.stmt(s[1], True)
+            self.expr(s[2], True)
+        elif k == "For":
+            if s[1] is not None:
+                self.expr(s[1], cond)
+            for e in s[2:4]:
+                if e is not None:
+                    self.expr(e, True)
+            self.stmt(s[4], True)
+        elif k == "ForIn":
+            self.read(s[2])
+            self.target(s[1], cond, True)
+            self.stmt(s[3], True)
+        elif k == "Delete":
+            for x in s[2] or ():
+                self.expr(x, cond)
+            self.write(s[1], False)
+        elif k == "Return":
+            if s[1] is not None:
+                self.expr(s[1], cond)
+
+    def expr(self, e, cond):
+        k = e[0]
+        if k == "Var":
+            self.read(e[1])
+        elif k == "Field":
+            self.expr(e[1], cond)
+        elif k == "UnaryOp":
+            self.expr(e[2], cond)
+        elif k == "BinOp":
+            self.expr(e[2], cond)
+            self.expr(e[3], cond or e[1] in ("&&", "||"))
+        elif k == "MatchOp":
+            self.expr(e[1], cond)
+            self.expr(e[2], cond)
+        elif k == "Assign":
+            self.expr(e[3], cond)
+            if e[1] != "=" and e[2][0] in ("Var", "Index"):
+                self.read(e[2][1])
+            self.target(e[2], cond, e[1] == "=")
+        elif k == "IncDec":
+            # Used as a value (a statement on its own is an accumulator),
+            # so the old value is read, also of an array element.
+            if e[2][0] in ("Var", "Index"):
+                self.read(e[2][1])
+            self.target(e[2], cond, False)
+        elif k in ("Index", "In"):
+            subs, name = (e[2], e[1]) if k == "Index" else (e[1], e[2])
+            for x in subs:
+                self.expr(x, cond)
+            self.read(name)
+        elif k == "Call":
+            self.call(e[1], e[2], cond)
+
+    def call(self, name, args, cond):
+        if name == "split" and len(args) >= 2 and args[1][0] == "Var":
+            self.expr(args[0], cond)
+            for x in args[2:]:
+                self.expr(x, cond)
+            self.write(args[1][1], not cond)
+            return
+        if name in ("sub", "gsub") and len(args) == 3:
+            for x in args[:2]:
+                self.expr(x, cond)
+            if args[2][0] == "Var":
+                self.read(args[2][1])
+            self.target(args[2], cond, False)
+            return
+        for x in args:
+            self.expr(x, cond)
+        if name in self.funcs and name not in _AwkEvaluator._BUILTINS:
+            params, body = self.funcs[name]
+            arrays = set()
+            _awk_array_names(body, arrays)
+            for param, arg in zip(params, args):
+                # An array argument may be modified by the function.
+                if param in arrays and arg[0] == "Var":
+                    self.write(arg[1], False)
+            if name not in self.visited:
+                self.visited.add(name)
+                saved = self.locals, self.defined
+                self.locals = frozenset(params)
+                self.defined = set()
+                self.stmt(body, True)
+                self.locals, self.defined = saved
+
+
+def _awk_ranges(path, parts):
+    """Split file *path* into about *parts* (start, end) byte ranges, each
+    ending just after a newline (or at the end of the file)."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, parts):
+            pos = size * i // parts
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+
+def _awk_run_range(program, state, accumulators, path, start, end):
+    """Run the rules of *program* over bytes start..end of *path*.
+
+    *state* is (FS, OFS, variables) as left by BEGIN, minus the sums
+    among the *accumulators*, which start empty.  Returns the output text,
+    the accumulator values and the number of records read.
+    """
+    chunks = []
+    write = chunks.append
+    ev = _AwkEvaluator(
+        _AwkParser(_awk_lex(program)).parse_program(), None,
+        lambda line: write(line + "\n"), write,
+    )
+    ev.fs, ev.ofs, variables = state
+    ev.vars.update(variables)
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(CmdAwk.READ_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            if remaining > 0 and not block.endswith(b"\n"):
+                tail = f.readline()
+                block += tail
+                remaining -= len(tail)
+            lines = block.decode("utf8", errors="replace").split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            for line in lines:
+                ev.run_line(line.rstrip("\r"))
+    sums = {name: ev.vars[name] for name in accumulators if name in ev.vars}
+    return "".join(chunks), sums, ev.NR
+
+
+def _awk_merge_sums(variables, sums, accumulators):
+    """Merge accumulator values from a worker into *variables*: add up
+    sums, and keep the value that wins the comparison for minimums and
+    maximums (see _AwkParallelPlan)."""
+    for name, value in sums.items():
+        op = accumulators[name]
+        if type(value) is dict:
+            target = variables.get(name)
+            if type(target) is not dict:
+                target = variables[name] = {}
+            items = value.items()
+        else:
+            target = variables
+            items = ((name, value),)
+        for key, v in items:
+            if op == "+":
+                target[key] = _awk_to_num(target.get(key, "")) + _awk_to_num(v)
+            elif key not in target or _awk_compare(op, v, target[key]):
+                target[key] = v
+
+
 class CmdAwk(Cmd):
+    # With -j, files are split into ranges of at most this many bytes (and
+    # at least one per worker); up to two ranges per worker are in flight,
+    # and a range's output is held in memory until it is written.
+    RANGE_SIZE = 64 * 1024**2
+    # Bytes a worker reads and decodes at a time.
+    READ_BLOCK = 1024**2
+
     def __init__(self):
         Cmd.__init__(self, "awk")
 
     def help(self):
         return (
-            "[-F<sep>] '<program>' [<file>...]"
+            "[-F<sep>] [-j <n>] '<program>' [<file>...]"
             "   : pattern-action text processor (subset)"
         )
 
     def execute(self, shell, args):
         fs = None
         program = None
+        jobs = 1
         filenames = []
         idx = 0
         while idx < len(args):
             a = args[idx]
+            if a == "-j" or (a.startswith("-j") and a[2:].isdigit()):
+                if a == "-j":
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: awk: -j requires an argument")
+                        return
+                    value = args[idx + 1]
+                    idx += 2
+                else:
+                    value = a[2:]
+                    idx += 1
+                try:
+                    jobs = int(value)
+                except ValueError:
+                    shell.oute.print(
+                        f"ERR: awk: invalid number of workers {value!r}"
+                    )
+                    return
+                if jobs < 1:
+                    shell.oute.print("ERR: awk: -j must be >= 1")
+                    return
+                continue
             if a == "-F":
                 if idx + 1 >= len(args):
                     shell.oute.print("ERR: awk: -F requires an argument")
@@ -5010,14 +7854,29 @@ class CmdAwk(Cmd):
         try:
             tokens = _awk_lex(program)
             ast = _AwkParser(tokens).parse_program()
-        except ValueError as e:
+            ev = _AwkEvaluator(ast, fs, shell.outs.print, shell.outs.write)
+        except (ValueError, re.error) as e:
             shell.oute.print(f"ERR: awk: {e}")
             return
+        except RecursionError:
+            shell.oute.print("ERR: awk: program nesting too deep")
+            return
+        if jobs > 1:
+            if not filenames:
+                shell.oute.print("ERR: awk: -j needs file arguments")
+                return
+            try:
+                plan = _AwkParallelPlan(ast)
+            except ValueError as e:
+                shell.oute.print(f"ERR: awk: -j: can't run in parallel: {e}")
+                return
 
-        ev = _AwkEvaluator(ast, fs, shell.outs.print, shell.outs.write)
         try:
             ev.run_begin()
-            if filenames:
+            if jobs > 1:
+                self._run_parallel(shell, ev, program, filenames, jobs,
+                                   plan.accumulators)
+            elif filenames:
                 for fn in filenames:
                     if not os.path.isabs(fn):
                         fn = shell.canon(os.path.join(shell.cwd, fn))
@@ -5033,8 +7892,65 @@ class CmdAwk(Cmd):
                     line = line.rstrip("\n").rstrip("\r")
                     ev.run_line(line)
             ev.run_end()
-        except ValueError as e:
+        except (ValueError, re.error) as e:
             shell.oute.print(f"ERR: awk: {e}")
+        except RecursionError:
+            shell.oute.print("ERR: awk: function call nesting too deep")
+
+    def _run_parallel(self, shell, ev, program, filenames, jobs, accumulators):
+        """Run the rules over newline-aligned ranges of each file in worker
+        processes, writing each range's output in order and merging the
+        accumulators and NR into *ev* for END."""
+        with contextlib.ExitStack() as stack:
+            try:
+                pool = stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(jobs)
+                )
+            except OSError:
+                pool = None
+            for fn in filenames:
+                if not os.path.isabs(fn):
+                    fn = shell.canon(os.path.join(shell.cwd, fn))
+                if not os.path.isfile(fn):
+                    shell.oute.print(f"ERR: {fn} not found")
+                    continue
+                state = (ev.fs, ev.ofs, {
+                    k: v for k, v in ev.vars.items()
+                    if accumulators.get(k) != "+"
+                })
+                parts = max(jobs, -(-os.path.getsize(fn) // self.RANGE_SIZE))
+                tasks = iter([
+                    (program, state, accumulators, fn, lo, hi)
+                    for lo, hi in _awk_ranges(fn, parts)
+                ])
+                # Only a window of ranges is in flight, so that no more
+                # than that many ranges' output waits to be written.
+                window = collections.deque()
+                while True:
+                    for task in itertools.islice(tasks, 2 * jobs - len(window)):
+                        future = None
+                        if pool is not None:
+                            try:
+                                future = pool.submit(_awk_run_range, *task)
+                            except (OSError, concurrent.futures.BrokenExecutor):
+                                pool = None
+                        window.append((task, future))
+                    if not window:
+                        break
+                    task, future = window.popleft()
+                    result = None
+                    if future is not None:
+                        try:
+                            result = future.result()
+                        except (OSError, concurrent.futures.BrokenExecutor):
+                            pass
+                    if result is None:
+                        # No worker processes available; run in-process.
+                        result = _awk_run_range(*task)
+                    text, sums, nr = result
+                    shell.outs.write(text)
+                    _awk_merge_sums(ev.vars, sums, accumulators)
+                    ev.NR += nr
 
 
 class CmdTee(Cmd):
@@ -5208,12 +8124,17 @@ class CmdHash(Cmd):
 
     def help(self):
         return (
-            "[-a md5|sha1|sha256|sha512] [<file>...]"
+            "[-a md5|sha1|sha256|sha512] [-r] [-j <n>] [--check <manifest>] "
+            "[--no-cache] [<file>...]"
             "   : computes a cryptographic hash of files or stdin"
         )
 
     def execute(self, shell, args):
         algo = "sha256"
+        recursive = False
+        jobs = os.cpu_count() or 1
+        manifest = None
+        use_cache = True
         filenames = []
         idx = 0
         after_args = False
@@ -5228,6 +8149,30 @@ class CmdHash(Cmd):
                         return
                     algo = args[idx + 1].lower()
                     idx += 1
+                elif arg == "-r":
+                    recursive = True
+                elif arg == "-j" or (arg.startswith("-j") and arg[2:].isdigit()):
+                    value = arg[2:]
+                    if not value:
+                        if idx + 1 >= len(args):
+                            shell.oute.print("ERR: hash: -j requires an argument")
+                            return
+                        value = args[idx + 1]
+                        idx += 1
+                    if not value.isdigit() or int(value) < 1:
+                        shell.oute.print(
+                            f"ERR: hash: invalid number of workers {value!r}"
+                        )
+                        return
+                    jobs = int(value)
+                elif arg == "--check":
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: hash: --check requires a manifest")
+                        return
+                    manifest = args[idx + 1]
+                    idx += 1
+                elif arg == "--no-cache":
+                    use_cache = False
                 else:
                     shell.oute.print(f"ERR: hash: unknown option {arg!r}")
                     return
@@ -5235,12 +8180,21 @@ class CmdHash(Cmd):
                 filenames.append(arg)
             idx += 1
 
-        import hashlib as _hashlib
-        if algo not in _hashlib.algorithms_guaranteed:
+        if algo not in hashlib.algorithms_guaranteed:
             shell.oute.print(f"ERR: hash: unsupported algorithm {algo!r}")
             return
 
-        if filenames:
+        opened = _HashCache.open(shell) if use_cache else contextlib.nullcontext()
+        with opened as cache:
+            self._hash(shell, filenames, manifest, algo, recursive, jobs, cache)
+
+    def _hash(self, shell, filenames, manifest, algo, recursive, jobs, cache):
+        if manifest is not None:
+            # Verification always reads the files: the cache would vouch
+            # for a file changed in place with its size and time restored.
+            self._check(shell, manifest, algo, jobs)
+        elif filenames:
+            files = []
             for fn in filenames:
                 if not os.path.isabs(fn):
                     fn_abs = shell.canon(os.path.join(shell.cwd, fn))
@@ -5250,19 +8204,24 @@ class CmdHash(Cmd):
                     shell.oute.print(f"ERR: {fn} not found")
                     continue
                 if os.path.isdir(fn_abs):
-                    shell.oute.print(f"ERR: {fn}: is a directory")
-                    continue
-                h = _hashlib.new(algo)
-                try:
-                    with open(fn_abs, "rb") as f:
-                        for chunk in iter(lambda: f.read(65536), b""):
-                            h.update(chunk)
-                except OSError as e:
-                    shell.oute.print(f"ERR: {fn}: {e}")
+                    if not recursive:
+                        shell.oute.print(f"ERR: {fn}: is a directory")
+                        continue
+                    tree = _scan_tree(fn_abs)
+                    for rel in sorted(tree, key=lambda r: r.split(os.sep)):
+                        if not tree[rel][0]:
+                            files.append((
+                                os.path.join(fn, rel), os.path.join(fn_abs, rel),
+                            ))
                     continue
-                shell.outs.print(f"{h.hexdigest()}  {fn}")
+                files.append((fn, fn_abs))
+            for fn, digest in self._digests(files, algo, jobs, cache):
+                if isinstance(digest, OSError):
+                    shell.oute.print(f"ERR: {fn}: {digest}")
+                else:
+                    shell.outs.print(f"{digest}  {fn}")
         elif shell.current_stdin is not None:
-            h = _hashlib.new(algo)
+            h = hashlib.new(algo)
             for line in shell.current_stdin:
                 if isinstance(line, bytes):
                     h.update(line)
@@ -5270,20 +8229,687 @@ class CmdHash(Cmd):
                     h.update(line.encode("utf8", errors="replace"))
             shell.outs.print(h.hexdigest())
 
+    def _digests(self, files, algo, jobs, cache=None):
+        """Hash the (name, path) pairs *files* on up to *jobs* threads,
+        taking digests from *cache* (a _HashCache) where it has them.
+
+        Yields (name, hexdigest) in the order of *files*, or (name, error)
+        for files that could not be read.  hashlib releases the GIL while
+        it digests, so the threads hash in parallel.
+        """
+        file_digest = cache.digest if cache else _file_digest
+
+        def digest(path):
+            try:
+                return file_digest(path, algo).hex()
+            except OSError as e:
+                return e
+
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(digest, path) for _, path in files]
+            for (name, _), future in zip(files, futures):
+                yield name, future.result()
+
+    def _check(self, shell, manifest, algo, jobs):
+        """Verify the files listed in a sha256sum-style *manifest*
+        ("<hexdigest>  <name>" lines) and report only those that do not
+        match.  Names are relative to the current directory."""
+        path = manifest
+        if not os.path.isabs(path):
+            path = shell.canon(os.path.join(shell.cwd, path))
+        try:
+            with open(path, encoding="utf8") as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            shell.oute.print(f"ERR: hash: {manifest}: {e}")
+            return
+        size = hashlib.new(algo).digest_size * 2
+        expected = []
+        malformed = 0
+        for line in lines:
+            digest, sep, name = line.partition(" ")
+            # sha256sum writes "  name" for text and " *name" for binary.
+            if not sep or len(digest) != size or name[:1] not in (" ", "*"):
+                if line.strip():
+                    malformed += 1
+                continue
+            name = name[1:]
+            fn_abs = name
+            if not os.path.isabs(fn_abs):
+                fn_abs = shell.canon(os.path.join(shell.cwd, fn_abs))
+            expected.append((name, fn_abs, digest.lower()))
+        failed = 0
+        results = self._digests([(n, p) for n, p, _ in expected], algo, jobs)
+        for (name, _, want), (_, got) in zip(expected, results):
+            if isinstance(got, OSError):
+                shell.outs.print(f"{name}: FAILED open or read")
+            elif got != want:
+                shell.outs.print(f"{name}: FAILED")
+            else:
+                continue
+            failed += 1
+        if malformed:
+            shell.oute.print(
+                f"ERR: hash: {manifest}: {malformed} improperly formatted line(s)"
+            )
+        if failed:
+            shell.oute.print(
+                f"ERR: hash: {failed} of {len(expected)} file(s) did not match"
+            )
+
+
+def _edge_digest(path, size, edge):
+    """Digest of the first and last *edge* bytes of file *path* of the
+    given *size*."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        h.update(f.read(edge))
+        if size > edge:
+            f.seek(max(edge, size - edge))
+            h.update(f.read(edge))
+    return h.digest()
+
+
+class CmdDupes(Cmd):
+    # Bytes hashed at each end of a file before hashing all of it.
+    EDGE = 64 * 1024
+
+    def __init__(self):
+        Cmd.__init__(self, "dupes")
+
+    def help(self):
+        return (
+            "[-j <n>] [--no-cache] [<path>...]"
+            "   : lists groups of files with identical contents "
+            "(empty files and symlinks are ignored, hard links count once)"
+        )
+
+    def execute(self, shell, args):
+        jobs = os.cpu_count() or 1
+        use_cache = True
+        paths = []
+        idx = 0
+        while idx < len(args):
+            arg = args[idx]
+            if arg == "-j" or (arg.startswith("-j") and arg[2:].isdigit()):
+                value = arg[2:]
+                if not value:
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: dupes: -j requires an argument")
+                        return
+                    value = args[idx + 1]
+                    idx += 1
+                if not value.isdigit() or int(value) < 1:
+                    shell.oute.print(
+                        f"ERR: dupes: invalid number of workers {value!r}"
+                    )
+                    return
+                jobs = int(value)
+            elif arg == "--no-cache":
+                use_cache = False
+            else:
+                paths.append(arg)
+            idx += 1
+
+        cwd = shell.canon(shell.cwd)
+        # One path per file: symlinks are left out, and of the hard links
+        # to a file only the first path in sort order is kept, so that
+        # every path listed holds its own copy of the data.
+        inodes = {}
+        for path in paths or ["."]:
+            if not os.path.isabs(path):
+                path = shell.canon(os.path.join(shell.cwd, path))
+            if not os.path.exists(path):
+                shell.oute.print(f"ERR: {path} not found")
+                continue
+            if os.path.isdir(path):
+                tree = _scan_tree(path)
+                found = [
+                    (os.path.join(path, rel), size)
+                    for rel, (is_dir, size, _) in tree.items() if not is_dir
+                ]
+            else:
+                found = [(path, os.path.getsize(path))]
+            for fn, size in found:
+                if not size:
+                    continue
+                try:
+                    st = os.lstat(fn)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key not in inodes or fn < inodes[key][0]:
+                    inodes[key] = (fn, st.st_size)
+        by_size = collections.defaultdict(list)
+        for fn, size in inodes.values():
+            by_size[size].append(fn)
+        for files in by_size.values():
+            files.sort()
+        opened = _HashCache.open(shell) if use_cache else contextlib.nullcontext()
+        with opened as cache:
+            for group in self._groups(by_size, jobs, cache):
+                for fn in group:
+                    if fn.startswith(cwd + os.sep):
+                        fn = fn[len(cwd)+1:]
+                    shell.outs.print(fn)
+                shell.outs.print("")
+                shell.flush_outputs()
+
+    def _groups(self, by_size, jobs, cache):
+        """Yield the groups of files with identical contents, largest files
+        first.
+
+        Only files of equal size are compared.  Those are told apart by a
+        digest of their first and last EDGE bytes, and only files that
+        still collide are hashed in full.  Hashing runs on a thread pool
+        that works ahead while the groups found so far are yielded.
+        """
+        full_digest = cache.digest if cache else _file_digest
+        sizes = sorted(
+            (size for size, files in by_size.items() if len(files) > 1),
+            reverse=True,
+        )
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            edges = {
+                size: [
+                    pool.submit(_edge_digest, fn, size, self.EDGE)
+                    for fn in by_size[size]
+                ]
+                for size in sizes
+            }
+            for size in sizes:
+                candidates = self._collisions(by_size[size], edges.pop(size))
+                if size <= 2 * self.EDGE:
+                    # The edges covered the whole file.
+                    yield from candidates
+                    continue
+                fulls = [
+                    [pool.submit(full_digest, fn) for fn in files]
+                    for files in candidates
+                ]
+                for files, futures in zip(candidates, fulls):
+                    yield from self._collisions(files, futures)
+
+    def _collisions(self, files, futures):
+        """Group *files* by the digests their *futures* compute and return
+        the groups with more than one file; unreadable files are left
+        out."""
+        groups = collections.defaultdict(list)
+        for fn, future in zip(files, futures):
+            try:
+                groups[future.result()].append(fn)
+            except OSError:
+                continue
+        return [g for g in groups.values() if len(g) > 1]
+
+
+# Stands in for a value that is not there, where None is a valid value.
+_MISSING = object()
+
+
+class _JsonPath:
+    """A compiled json -p path query.
+
+    Paths are dot separated steps: a key (or list index) like
+    ``users.0.name``, ``*`` for all members, a slice ``start:stop:step``
+    of a list, and ``..key`` for *key* at any depth.  Brackets take the
+    same steps (``items[*]``, ``items[1:3]``, ``["a.b"]``) and filters
+    ``[?field==value]`` / ``[?field!=value]`` / ``[?field]`` that keep
+    the members whose *field* (itself a dotted path) matches; *value* is
+    a JSON literal or a bare word.
+
+    The path is compiled once into ``steps``, a list of ``(kind, arg)``
+    pairs, and a chain of generators over them, so the matches are
+    produced lazily, one at a time.  ``multi`` is False for paths that
+    select at most one value.
+    """
+
+    _TOKEN = re.compile(
+        r"""\.\.|\.|\[\s*(?:\?(?P<filter>[^\]]*)|(?P<quoted>"(?:[^"\\]|\\.)*"|'[^']*')|(?P<inner>[^\]]*))\s*\]|(?P<bare>[^.\[]+)"""
+    )
+    _INDEX = re.compile(r"-?\d+")
+    _SLICE = re.compile(r"(-?\d*):(-?\d*)(?::(-?\d*))?")
+    _FILTER = re.compile(r"\s*([^=!\s]+)\s*(?:(==|!=)\s*(.*?))?\s*")
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        descend = False
+        pos = 0
+        while pos < len(path):
+            m = self._TOKEN.match(path, pos)
+            if m is None:
+                raise ValueError(f"invalid path {path!r} at {path[pos:]!r}")
+            pos = m.end()
+            token = m.group(0)
+            if token == "..":
+                descend = True
+                continue
+            if token == ".":
+                continue
+            if descend:
+                self.steps.append(("descend", None))
+                descend = False
+            if m.group("filter") is not None:
+                text = m.group("filter")
+                self.steps.append(("filter", self._parse_filter(text)))
+            elif m.group("quoted") is not None:
+                import json as _json
+                quoted = m.group("quoted")
+                if quoted[0] == "'":
+                    quoted = _json.dumps(quoted[1:-1])
+                self.steps.append(("key", _json.loads(quoted)))
+            else:
+                text = m.group("inner")
+                if text is None:
+                    text = m.group("bare")
+                self.steps.append(self._step(text.strip()))
+        if descend:
+            raise ValueError(f"invalid path {path!r}: '..' needs a key")
+        self.multi = any(kind != "key" for kind, _ in self.steps)
+        self._chain = [
+            getattr(self, "_" + kind)(arg) for kind, arg in self.steps
+        ]
+
+    def __call__(self, data):
+        """Return an iterator over the values the path selects in *data*."""
+        values = iter((data,))
+        for step in self._chain:
+            values = step(values)
+        return values
+
+    def _step(self, text):
+        if text == "*":
+            return ("all", None)
+        m = self._SLICE.fullmatch(text)
+        if m:
+            bounds = [int(b) if b else None for b in m.groups()]
+            return ("slice", slice(*bounds))
+        return ("key", text)
+
+    def _parse_filter(self, text):
+        import json as _json
+        m = self._FILTER.fullmatch(text)
+        if m is None:
+            raise ValueError(f"invalid filter [?{text}]")
+        field, op, literal = m.groups()
+        if op is not None:
+            try:
+                literal = _json.loads(literal)
+            except ValueError:
+                literal = literal.strip("'")
+        return _JsonPath(field), op, literal
+
+    @staticmethod
+    def index(name):
+        """Return *name* as a list index, or None if it is not one."""
+        return int(name) if _JsonPath._INDEX.fullmatch(name) else None
+
+    @staticmethod
+    def matches(found, op, literal):
+        """Whether a filter's field value *found* (``_MISSING`` if the
+        field is absent) passes the filter ``op literal``."""
+        if op is None:
+            return found is not _MISSING
+        return (found == literal) == (op == "==")
+
+    @staticmethod
+    def _key(name):
+        index = _JsonPath.index(name)
+
+        def step(values):
+            for value in values:
+                if isinstance(value, dict):
+                    if name in value:
+                        yield value[name]
+                elif isinstance(value, list) and index is not None:
+                    if -len(value) <= index < len(value):
+                        yield value[index]
+        return step
+
+    @staticmethod
+    def _all(_):
+        def step(values):
+            for value in values:
+                if isinstance(value, dict):
+                    yield from value.values()
+                elif isinstance(value, list):
+                    yield from value
+        return step
+
+    @staticmethod
+    def _slice(sl):
+        def step(values):
+            for value in values:
+                if isinstance(value, list):
+                    yield from value[sl]
+        return step
+
+    @staticmethod
+    def _descend(_):
+        # The values themselves and everything below them, in document
+        # order; iterative, so deep documents cannot hit the recursion
+        # limit.
+        def step(values):
+            for value in values:
+                stack = [value]
+                while stack:
+                    value = stack.pop()
+                    yield value
+                    if isinstance(value, dict):
+                        stack.extend(reversed(value.values()))
+                    elif isinstance(value, list):
+                        stack.extend(reversed(value))
+        return step
+
+    @staticmethod
+    def _filter(arg):
+        field, op, literal = arg
+
+        def keep(member):
+            found = next(field(member), _MISSING)
+            return _JsonPath.matches(found, op, literal)
+
+        def step(values):
+            for value in values:
+                if isinstance(value, dict):
+                    value = value.values()
+                elif not isinstance(value, list):
+                    continue
+                yield from filter(keep, value)
+        return step
+
+
+def _json_nested_pattern(depth):
+    """Return a regular expression for a JSON array or object with at most
+    *depth* levels of containers, not checking anything but the brackets
+    and strings."""
+    pattern = b""
+    for _ in range(depth):
+        pattern = (
+            rb'[\[{](?:[^"\[\]{}]++|"[^"\\]*+(?:\\.[^"\\]*+)*+"'
+            + (b"|" + pattern if pattern else b"")
+            + rb")*+[\]}]"
+        )
+    return pattern
+
+
+class _JsonStream:
+    """Evaluates a _JsonPath over the raw bytes of a JSON document (e.g.
+    an mmap of a file) without decoding the parts it does not select.
+
+    Values are addressed by the offset of their first byte.  Skipping a
+    value only finds its end: strings are jumped over by a regular
+    expression and containers by counting the brackets outside strings, so
+    nothing is built and the skipped bytes are not validated.  Only the
+    selected values are decoded, by json's scanner on their slice of
+    bytes; that, the regular expressions and the bytes methods used for
+    skipping run in C.
+    """
+
+    # Bytes per chunk when skipping large containers.
+    CHUNK = 1024**2
+    # Filters decode members up to this size instead of scanning them.
+    SMALL = 4096
+
+    _WS = re.compile(rb"[ \t\n\r]*")
+    _STRING = re.compile(rb'"[^"\\]*+(?:\\.[^"\\]*+)*+"', re.DOTALL)
+    _STRING_REST = re.compile(rb'[^"\\]*+(?:\\.[^"\\]*+)*+"', re.DOTALL)
+    _ESCAPE = re.compile(rb"\\.", re.DOTALL)
+    _BRACKET = re.compile(
+        rb'(?:[^"\[\]{}]++|"[^"\\]*+(?:\\.[^"\\]*+)*+")*+([\[\]{}])', re.DOTALL
+    )
+    _NOT_BRACKET = bytes(c for c in range(256) if c not in b"[]{}")
+    # A container nested at most four deep, matched in one go.
+    _NESTED = re.compile(_json_nested_pattern(4), re.DOTALL)
+    _MEMBER = re.compile(
+        rb'("[^"\\]*+(?:\\.[^"\\]*+)*+")[ \t\n\r]*+:[ \t\n\r]*+', re.DOTALL
+    )
+    _SEPARATOR = re.compile(rb"[ \t\n\r]*+([,\]}])[ \t\n\r]*+")
+    _SCALAR = re.compile(rb"[^,:\[\]{}\s\"]+")
+
+    def __init__(self, buf):
+        import json as _json
+        self.buf = buf
+        self._scan = _json.scanner.make_scanner(_json.JSONDecoder())
+        # (offset, end) of the last container whose members were read to
+        # the end, so the enclosing container need not skip it again.
+        self._last = None
+
+    def select(self, query, pos=0):
+        """Yield the offsets of the values *query* selects in the value
+        at *pos*."""
+        positions = iter((self._WS.match(self.buf, pos).end(),))
+        for kind, arg in query.steps:
+            positions = getattr(self, "_" + kind)(positions, arg)
+        return positions
+
+    def value(self, pos):
+        """Decode the value at *pos*."""
+        return self._decode(pos, self.skip(pos))
+
+    def _decode(self, start, end):
+        # json's scanner directly; json.loads costs more than the parsing
+        # for the many small values of a filter.
+        text = self.buf[start:end].decode("utf8")
+        try:
+            value, stop = self._scan(text, 0)
+        except StopIteration:
+            stop = -1
+        if stop != len(text):
+            self._error("invalid value", start)
+        return value
+
+    def skip(self, pos):
+        """Return the offset just past the value at *pos*."""
+        buf = self.buf
+        c = buf[pos:pos + 1]
+        if c == b'"':
+            m = self._STRING.match(buf, pos)
+            if m is None:
+                self._error("unterminated string", pos)
+            return m.end()
+        if c == b"{" or c == b"[":
+            m = self._NESTED.match(buf, pos, pos + self.CHUNK)
+            if m is not None:
+                return m.end()
+            return self._skip_container(pos)
+        m = self._SCALAR.match(buf, pos)
+        if m is None:
+            self._error("expected a value", pos)
+        return m.end()
+
+    def _skip_container(self, pos):
+        # Chunks (growing, so that small values stay cheap) are reduced to
+        # the brackets outside of strings: escapes are dropped, and then
+        # every other piece between quotes is outside of a string.  Only
+        # the chunk where the depth gets back to zero is walked bracket by
+        # bracket to find the exact end.
+        buf = self.buf
+        n = len(buf)
+        depth = 1
+        in_string = False
+        p = pos + 1
+        size = 256
+        while p < n:
+            q = min(p + size, n)
+            while q < n and buf[q - 1:q] == b"\\":
+                q += 1
+            chunk = buf[p:q]
+            if b"\\" in chunk:
+                chunk = self._ESCAPE.sub(b"", chunk)
+            pieces = chunk.split(b'"')
+            brackets = b"".join(pieces[in_string::2]).translate(
+                None, self._NOT_BRACKET
+            )
+            d = depth
+            for c in brackets:
+                if c == 91 or c == 123:  # [ {
+                    d += 1
+                else:
+                    d -= 1
+                    if d == 0:
+                        break
+            if d == 0:
+                if in_string:
+                    p = self._STRING_REST.match(buf, p).end()
+                for m in self._BRACKET.finditer(buf, p, q):
+                    if m.group(1) in b"[{":
+                        depth += 1
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            return m.end()
+            depth = d
+            in_string ^= len(pieces) % 2 == 0
+            p = q
+            size = min(size * 2, self.CHUNK)
+        self._error("unterminated container", pos)
+
+    def members(self, pos):
+        """Yield ``(key, offset)`` for the members of the object at *pos*,
+        or ``(index, offset)`` for the items of the array there; nothing
+        for other values."""
+        buf = self.buf
+        start = pos
+        opening = buf[pos:pos + 1]
+        if opening == b"{":
+            closing = b"}"
+        elif opening == b"[":
+            closing = b"]"
+        else:
+            return
+        pos = self._WS.match(buf, pos + 1).end()
+        if buf[pos:pos + 1] == closing:
+            self._last = (start, pos + 1)
+            return
+        member = self._MEMBER.match
+        separator = self._SEPARATOR.match
+        index = 0
+        while True:
+            if closing == b"}":
+                m = member(buf, pos)
+                if m is None:
+                    self._error("expected a key", pos)
+                key = self._decode_key(m.group(1))
+                pos = m.end()
+            else:
+                key = index
+                index += 1
+            yield key, pos
+            last = self._last
+            end = last[1] if last and last[0] == pos else self.skip(pos)
+            m = separator(buf, end)
+            if m is None:
+                self._error(f"expected ',' or {closing.decode()!r}", end)
+            if m.group(1) != b",":
+                if m.group(1) != closing:
+                    self._error(f"mismatched {m.group(1).decode()!r}", end)
+                self._last = (start, m.start(1) + 1)
+                return
+            pos = m.end()
+
+    def _decode_key(self, raw):
+        if b"\\" in raw:
+            import json as _json
+            return _json.loads(raw)
+        return raw[1:-1].decode("utf8", "replace")
+
+    def _error(self, msg, pos):
+        raise ValueError(f"{msg} at offset {pos}")
+
+    def _kind(self, pos):
+        return self.buf[pos:pos + 1]
+
+    def _key(self, positions, name):
+        index = _JsonPath.index(name)
+        for pos in positions:
+            kind = self._kind(pos)
+            if kind == b"{":
+                # Reads on to the end: of duplicate keys the last one
+                # counts, as with json.loads.
+                found = None
+                for key, value in self.members(pos):
+                    if key == name:
+                        found = value
+                if found is not None:
+                    yield found
+            elif kind == b"[" and index is not None:
+                if index < 0:
+                    items = [value for _, value in self.members(pos)]
+                    if index >= -len(items):
+                        yield items[index]
+                    continue
+                for i, value in self.members(pos):
+                    if i == index:
+                        yield value
+                        break
+
+    def _all(self, positions, _):
+        for pos in positions:
+            for _, value in self.members(pos):
+                yield value
+
+    def _slice(self, positions, sl):
+        for pos in positions:
+            if self._kind(pos) == b"[":
+                items = [value for _, value in self.members(pos)]
+                yield from items[sl]
+
+    def _descend(self, positions, _):
+        for pos in positions:
+            yield pos
+            stack = [self.members(pos)]
+            while stack:
+                for _, value in stack[-1]:
+                    yield value
+                    stack.append(self.members(value))
+                    break
+                else:
+                    stack.pop()
+
+    def _filter(self, positions, arg):
+        field, op, literal = arg
+        for pos in positions:
+            for _, value in self.members(pos):
+                end = self.skip(value)
+                self._last = (value, end)
+                if end - value <= self.SMALL:
+                    # Decoding a small member in C is quicker than
+                    # scanning it.
+                    found = next(field(self._decode(value, end)), _MISSING)
+                else:
+                    found = next(self.select(field, value), _MISSING)
+                    if found is not _MISSING:
+                        found = self.value(found)
+                if _JsonPath.matches(found, op, literal):
+                    yield value
+
 
 class CmdJson(Cmd):
+    # -p on files at least this large scans the mmap'd bytes for the
+    # selected values instead of decoding the whole document, which needs
+    # several times the file size in memory.  The results are the same,
+    # but then only the selected values are checked to be valid JSON.
+    STREAM_MIN_SIZE = 64 * 1024**2
+
     def __init__(self):
         Cmd.__init__(self, "json")
 
     def help(self):
         return (
-            "[-c] [-p <path>] [-i <indent>] [<file>]"
+            "[-c] [-p <path>] [-i <indent>] [--lines] [<file>]"
             "   : pretty-prints JSON or extracts a value at <path> "
-            "(dot/index syntax: 'users.0.name')"
+            "(dot/index syntax: 'users.0.name', wildcards 'items.*.id', "
+            "slices 'items[1:3]', descent '..id', filters "
+            "'items[?kind==file]'); --lines processes one JSON record per line"
         )
 
     def execute(self, shell, args):
         compact = False
+        lines = False
         path = None
         indent = 2
         filename = None
@@ -5296,6 +8922,8 @@ class CmdJson(Cmd):
                     after_args = True
                 elif arg == "-c":
                     compact = True
+                elif arg == "--lines":
+                    lines = True
                 elif arg == "-p":
                     if idx + 1 >= len(args):
                         shell.oute.print("ERR: json: -p requires an argument")
@@ -5324,6 +8952,14 @@ class CmdJson(Cmd):
                 filename = arg
             idx += 1
 
+        query = None
+        if path is not None:
+            try:
+                query = _JsonPath(path)
+            except ValueError as e:
+                shell.oute.print(f"ERR: json: {e}")
+                return
+
         if filename is not None:
             fn = filename
             if not os.path.isabs(fn):
@@ -5331,8 +8967,19 @@ class CmdJson(Cmd):
             if not os.path.exists(fn):
                 shell.oute.print(f"ERR: {fn} not found")
                 return
-            with open(fn, encoding="utf8") as f:
+            size = os.path.getsize(fn)
+            streamed = query is not None and not lines
+            if streamed and size and size >= self.STREAM_MIN_SIZE:
+                self._stream(shell, fn, query, compact, indent)
+                return
+            with open(fn, encoding="utf8", errors="replace") as f:
+                if lines:
+                    self._lines(shell, f, path, query)
+                    return
                 text = f.read()
+        elif lines and shell.current_stdin is not None:
+            self._lines(shell, shell.current_stdin, path, query)
+            return
         elif shell.current_stdin is not None:
             text = "".join(shell.current_stdin)
         else:
@@ -5346,63 +8993,304 @@ class CmdJson(Cmd):
             shell.oute.print(f"ERR: json: parse error: {e}")
             return
 
-        if path is not None:
+        if query is None:
+            self._print(shell, data, False, compact, indent)
+        else:
+            self._print_all(shell, query, query(data), compact, indent)
+
+    def _stream(self, shell, fn, query, compact, indent):
+        """Print the values *query* selects in the large file *fn*,
+        decoding only those (see _JsonStream)."""
+        with open(fn, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as buf:
+            stream = _JsonStream(buf)
+            values = map(stream.value, stream.select(query))
             try:
-                data = self._walk_path(data, path)
-            except (KeyError, IndexError, TypeError) as e:
-                shell.oute.print(f"ERR: json: {e}")
-                return
-
-        if isinstance(data, str) and path is not None:
-            shell.outs.print(data)
-            return
-        if compact:
-            shell.outs.print(_json.dumps(data, ensure_ascii=False))
+                self._print_all(shell, query, values, compact, indent)
+            except ValueError as e:
+                shell.oute.print(f"ERR: json: parse error: {e}")
+
+    def _print_all(self, shell, query, values, compact, indent):
+        found = False
+        for value in values:
+            found = True
+            self._print(shell, value, True, compact, indent)
+        if not found and not query.multi:
+            shell.oute.print(f"ERR: json: no value at {query.path!r}")
+
+    def _print(self, shell, value, raw_strings, compact, indent):
+        import json as _json
+        if isinstance(value, str) and raw_strings:
+            shell.outs.print(value)
+        elif compact:
+            shell.outs.print(_json.dumps(value, ensure_ascii=False))
         else:
             shell.outs.print(
-                _json.dumps(data, ensure_ascii=False, indent=indent)
+                _json.dumps(value, ensure_ascii=False, indent=indent)
             )
 
-    def _walk_path(self, data, path):
-        for part in path.split("."):
-            if part == "":
+    def _lines(self, shell, records, path, query):
+        """Decode each line of *records* as one JSON value (JSON Lines) and
+        print it, or the values *query* selects in it, compactly.
+
+        Records are handled one at a time, so memory use does not grow
+        with the input.  Blank lines are skipped; malformed lines and
+        records where *query* selects nothing are counted and reported at
+        the end.
+        """
+        import json as _json
+        loads = _json.loads
+        dumps = _json.JSONEncoder(ensure_ascii=False).encode
+        out = shell.outs
+        malformed = missing = 0
+        first_error = None
+        for lineno, line in enumerate(records, 1):
+            if not line.strip():
                 continue
-            if isinstance(data, list):
-                data = data[int(part)]
-            elif isinstance(data, dict):
-                data = data[part]
-            else:
-                raise TypeError(
-                    f"cannot descend into {type(data).__name__} at {part!r}"
-                )
-        return data
+            try:
+                data = loads(line)
+            except ValueError as e:
+                malformed += 1
+                if first_error is None:
+                    first_error = f"line {lineno}: {e}"
+                continue
+            if query is None:
+                out.print(dumps(data))
+                continue
+            found = False
+            for value in query(data):
+                found = True
+                out.print(value if isinstance(value, str) else dumps(value))
+            if not found:
+                missing += 1
+        if malformed:
+            shell.oute.print(
+                f"ERR: json: {malformed} malformed line(s), first at {first_error}"
+            )
+        if missing:
+            shell.oute.print(f"ERR: json: {missing} record(s) without {path!r}")
+
+
+class _HttpPool:
+    """Keep-alive HTTP(S) connections for the downloads of one fetch,
+    pooled per host.
+
+    Each download takes an idle connection to its host (or opens one),
+    sends its request and puts the connection back once the response has
+    been read, so the next download to the same host skips the TCP and
+    TLS handshakes.  Like urlopen, it goes through the proxies set by
+    http_proxy and https_proxy, except for the hosts in no_proxy.  Safe to
+    use from several threads.
+    """
+
+    # Redirects followed per URL.
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout, headers=()):
+        import urllib.request
+        self.timeout = timeout
+        self.headers = dict(headers)
+        self._proxies = urllib.request.getproxies()
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def download(self, url, path):
+        """GET *url* into the file *path*, following redirects, and
+        return the number of bytes written.
+
+        Raises OSError (urllib.error.HTTPError for error statuses),
+        http.client.HTTPException or ValueError for unsupported URLs.
+        """
+        import urllib.error
+        import urllib.parse
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.netloc:
+                raise ValueError(f"unsupported URL {url!r}")
+            host = (parts.scheme, parts.netloc)
+            target = parts.path or "/"
+            if parts.query:
+                target += "?" + parts.query
+            conn, resp = self._request(host, target)
+            done = False
+            try:
+                location = resp.getheader("Location")
+                if resp.status in (301, 302, 303, 307, 308) and location:
+                    resp.read()
+                    done = True
+                    url = urllib.parse.urljoin(url, location)
+                    continue
+                if not 200 <= resp.status < 300:
+                    resp.read()
+                    done = True
+                    raise urllib.error.HTTPError(
+                        url, resp.status, resp.reason, resp.headers, None
+                    )
+                size = 0
+                with open(path, "wb") as f:
+                    for chunk in iter(lambda: resp.read(65536), b""):
+                        f.write(chunk)
+                        size += len(chunk)
+                done = True
+                return size
+            finally:
+                if done and not resp.will_close:
+                    with self._lock:
+                        self._idle[host].append(conn)
+                else:
+                    conn.close()
+        raise urllib.error.HTTPError(
+            url, resp.status, "too many redirects", resp.headers, None
+        )
+
+    def _proxy(self, scheme, netloc):
+        """Return the split URL of the proxy for *netloc*, or None."""
+        import urllib.parse
+        import urllib.request
+        proxy = self._proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(netloc):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        return urllib.parse.urlsplit(proxy)
+
+    @staticmethod
+    def _proxy_headers(proxy):
+        if proxy.username is None:
+            return {}
+        import base64
+        import urllib.parse
+        user = urllib.parse.unquote(proxy.username)
+        password = urllib.parse.unquote(proxy.password or "")
+        credentials = f"{user}:{password}"
+        token = base64.b64encode(credentials.encode()).decode("ascii")
+        return {"Proxy-Authorization": "Basic " + token}
+
+    def _connect(self, scheme, netloc, proxy):
+        import http.client
+        if scheme == "https":
+            cls = http.client.HTTPSConnection
+        else:
+            cls = http.client.HTTPConnection
+        if proxy is None:
+            return cls(netloc, timeout=self.timeout)
+        conn = cls(proxy.hostname, proxy.port, timeout=self.timeout)
+        if scheme == "https":
+            conn.set_tunnel(netloc, headers=self._proxy_headers(proxy))
+        return conn
+
+    def _request(self, host, target):
+        import http.client
+        scheme, netloc = host
+        proxy = self._proxy(scheme, netloc)
+        headers = self.headers
+        if proxy is not None and scheme == "http":
+            # Plain HTTP is requested from the proxy by absolute URL;
+            # HTTPS goes through a tunnel (see _connect).
+            target = f"http://{netloc}{target}"
+            headers = {**headers, **self._proxy_headers(proxy)}
+        with self._lock:
+            idle = self._idle.get(host)
+            conn = idle.pop() if idle else None
+        # A pooled connection may have been closed by the server since it
+        # was last used; that shows only when it is used, so retry once on
+        # a new connection.
+        for reused in (conn is not None, False):
+            if conn is None:
+                conn = self._connect(scheme, netloc, proxy)
+            try:
+                conn.request("GET", target, headers=headers)
+                return conn, conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                conn = None
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+
+
+def _fetch_name(url):
+    """Return the file name fetch -O saves *url* under."""
+    import urllib.parse
+    path = urllib.parse.urlsplit(url).path
+    name = urllib.parse.unquote(path.rstrip("/").rpartition("/")[2])
+    name = name.replace("/", "_").replace(os.sep, "_")
+    if name in ("", ".", ".."):
+        name = "index.html"
+    return name
 
 
 class CmdFetch(Cmd):
+    # Downloads running at the same time with -O, unless -j says otherwise.
+    JOBS = 4
+
     def __init__(self):
         Cmd.__init__(self, "fetch")
 
     def help(self):
         return (
-            "[-o <file>] [-H <header>]... [--timeout <s>] <url>"
-            "   : downloads from a URL (HTTP GET); writes to stdout or <file>"
+            "[-o <file> | -O <dir>] [-i <list>] [-j <n>] [-H <header>]... "
+            "[--timeout <s>] [<url>...]"
+            "   : downloads from URLs (HTTP GET); writes one URL to stdout "
+            "or <file>, or any number of them (also read from <list> or "
+            "stdin) into <dir>, <n> at a time"
         )
 
     def execute(self, shell, args):
         output = None
+        output_dir = None
+        url_list = None
+        jobs = self.JOBS
         headers = []
         timeout = 30.0
-        url = None
+        urls = []
         idx = 0
         while idx < len(args):
             arg = args[idx]
-            if arg == "-o":
+            if arg in ("-o", "-O", "-i"):
                 if idx + 1 >= len(args):
-                    shell.oute.print("ERR: fetch: -o requires an argument")
+                    shell.oute.print(f"ERR: fetch: {arg} requires an argument")
                     return
-                output = args[idx + 1]
+                if arg == "-o":
+                    output = args[idx + 1]
+                elif arg == "-O":
+                    output_dir = args[idx + 1]
+                else:
+                    url_list = args[idx + 1]
                 idx += 2
                 continue
+            if arg == "-j" or (arg.startswith("-j") and arg[2:].isdigit()):
+                value = arg[2:]
+                if not value:
+                    if idx + 1 >= len(args):
+                        shell.oute.print("ERR: fetch: -j requires an argument")
+                        return
+                    value = args[idx + 1]
+                    idx += 1
+                if not value.isdigit() or int(value) < 1:
+                    shell.oute.print(
+                        f"ERR: fetch: invalid number of workers {value!r}"
+                    )
+                    return
+                jobs = int(value)
+                idx += 1
+                continue
             if arg == "-H":
                 if idx + 1 >= len(args):
                     shell.oute.print("ERR: fetch: -H requires an argument")
@@ -5428,24 +9316,48 @@ class CmdFetch(Cmd):
             if arg.startswith("-"):
                 shell.oute.print(f"ERR: fetch: unknown option {arg!r}")
                 return
-            if url is not None:
-                shell.oute.print("ERR: fetch: only one URL allowed")
-                return
-            url = arg
+            urls.append(arg)
             idx += 1
 
-        if url is None:
+        if url_list is not None:
+            path = url_list
+            if not os.path.isabs(path):
+                path = shell.canon(os.path.join(shell.cwd, path))
+            try:
+                with open(path, encoding="utf8") as f:
+                    urls.extend(self._read_urls(f))
+            except OSError as e:
+                shell.oute.print(f"ERR: fetch: {url_list}: {e}")
+                return
+        elif not urls and shell.current_stdin is not None:
+            urls.extend(self._read_urls(shell.current_stdin))
+
+        if not urls:
             shell.oute.print("ERR: fetch: missing URL")
             return
+        if output is not None and (output_dir is not None or len(urls) > 1):
+            shell.oute.print("ERR: fetch: -o takes a single URL; use -O <dir>")
+            return
+        if output_dir is None and len(urls) > 1:
+            shell.oute.print("ERR: fetch: several URLs need -O <dir>")
+            return
 
-        import urllib.request as _ureq
-        req = _ureq.Request(url)
+        parsed = []
         for h in headers:
             if ":" not in h:
                 shell.oute.print(f"ERR: fetch: invalid header {h!r}")
                 return
             name, value = h.split(":", 1)
-            req.add_header(name.strip(), value.strip())
+            parsed.append((name.strip(), value.strip()))
+
+        if output_dir is not None:
+            self._fetch_all(shell, urls, output_dir, jobs, parsed, timeout)
+            return
+
+        import urllib.request as _ureq
+        req = _ureq.Request(urls[0])
+        for name, value in parsed:
+            req.add_header(name, value)
 
         try:
             with _ureq.urlopen(req, timeout=timeout) as resp:
@@ -5468,6 +9380,74 @@ class CmdFetch(Cmd):
         except Exception as e:
             shell.oute.print(f"ERR: fetch: {e}")
 
+    def _read_urls(self, lines):
+        """URLs from the lines of a list, skipping blank and # lines."""
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+    def _fetch_all(self, shell, urls, output_dir, jobs, headers, timeout):
+        """Download *urls* into *output_dir* on up to *jobs* threads that
+        share a _HttpPool, printing a status line per URL in the order
+        given.  Files are named after the last part of the URL path; a
+        name that is already taken gets a .1, .2, ... suffix."""
+        dir_abs = output_dir
+        if not os.path.isabs(dir_abs):
+            dir_abs = shell.canon(os.path.join(shell.cwd, dir_abs))
+        try:
+            os.makedirs(dir_abs, exist_ok=True)
+        except OSError as e:
+            shell.oute.print(f"ERR: fetch: {output_dir}: {e}")
+            return
+        names = []
+        taken = set()
+        suffixes = {}
+        for url in urls:
+            base = name = _fetch_name(url)
+            # A suffixed name can itself be the name of a later URL (a,
+            # a, a.1), so every candidate is checked against all names.
+            while name in taken:
+                suffixes[base] = suffixes.get(base, 0) + 1
+                name = f"{base}.{suffixes[base]}"
+            taken.add(name)
+            names.append(name)
+
+        def download(url, name):
+            # Into a .part file first, so that a failed download leaves
+            # an earlier file of the same name alone.
+            path = os.path.join(dir_abs, name)
+            part = path + ".part"
+            try:
+                size = pool.download(url, part)
+                os.replace(part, path)
+                return size
+            except Exception as e:
+                with contextlib.suppress(OSError):
+                    os.remove(part)
+                return e
+
+        failed = 0
+        with _HttpPool(timeout, headers) as pool:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                futures = [
+                    executor.submit(download, url, name)
+                    for url, name in zip(urls, names)
+                ]
+                for url, name, future in zip(urls, names, futures):
+                    result = future.result()
+                    if isinstance(result, Exception):
+                        shell.oute.print(f"ERR: fetch: {url}: {result}")
+                        failed += 1
+                    else:
+                        shell.outs.print(
+                            f"{os.path.join(output_dir, name)}: {result} bytes"
+                        )
+        if failed:
+            shell.oute.print(
+                f"ERR: fetch: {failed} of {len(urls)} download(s) failed"
+            )
+
 
 class CmdTar(Cmd):
     def __init__(self):
@@ -5704,6 +9684,222 @@ class CmdOpen(Cmd):
             shell.oute.print(f"ERR: open: {e}")
 
 
+class _FileLines:
+    """Lines of a binary file for the pager.  The line index is extended
+    only as far as the pager has looked so far."""
+
+    def __init__(self, f, index):
+        self.f = f
+        self.index = index
+
+    @property
+    def complete(self):
+        return self.index.complete
+
+    def __len__(self):
+        return len(self.index)
+
+    def load(self, n):
+        """Make at least *n* lines known, unless the file is shorter."""
+        while len(self.index) < n and self.index.scan_more(self.f):
+            pass
+
+    def get(self, lo, hi):
+        self.load(hi)
+        hi = min(hi, len(self.index))
+        if lo >= hi:
+            return []
+        data = self.index.read(self.f, lo, hi)
+        return [
+            line.rstrip(b"\r").decode("utf8", errors="replace")
+            for line in data.split(b"\n")[:hi - lo]
+        ]
+
+
+class _IterLines:
+    """Lines of piped input for the pager, taken from the input only as
+    far as the pager has looked so far."""
+
+    def __init__(self, lines):
+        self._it = iter(lines)
+        self._lines = []
+        self.complete = False
+
+    def __len__(self):
+        return len(self._lines)
+
+    def load(self, n):
+        if self.complete or len(self._lines) >= n:
+            return
+        more = itertools.islice(self._it, n - len(self._lines))
+        self._lines.extend(l.rstrip("\n").rstrip("\r") for l in more)
+        if len(self._lines) < n:
+            self.complete = True
+
+    def get(self, lo, hi):
+        self.load(hi)
+        return self._lines[lo:hi]
+
+
+class _Pager:
+    """Interactive pager over a _FileLines or _IterLines source.
+
+    With VT escapes only the rows that changed are repainted: small
+    scrolls move the screen contents with a scroll region (SU/SD) and the
+    rows that scrolled in are drawn, everything else is compared with what
+    is already on screen.
+    """
+
+    # Lines fetched at once while searching.
+    SEARCH_BATCH = 1024
+
+    def __init__(self, shell, source):
+        self.shell = shell
+        self.source = source
+        term = shutil.get_terminal_size()
+        self.rows = max(2, term.lines - 1)
+        self.cols = term.columns
+        self.top = 0
+        self.message = ""
+        self.pattern = None
+        # What is on screen: one string per row plus the status row, and the
+        # top line it was drawn for.  None if the screen is unknown.
+        self.screen = None
+        self.screen_top = 0
+
+    def fits(self):
+        self.source.load(self.rows + 1)
+        return self.source.complete and len(self.source) <= self.rows
+
+    def last_top(self):
+        self.source.load(self.top + 2 * self.rows)
+        return max(0, len(self.source) - self.rows)
+
+    def scroll(self, delta):
+        if delta > 0:
+            self.top = min(self.last_top(), self.top + delta)
+        else:
+            self.top = max(0, self.top + delta)
+
+    def status(self):
+        if self.message:
+            return self.message
+        total = len(self.source)
+        bottom = min(self.top + self.rows, total)
+        if self.source.complete:
+            pct = 100 if total <= self.rows else int(100 * bottom / total)
+            where = f"{total} ({pct}%)"
+        else:
+            where = f"{total}+"
+        return f":  lines {self.top + 1}-{bottom}/{where}  q to quit"
+
+    def draw(self):
+        cols = self.cols
+        lines = self.source.get(self.top, self.top + self.rows)
+        wanted = [line[:cols] for line in lines]
+        wanted += [""] * (self.rows - len(wanted))
+        wanted.append(self.status()[:cols])
+        out = self.shell.outs
+        if not _VT_ENABLED:
+            for line in wanted[:-1]:
+                out.write(line + "\n")
+            out.write(wanted[-1])
+            return
+        screen = self.screen
+        if screen is None:
+            out.write("\033[2J")
+            screen = [None] * len(wanted)
+        delta = self.top - self.screen_top
+        if 0 < abs(delta) < self.rows:
+            out.write(f"\033[1;{self.rows}r")
+            if delta > 0:
+                out.write(f"\033[{delta}S")
+                screen = screen[delta:self.rows] + [None] * delta
+            else:
+                out.write(f"\033[{-delta}T")
+                screen = [None] * -delta + screen[:self.rows + delta]
+            out.write("\033[r")
+            screen.append(None)
+        for row, (old, new) in enumerate(zip(screen, wanted)):
+            if old != new:
+                out.write(f"\033[{row + 1};1H{new}\033[K")
+        self.screen = wanted
+        self.screen_top = self.top
+
+    def prompt(self, prefix):
+        """Read a line of input on the status row; None if cancelled."""
+        text = ""
+        while True:
+            self.message = prefix + text
+            self.draw()
+            key = self.shell.inp.getch()
+            if key in (KEY_CR, KEY_LF, "\r", "\n"):
+                self.message = ""
+                return text
+            if key in (KEY_ESC, KEY_CTRL_C):
+                self.message = ""
+                return None
+            if key == KEY_BACKSPACE:
+                if not text:
+                    self.message = ""
+                    return None
+                text = text[:-1]
+            elif isinstance(key, str) and key.isprintable():
+                text += key
+
+    def search(self, start):
+        """Move to the first line from *start* on that matches the current
+        pattern, reading the input only as far as the match."""
+        pos = start
+        while True:
+            lines = self.source.get(pos, pos + self.SEARCH_BATCH)
+            for i, line in enumerate(lines):
+                if self.pattern.search(line):
+                    self.top = pos + i
+                    if self.source.complete:
+                        self.top = min(self.top, self.last_top())
+                    return
+            if len(lines) < self.SEARCH_BATCH:
+                self.message = "Pattern not found"
+                return
+            pos += len(lines)
+
+    def run(self):
+        rows = self.rows
+        while True:
+            self.draw()
+            self.message = ""
+            key = self.shell.inp.getch()
+            if key is None:
+                continue
+            if key in ("q", "Q", KEY_CTRL_C, KEY_CTRL_D):
+                break
+            elif key in (" ", "f", KEY_PAGEDOWN):
+                self.scroll(rows)
+            elif key in ("b", KEY_PAGEUP):
+                self.scroll(-rows)
+            elif key in ("j", "\r", "\n", KEY_CR, KEY_LF, KEY_DOWN):
+                self.scroll(1)
+            elif key in ("k", KEY_UP):
+                self.scroll(-1)
+            elif key in ("g", KEY_HOME):
+                self.top = 0
+            elif key in ("G", KEY_END):
+                self.source.load(sys.maxsize)
+                self.top = self.last_top()
+            elif key == "/":
+                text = self.prompt("/")
+                if text:
+                    try:
+                        self.pattern = re.compile(text)
+                    except re.error as e:
+                        self.message = f"Invalid pattern: {e}"
+                        continue
+                    self.search(self.top + 1)
+            elif key == "n" and self.pattern is not None:
+                self.search(self.top + 1)
+
+
 class CmdLess(Cmd):
     def __init__(self):
         Cmd.__init__(self, "less")
@@ -5711,7 +9907,8 @@ class CmdLess(Cmd):
     def help(self):
         return (
             "[<file>]"
-            "   : pages through file or stdin (space=page, j/k=line, g/G=top/bottom, q=quit)"
+            "   : pages through file or stdin (space=page, j/k=line, "
+            "g/G=top/bottom, /=search, n=next match, q=quit)"
         )
 
     def execute(self, shell, args):
@@ -5725,68 +9922,23 @@ class CmdLess(Cmd):
             if os.path.isdir(fn):
                 shell.oute.print(f"ERR: {args[0]}: is a directory")
                 return
-            with open(fn, encoding="utf8", errors="replace") as f:
-                lines = [l.rstrip("\n").rstrip("\r") for l in f]
+            with open(fn, "rb") as f:
+                index = _LineIndex.open(f, shell.cache_dir("lines"), lazy=True)
+                self._page(shell, _FileLines(f, index))
         elif shell.current_stdin is not None:
-            lines = [
-                l.rstrip("\n").rstrip("\r") for l in shell.current_stdin
-            ]
+            self._page(shell, _IterLines(shell.current_stdin))
         else:
             shell.oute.print("ERR: less: no input")
-            return
-
-        term = shutil.get_terminal_size()
-        rows = max(2, term.lines - 1)
-        cols = term.columns
-        total = len(lines)
-        top = 0
-
-        def draw():
-            if _VT_ENABLED:
-                shell.outs.write("\033[2J\033[H")
-            visible = lines[top:top + rows]
-            for line in visible:
-                shell.outs.write(line[:cols] + "\n")
-            pct = 100 if total <= rows else int(
-                100 * min(top + rows, total) / total
-            )
-            status = f":  lines {top + 1}-{min(top + rows, total)}/{total} ({pct}%)  q to quit"
-            shell.outs.write(status[:cols])
 
+    def _page(self, shell, source):
+        pager = _Pager(shell, source)
         # If everything fits, just print and return.
-        if total <= rows:
-            for line in lines:
-                shell.outs.print(line[:cols])
+        if pager.fits():
+            for line in source.get(0, len(source)):
+                shell.outs.print(line[:pager.cols])
             return
-
         try:
-            while True:
-                draw()
-                key = shell.inp.getch()
-                if key is None:
-                    continue
-                if key in ("q", "Q", "\x03", "\x04"):
-                    break
-                elif key == " ":
-                    top = min(total - rows, top + rows)
-                elif key == "b":
-                    top = max(0, top - rows)
-                elif key in ("j", "\r", "\n"):
-                    top = min(total - rows, top + 1)
-                elif key == "k":
-                    top = max(0, top - 1)
-                elif key == "g":
-                    top = 0
-                elif key == "G":
-                    top = max(0, total - rows)
-                elif key == "ARROW_DOWN":
-                    top = min(total - rows, top + 1)
-                elif key == "ARROW_UP":
-                    top = max(0, top - 1)
-                elif key == "PAGE_DOWN":
-                    top = min(total - rows, top + rows)
-                elif key == "PAGE_UP":
-                    top = max(0, top - rows)
+            pager.run()
         finally:
             if _VT_ENABLED:
                 shell.outs.write("\033[2J\033[H")
@@ -6503,6 +10655,8 @@ class CmdWatch(Cmd):
                 for line in lines:
                     shell.outs.write(line + "\n")
 
+                _flush_stream_buffers()
+
                 # On Linux the terminal is in raw mode (ISIG cleared), so
                 # Ctrl+C does not raise KeyboardInterrupt via a signal.
                 # Instead, poll stdin with a timeout; if the user presses
@@ -8,10 +8,13 @@ Run with:
 Uses only the standard library (unittest + tempfile + os + textwrap).
 """
 
+import io
 import os
 import sys
 import tempfile
 import textwrap
+import threading
+import time
 import unittest
 
 # ── locate the package regardless of where the test is run from ──────────────
@@ -88,6 +91,7 @@ class ShellTestCase(unittest.TestCase):
         self.shell = m.Dabshell()
         self.shell.cwd = self.tmpdir
         self.shell.options["user-home"] = self.tmpdir
+        self.shell.options["cache-dir"] = "off"
 
         # Capture stdout and stderr
         self._out = _CapturingOutput()
@@ -760,6 +764,11 @@ class TestSortUniqCutTee(ShellTestCase):
         out = self.out("sort -u a.txt")
         self.assertEqual(out.splitlines(), ["a", "b", "c"])
 
+    def test_sort_unique_keeps_first_of_equal_keys(self):
+        self.write_file("n.txt", "2\n1.0\n1\n2.0\n")
+        self.assertEqual(self.out("sort -u -n n.txt").splitlines(), ["1.0", "2"])
+        self.assertEqual(self.out("sort -u -n -r n.txt").splitlines(), ["2", "1.0"])
+
     def test_sort_key(self):
         self.write_file("a.txt", "z 1\ny 2\nx 3\n")
         out = self.out("sort -k 2 a.txt")
@@ -770,6 +779,70 @@ class TestSortUniqCutTee(ShellTestCase):
         out = self.out("cat a.txt | sort")
         self.assertEqual(out.splitlines(), ["a", "b", "c"])
 
+    def test_sort_external_matches_in_memory(self):
+        import random
+        rnd = random.Random(42)
+        rows = [f"k{rnd.randint(0, 50)} {rnd.randint(-500, 500)}" for _ in range(2000)]
+        self.write_file("big.txt", "\n".join(rows) + "\n")
+        os.mkdir(os.path.join(self.tmpdir, "tmp"))
+        sort = self.shell.env.get("sort")
+        sort.READ_BATCH = 16
+        try:
+            for opts in ("", "-r", "-n -k 2", "-u", "-u -k 1", "-r -n -u -k 2"):
+                expected = self.out(f"sort {opts} big.txt")
+                out = self.out(f"sort -S 2K -T tmp {opts} big.txt")
+                self.assertEqual(out, expected, opts)
+        finally:
+            del sort.READ_BATCH
+        # Spilled runs are cleaned up afterwards.
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, "tmp")), [])
+
+    def test_sort_external_many_runs(self):
+        self.write_file("n.txt", "".join(f"{i}\n" for i in range(3000, 0, -1)))
+        sort = self.shell.env.get("sort")
+        sort.MERGE_FANIN = 3
+        sort.READ_BATCH = 16
+        try:
+            out = self.out("sort -n -S 1K n.txt")
+            # Repeated keys keep their input order across many runs, and
+            # -u keeps the first line of each key, as in memory.
+            self.write_file(
+                "k.txt", "".join(f"k{i % 3} {i}\n" for i in range(1000))
+            )
+            keyed = self.out("sort -k 1 -S 2K k.txt")
+            unique = self.out("sort -u -k 1 -S 2K k.txt")
+        finally:
+            del sort.MERGE_FANIN, sort.READ_BATCH
+        self.assertEqual(out.splitlines(), [str(i) for i in range(1, 3001)])
+        self.assertEqual(keyed, self.out("sort -k 1 k.txt"))
+        self.assertEqual(unique.splitlines(), ["k0 0", "k1 1", "k2 2"])
+
+    def test_sort_parallel_matches_serial(self):
+        import random
+        rnd = random.Random(7)
+        rows = [f"{rnd.choice('abc')} {rnd.uniform(-9, 9):.3f}" for _ in range(3000)]
+        self.write_file("p.txt", "\n".join(rows) + "\n")
+        sort = self.shell.env.get("sort")
+        sort.PARALLEL_MIN = 100
+        sort.READ_BATCH = 256
+        try:
+            for opts in ("", "-k 2 -n", "-r -k 1", "-u -k 1"):
+                expected = self.out(f"sort {opts} p.txt")
+                out = self.out(f"sort --parallel 3 {opts} p.txt")
+                self.assertEqual(out, expected, opts)
+                out = self.out(f"sort --parallel=2 -S 4K {opts} p.txt")
+                self.assertEqual(out, expected, opts)
+        finally:
+            del sort.PARALLEL_MIN, sort.READ_BATCH
+
+    def test_sort_parallel_invalid(self):
+        self.write_file("a.txt", "a\n")
+        self.assertIn("ERR", self.err("sort --parallel 0 a.txt"))
+
+    def test_sort_invalid_buffer_size(self):
+        self.write_file("a.txt", "a\n")
+        self.assertIn("ERR", self.err("sort -S lots a.txt"))
+
     # uniq
 
     def test_uniq_basic(self):
@@ -798,6 +871,55 @@ class TestSortUniqCutTee(ShellTestCase):
         out = self.out("uniq -i u.txt")
         self.assertEqual(out.splitlines(), ["a", "b"])
 
+    def test_uniq_global_keeps_first_in_order(self):
+        self.write_file("u.txt", "b\na\nb\nc\na\nB\n")
+        self.assertEqual(self.out("uniq -g u.txt").splitlines(), ["b", "a", "c", "B"])
+        self.assertEqual(self.out("uniq --global -i u.txt").splitlines(), ["b", "a", "c"])
+
+    def test_uniq_global_exact_limit_warns(self):
+        self.write_file("u.txt", "a\nb\nc\nc\na\n")
+        out, err = self.run_cmd("uniq -g --max-exact 2 u.txt")
+        # c is past the limit so its repeat is not removed; a still is.
+        self.assertEqual(out.splitlines(), ["a", "b", "c", "c"])
+        self.assertTrue(err.startswith("ERR: uniq: more than 2 distinct lines"))
+        self.assertIn("--approx", err)
+
+    def test_uniq_global_approx(self):
+        self.write_file("u.txt", "a\nb\nc\nd\nc\nd\na\ne\n")
+        out, err = self.run_cmd("uniq -g --max-exact 2 --approx u.txt")
+        self.assertEqual(out.splitlines(), ["a", "b", "c", "d", "e"])
+        self.assertEqual(err, "")
+
+    def test_uniq_global_rejects_count(self):
+        self.write_file("u.txt", "a\n")
+        self.assertIn("ERR", self.err("uniq -g -c u.txt"))
+
+    def test_uniq_count_all_unsorted_input(self):
+        self.write_file("u.txt", "b\na\nb\nc\nb\na\n")
+        out = self.out("uniq -a u.txt")
+        lines = [l.split() for l in out.splitlines()]
+        self.assertEqual(lines, [["3", "b"], ["2", "a"], ["1", "c"]])
+
+    def test_uniq_count_all_top(self):
+        self.write_file("u.txt", "x\ny\nz\ny\nz\nz\n")
+        out = self.out("uniq --top 2 u.txt")
+        lines = [l.split() for l in out.splitlines()]
+        self.assertEqual(lines, [["3", "z"], ["2", "y"]])
+
+    def test_uniq_count_all_ignore_case_and_dups(self):
+        self.write_file("u.txt", "Foo\nbar\nfoo\nbaz\n")
+        out = self.out("uniq --count-all -i -d u.txt")
+        self.assertEqual([l.split() for l in out.splitlines()], [["2", "Foo"]])
+
+    def test_bloom_filter(self):
+        bf = m._BloomFilter(1000)
+        self.assertFalse(bf.add("x"))
+        self.assertTrue(bf.add("x"))
+        added = [f"k{i}" for i in range(1000)]
+        for k in added:
+            bf.add(k)
+        self.assertTrue(all(bf.add(k) for k in added))
+
     def test_uniq_pipe(self):
         out = self.out("echo a a b b c | tr ' ' '\\n'")
         # actual test below uses pipe through cat
@@ -832,6 +954,40 @@ class TestSortUniqCutTee(ShellTestCase):
         out = self.out("cut -c 2-4 c.txt")
         self.assertEqual(out.splitlines(), ["bcd", "hij"])
 
+    def test_cut_fields_input_order_and_overlap(self):
+        self.write_file("c.txt", "a,b,c,d,e\n")
+        out = self.out("cut -d , -f 4,1-2,2-3 c.txt")
+        self.assertEqual(out.splitlines(), ["a,b,c,d"])
+
+    def test_cut_fields_short_lines(self):
+        self.write_file("c.txt", "a,b,c,d\na,b\nabc\n")
+        out = self.out("cut -d , -f 1,3 c.txt")
+        self.assertEqual(out.splitlines(), ["a,c", "a", "abc"])
+
+    def test_cut_fields_open_range_in_list(self):
+        self.write_file("c.txt", "a,b,c,d,e\n")
+        out = self.out("cut -d , -f 1,4- c.txt")
+        self.assertEqual(out.splitlines(), ["a,d,e"])
+
+    def test_cut_chars_multiple_ranges(self):
+        self.write_file("c.txt", "abcdef\n")
+        out = self.out("cut -c 5-,1-2 c.txt")
+        self.assertEqual(out.splitlines(), ["abef"])
+
+    def test_cut_bytes(self):
+        self.write_file("c.txt", "h\u00e9llo\n")
+        self.assertEqual(self.out("cut -b 1-3 c.txt").splitlines(), ["h\u00e9"])
+        self.assertEqual(self.out("cut -c 1-3 c.txt").splitlines(), ["h\u00e9l"])
+        out = self.out("print abcdef | cut -b 2,4")
+        self.assertEqual(out.splitlines(), ["bd"])
+
+    def test_cut_normalize(self):
+        cmd = self.shell.env.get("cut")
+        self.assertEqual(
+            cmd._normalize([(5, 6), (1, 2), (3, 3), (8, None), (9, 10)]),
+            [(0, 3), (4, 6), (7, None)],
+        )
+
     def test_cut_requires_one_of_f_c(self):
         err = self.err("cut a.txt")
         self.assertIn("ERR", err)
@@ -941,6 +1097,208 @@ class TestFindHash(ShellTestCase):
             "5891b5b522d5df086d0ff0b110fbd9d21bb4fc7163af34d08286a2e846f6be03",
         )
 
+    def _hash_tree(self):
+        import hashlib
+        files = {
+            "a.txt": "alpha\n",
+            os.path.join("sub", "b.txt"): "beta\n",
+            os.path.join("sub", "deeper", "c.txt"): "gamma\n",
+        }
+        os.makedirs(os.path.join(self.tmpdir, "hashed", "sub", "deeper"))
+        for name, content in files.items():
+            self.write_file(os.path.join("hashed", name), content)
+        return [
+            f"{hashlib.sha256(content.encode()).hexdigest()}  "
+            f"{os.path.join('hashed', name)}"
+            for name, content in sorted(files.items(), key=lambda i: i[0].split(os.sep))
+        ]
+
+    def test_hash_recursive(self):
+        expected = self._hash_tree()
+        self.assertEqual(self.out("hash -r hashed").splitlines(), expected)
+        self.assertEqual(self.out("hash -r -j 3 hashed").splitlines(), expected)
+        self.assertIn("is a directory", self.err("hash hashed"))
+
+    def test_hash_check_reports_only_mismatches(self):
+        lines = self._hash_tree()
+        self.write_file("SUMS", "\n".join(lines + [
+            "0" * 64 + "  missing.txt",
+            "not a checksum line",
+        ]) + "\n")
+        self.write_file(os.path.join("hashed", "a.txt"), "changed\n")
+        out, err = self.run_cmd("hash --check SUMS -j 2")
+        self.assertEqual(out.splitlines(), [
+            f"{os.path.join('hashed', 'a.txt')}: FAILED",
+            "missing.txt: FAILED open or read",
+        ])
+        self.assertIn("1 improperly formatted line", err)
+        self.assertIn("2 of 4 file(s) did not match", err)
+
+    def _hash_cache(self, min_age=0):
+        cache = os.path.join(self.tmpdir, "cache")
+        self.shell.options["cache-dir"] = cache
+        self.addCleanup(
+            setattr, m._HashCache, "MIN_AGE_NS", m._HashCache.MIN_AGE_NS
+        )
+        m._HashCache.MIN_AGE_NS = min_age
+        reads = []
+        orig_digest = m._file_digest
+        def counting_digest(path, algo="sha256"):
+            reads.append(os.path.basename(path))
+            return orig_digest(path, algo)
+        m._file_digest = counting_digest
+        self.addCleanup(setattr, m, "_file_digest", orig_digest)
+        return os.path.join(cache, "hashes", "hashes.sqlite"), reads
+
+    def test_hash_cache_skips_unchanged_files(self):
+        _, reads = self._hash_cache()
+        self.write_file("h.txt", "hello\n")
+        first = self.out("hash h.txt")
+        self.assertEqual(reads, ["h.txt"])
+        self.assertEqual(self.out("hash h.txt"), first)
+        self.assertEqual(reads, ["h.txt"])
+        self.out("hash --no-cache h.txt")
+        self.assertEqual(reads, ["h.txt", "h.txt"])
+        # Other algorithms and changed files are hashed again.
+        self.out("hash -a md5 h.txt")
+        self.write_file("h.txt", "hello, world\n")
+        self.assertNotEqual(self.out("hash h.txt"), first)
+        self.assertEqual(len(reads), 4)
+        # diff shares the cache.
+        self.write_file("g.txt", "hello, world\n")
+        self.assertEqual(self.out("diff -q h.txt g.txt"), "")
+        self.assertEqual(reads[4:], ["g.txt"])
+
+    def test_hash_cache_evicts_least_recently_used(self):
+        import contextlib, sqlite3
+        db, _ = self._hash_cache()
+        self.addCleanup(
+            setattr, m._HashCache, "MAX_ENTRIES", m._HashCache.MAX_ENTRIES
+        )
+        m._HashCache.MAX_ENTRIES = 2
+        for name in ("x.txt", "y.txt", "z.txt"):
+            self.write_file(name, name)
+        self.out("hash x.txt y.txt")
+        self.out("hash x.txt")
+        self.out("hash z.txt")
+        with contextlib.closing(sqlite3.connect(db)) as conn:
+            sizes = sorted(r[0] for r in conn.execute("SELECT size FROM hashes"))
+            inodes = {r[0] for r in conn.execute("SELECT ino FROM hashes")}
+        self.assertEqual(sizes, [5, 5])
+        self.assertNotIn(
+            os.stat(os.path.join(self.tmpdir, "y.txt")).st_ino, inodes
+        )
+
+    def test_hash_cache_ignores_fresh_files(self):
+        import contextlib, sqlite3
+        db, reads = self._hash_cache(min_age=60 * 10**9)
+        self.write_file("h.txt", "hello\n")
+        self.out("hash h.txt")
+        self.out("hash h.txt")
+        self.assertEqual(reads, ["h.txt", "h.txt"])
+        with contextlib.closing(sqlite3.connect(db)) as conn:
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM hashes").fetchone(), (0,)
+            )
+
+    def test_hash_check_reads_files_despite_cache(self):
+        self._hash_cache()
+        self.write_file("h.txt", "hello\n")
+        path = os.path.join(self.tmpdir, "h.txt")
+        self.write_file("SUMS", self.out("hash h.txt"))
+        st = os.stat(path)
+        self.write_file("h.txt", "HELLO\n")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self.out("hash --check SUMS"), "h.txt: FAILED")
+
+    def test_hash_cache_commits_in_batches(self):
+        import contextlib, sqlite3
+        db, _ = self._hash_cache()
+        self.addCleanup(
+            setattr, m._HashCache, "COMMIT_EVERY", m._HashCache.COMMIT_EVERY
+        )
+        m._HashCache.COMMIT_EVERY = 2
+        for name in ("x.txt", "y.txt", "z.txt"):
+            self.write_file(name, name)
+        os.makedirs(os.path.dirname(db))
+        cache = m._HashCache(db)
+        cache.digest(os.path.join(self.tmpdir, "x.txt"), "sha256")
+        cache.digest(os.path.join(self.tmpdir, "y.txt"), "sha256")
+        cache.digest(os.path.join(self.tmpdir, "z.txt"), "sha256")
+        with contextlib.closing(sqlite3.connect(db)) as conn:
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM hashes").fetchone(), (2,)
+            )
+        cache.close()
+
+    def test_hash_check_all_ok(self):
+        self.write_file("SUMS", "\n".join(self._hash_tree()) + "\n")
+        self.assertEqual(self.run_cmd("hash --check SUMS"), ("", ""))
+
+
+class TestDupes(ShellTestCase):
+
+    def setUp(self):
+        super().setUp()
+        edge = m.CmdDupes.EDGE
+        big = os.urandom(3 * edge)
+        # Same size, same first and last EDGE bytes, different middle.
+        twin = big[:edge] + bytes(edge) + big[-edge:]
+        os.makedirs(os.path.join(self.tmpdir, "d", "sub"))
+        for name, content in [
+            ("big1.bin", big),
+            (os.path.join("sub", "big2.bin"), big),
+            ("twin.bin", twin),
+            ("small1.txt", b"small\n"),
+            ("small2.txt", b"small\n"),
+            ("small3.txt", b"other\n"),
+            ("empty1", b""),
+            ("empty2", b""),
+        ]:
+            self.write_file(os.path.join("d", name), content)
+        self.reads = []
+        orig_digest = m._file_digest
+        def counting_digest(path, algo="sha256"):
+            self.reads.append(os.path.basename(path))
+            return orig_digest(path, algo)
+        m._file_digest = counting_digest
+        self.addCleanup(setattr, m, "_file_digest", orig_digest)
+
+    def test_dupes_groups_identical_files(self):
+        out = self.out("dupes d")
+        join = os.path.join
+        self.assertEqual(out.split("\n\n"), [
+            f"{join('d', 'big1.bin')}\n{join('d', 'sub', 'big2.bin')}",
+            f"{join('d', 'small1.txt')}\n{join('d', 'small2.txt')}",
+        ])
+        # Only the large files whose edges collide are hashed in full.
+        self.assertEqual(sorted(self.reads), ["big1.bin", "big2.bin", "twin.bin"])
+
+    def test_dupes_skips_symlinks_and_counts_hard_links_once(self):
+        join = os.path.join
+        d = join(self.tmpdir, "d")
+        os.symlink(join(d, "small1.txt"), join(d, "sym.txt"))
+        os.link(join(d, "small1.txt"), join(d, "hard.txt"))
+        out = self.out("dupes d")
+        self.assertIn(
+            f"{join('d', 'hard.txt')}\n{join('d', 'small2.txt')}",
+            out.split("\n\n"),
+        )
+        self.assertNotIn("sym.txt", out)
+        self.assertNotIn("small1.txt", out)
+        # A file and only its own links are no duplicates.
+        os.remove(join(d, "small2.txt"))
+        self.assertNotIn("small", self.out("dupes d"))
+
+    def test_dupes_parallel_and_file_arguments(self):
+        serial = self.out("dupes -j 1 d")
+        self.assertEqual(self.out("dupes -j 4 d"), serial)
+        out = self.out(f"dupes {os.path.join('d', 'small1.txt')} d")
+        self.assertEqual(out, serial)
+
+    def test_dupes_without_duplicates(self):
+        self.assertEqual(self.out(f"dupes {os.path.join('d', 'sub')}"), "")
+
 
 class TestJson(ShellTestCase):
 
@@ -987,6 +1345,137 @@ class TestJson(ShellTestCase):
         out = self.out("cat data.json | json -p age")
         self.assertEqual(out.strip(), "30")
 
+    def test_json_lines(self):
+        self.write_file("log.ndjson", "\n".join([
+            '{"level": "info", "msg": "started", "n": 1}',
+            '',
+            '{"level": "error", "msg": "fa\u00efled"}',
+            '{broken',
+            '["not", "an", "object"]',
+            '{"level": "info", "msg": "done"}',
+        ]) + "\n")
+        out, err = self.run_cmd("json --lines log.ndjson")
+        self.assertEqual(out.splitlines(), [
+            '{"level": "info", "msg": "started", "n": 1}',
+            '{"level": "error", "msg": "faïled"}',
+            '["not", "an", "object"]',
+            '{"level": "info", "msg": "done"}',
+        ])
+        self.assertIn("1 malformed line(s), first at line 4", err)
+
+        out, err = self.run_cmd("cat log.ndjson | json --lines -p msg")
+        self.assertEqual(out.splitlines(), ["started", "faïled", "done"])
+        self.assertIn("1 malformed line(s)", err)
+        self.assertIn("1 record(s) without 'msg'", err)
+
+    def test_json_path_query(self):
+        self.write_file("q.json", (
+            '{"items": ['
+            '{"id": 1, "kind": "file", "name": "a"},'
+            '{"id": 2, "kind": "dir", "name": "b",'
+            ' "children": [{"id": 3, "kind": "file", "name": "c"}]},'
+            '{"id": 4, "kind": "file", "name": "d.e"}'
+            '], "meta": {"name": "top"}}'
+        ))
+        self.assertEqual(
+            self.out("json -p items.*.id q.json").split(), ["1", "2", "4"]
+        )
+        self.assertEqual(
+            self.out("json -p items[1:].name q.json").split(), ["b", "d.e"]
+        )
+        self.assertEqual(
+            self.out("json -p items.::2.id q.json").split(), ["1", "4"]
+        )
+        self.assertEqual(
+            self.out("json -p ..name q.json").split(),
+            ["a", "b", "c", "d.e", "top"],
+        )
+        self.assertEqual(
+            self.out("json -p items[?kind==file].id q.json").split(),
+            ["1", "4"],
+        )
+        self.assertEqual(
+            self.out("json -p '..[?id==3].name' q.json").split(), ["c"]
+        )
+        self.assertEqual(
+            self.out("json -p 'items[?kind!=\"file\"][\"name\"]' q.json").split(),
+            ["b"],
+        )
+        self.assertEqual(
+            self.out("json -p items[?children].id q.json").split(), ["2"]
+        )
+        self.assertEqual(self.out("json -p items.-1.id q.json").strip(), "4")
+        # Wildcard queries with no match are silent; plain paths are not.
+        out, err = self.run_cmd("json -p items.*.size q.json")
+        self.assertEqual((out, err), ("", ""))
+        self.assertIn("no value at 'items.9'", self.err("json -p items.9 q.json"))
+        self.assertIn("invalid path", self.err("json -p items.. q.json"))
+        self.assertIn("invalid filter", self.err("json -p 'items[?=1]' q.json"))
+
+    def test_json_path_streamed(self):
+        import json
+        cmd = self.shell.env.get("json")
+        doc = {
+            "items": [
+                {"id": 1, "kind": "file", "name": "a", "s": "br]a{c\"e\\"},
+                {"id": 2, "kind": "dir", "na\"me": "q", "name": "b",
+                 "children": [{"id": 3, "kind": "file", "name": "c"}]},
+                {"id": 4, "kind": "file", "name": "\u00e9", "e": [], "o": {}},
+            ],
+            "meta": {"name": "top", "n": None},
+        }
+        paths = [
+            "items.*.id", "items[1:].name", "items.-1", "..name", "meta.n",
+            "items[?kind==file].id", "..[?id==3].name", "items[?s].s",
+            "items.1[\"na\\\"me\"]", "items.*.size", "items.9",
+        ]
+        stream = m._JsonStream
+        self.addCleanup(setattr, stream, "CHUNK", stream.CHUNK)
+        self.addCleanup(setattr, stream, "SMALL", stream.SMALL)
+        for indent in (None, 1):
+            self.write_file("big.json", json.dumps(doc, indent=indent))
+            expected = [
+                self.run_cmd(f"json -c -p '{p}' big.json") for p in paths
+            ]
+            cmd.STREAM_MIN_SIZE = 0
+            try:
+                # Also with tiny chunks and no small members, so that
+                # skipping goes through the chunked bracket count.
+                for stream.CHUNK, stream.SMALL in ((1024**2, 4096), (16, 0)):
+                    streamed = [
+                        self.run_cmd(f"json -c -p '{p}' big.json")
+                        for p in paths
+                    ]
+                    self.assertEqual(streamed, expected)
+            finally:
+                del cmd.STREAM_MIN_SIZE
+
+        # Only the selected values are checked.
+        cmd.STREAM_MIN_SIZE = 0
+        self.addCleanup(delattr, cmd, "STREAM_MIN_SIZE")
+        self.write_file("bad.json", '{"a": [1, 2}, "b": {"c": tru}}')
+        out, err = self.run_cmd("json -p a.1 bad.json")
+        self.assertEqual(out.strip(), "2")
+        self.assertIn("parse error", self.err("json -p b.c bad.json"))
+        # Of duplicate keys the last one counts, as when decoding.
+        self.write_file("dup.json", '{"a": {"b": 1}, "a": {"b": 2}}')
+        self.assertEqual(self.out("json -p a.b dup.json"), "2")
+        del cmd.STREAM_MIN_SIZE
+        self.assertEqual(self.out("json -p a.b dup.json"), "2")
+        cmd.STREAM_MIN_SIZE = 0
+        self.write_file("cut.json", '{"a": [1, 2, "x')
+        self.assertIn("parse error", self.err("json -p a.* cut.json"))
+
+    def test_json_lines_query(self):
+        self.write_file("log.ndjson", "\n".join([
+            '{"events": [{"t": "a"}, {"t": "b"}]}',
+            '{"events": []}',
+            '{"events": [{"t": "c"}]}',
+        ]) + "\n")
+        out, err = self.run_cmd("json --lines -p events.*.t log.ndjson")
+        self.assertEqual(out.split(), ["a", "b", "c"])
+        self.assertIn("1 record(s) without 'events.*.t'", err)
+
 
 class TestFetch(ShellTestCase):
 
@@ -1060,6 +1549,127 @@ class TestFetch(ShellTestCase):
         err = self.err("fetch")
         self.assertIn("ERR", err)
 
+    def _serve(self):
+        """Serve the "site" directory over HTTP/1.1 on localhost; return
+        the base URL and a list that collects the client connections."""
+        import http.server
+        site = os.path.join(self.tmpdir, "site")
+        os.makedirs(site, exist_ok=True)
+        connections = []
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=site, **kwargs)
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def translate_path(self, path):
+                # Requests through a proxy give the absolute URL.
+                import urllib.parse
+                return super().translate_path(urllib.parse.urlsplit(path).path)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(
+            target=server.serve_forever, args=(0.01,), daemon=True
+        ).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}", connections
+
+    def test_fetch_many(self):
+        base, connections = self._serve()
+        for i in range(8):
+            self.write_file(f"site/f{i}.txt", f"file {i}\n" * (i + 1))
+        self.write_file("site/sub/f0.txt", "other\n")
+        urls = " ".join(f"{base}/f{i}.txt" for i in range(8))
+        out, err = self.run_cmd(f"fetch -j 2 -O dl {urls} {base}/sub/f0.txt")
+        self.assertEqual(err, "")
+        lines = out.splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(lines[1], os.path.join("dl", "f1.txt: 14 bytes"))
+        self.assertEqual(lines[8], os.path.join("dl", "f0.txt.1: 6 bytes"))
+        for i in range(8):
+            with open(os.path.join(self.tmpdir, "dl", f"f{i}.txt")) as f:
+                self.assertEqual(f.read(), f"file {i}\n" * (i + 1))
+        with open(os.path.join(self.tmpdir, "dl", "f0.txt.1")) as f:
+            self.assertEqual(f.read(), "other\n")
+        # Nine downloads over no more connections than workers.
+        self.assertLessEqual(len(connections), 2)
+
+    def test_fetch_many_unique_names(self):
+        base, _ = self._serve()
+        self.write_file("site/a", "1")
+        self.write_file("site/b/a", "2")
+        self.write_file("site/a.1", "3")
+        out, err = self.run_cmd(f"fetch -O dl {base}/a {base}/b/a {base}/a.1")
+        self.assertEqual(err, "")
+        self.assertEqual(
+            [line.split(":")[0] for line in out.splitlines()],
+            [os.path.join("dl", n) for n in ("a", "a.1", "a.1.1")],
+        )
+        for name, content in (("a", "1"), ("a.1", "2"), ("a.1.1", "3")):
+            with open(os.path.join(self.tmpdir, "dl", name)) as f:
+                self.assertEqual(f.read(), content)
+
+    def test_fetch_many_through_proxy(self):
+        from unittest import mock
+        base, connections = self._serve()
+        self.write_file("site/p.txt", "proxied\n")
+        env = {"http_proxy": base, "no_proxy": ""}
+        with mock.patch.dict(os.environ, env):
+            out = self.out("fetch -O dl http://example.invalid/p.txt")
+        self.assertEqual(out, os.path.join("dl", "p.txt: 8 bytes"))
+        self.assertEqual(len(connections), 1)
+
+    def test_fetch_list_and_failures(self):
+        base, _ = self._serve()
+        self.write_file("site/a.txt", "alpha")
+        self.write_file("site/sub/index.html", "<p>sub</p>")
+        self.write_file("dl/missing.txt", "kept")
+        self.write_file("urls.txt", "\n".join([
+            "# downloads",
+            f"{base}/a.txt",
+            "",
+            f"{base}/missing.txt",
+            f"{base}/sub",
+            "ftp://example.com/x",
+        ]) + "\n")
+        out, err = self.run_cmd("fetch -i urls.txt -O dl")
+        self.assertEqual(out.splitlines(), [
+            os.path.join("dl", "a.txt") + ": 5 bytes",
+            os.path.join("dl", "sub") + ": 10 bytes",
+        ])
+        self.assertIn(f"{base}/missing.txt: HTTP Error 404", err)
+        self.assertIn("unsupported URL 'ftp://example.com/x'", err)
+        self.assertIn("2 of 4 download(s) failed", err)
+        # A failed download leaves an existing file alone.
+        with open(os.path.join(self.tmpdir, "dl", "missing.txt")) as f:
+            self.assertEqual(f.read(), "kept")
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmpdir, "dl"))),
+            ["a.txt", "missing.txt", "sub"],
+        )
+
+        out, err = self.run_cmd("cat urls.txt | fetch -j1 -O piped")
+        self.assertIn(os.path.join("piped", "a.txt") + ": 5 bytes", out)
+
+    def test_fetch_many_errors(self):
+        err = self.err("fetch http://a/x http://b/y")
+        self.assertIn("several URLs need -O <dir>", err)
+        err = self.err("fetch -o x -O dir http://a/x")
+        self.assertIn("-o takes a single URL", err)
+        err = self.err("fetch -j 0 -O dir http://a/x")
+        self.assertIn("invalid number of workers", err)
+        err = self.err("fetch -i nolist.txt -O dir")
+        self.assertIn("nolist.txt", err)
+
 
 class TestArchives(ShellTestCase):
 
@@ -1166,6 +1776,117 @@ class TestLess(ShellTestCase):
         # Should not hang, should not raise.
         self.run_cmd("less big.txt")
 
+    # The pager is tested on a 10x40 terminal with VT escapes: _keys()
+    # feeds the key presses and _render() replays the output on a screen.
+
+    def _keys(self, *keys):
+        saved = {name: os.environ.get(name) for name in ("LINES", "COLUMNS")}
+        def restore():
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        self.addCleanup(restore)
+        os.environ["LINES"], os.environ["COLUMNS"] = "10", "40"
+        self.addCleanup(setattr, m, "_VT_ENABLED", m._VT_ENABLED)
+        m._VT_ENABLED = True
+        keys = iter(keys)
+        class _StubInp:
+            def getch(self_inp):
+                return next(keys)
+        self.shell.inp = _StubInp()
+
+    def _render(self, out):
+        """Replay *out* up to the final clear and return the screen rows."""
+        out = out[:out.rindex("\033[2J")]
+        rows = [""] * 10
+        row = col = 0
+        region = (0, 9)
+        for m_ in __import__("re").finditer(
+            r"\033\[([0-9;]*)([A-Za-z])|([^\033]+)", out
+        ):
+            params, op, text = m_.groups()
+            nums = [int(n) for n in params.split(";") if n] if params else []
+            if text is not None:
+                line = rows[row].ljust(col)
+                rows[row] = line[:col] + text + line[col + len(text):]
+                col += len(text)
+            elif op == "H":
+                row, col = (nums[0] - 1, nums[1] - 1) if nums else (0, 0)
+            elif op == "J":
+                rows = [""] * 10
+            elif op == "K":
+                rows[row] = rows[row][:col]
+            elif op == "r":
+                region = (nums[0] - 1, nums[1] - 1) if nums else (0, 9)
+                row = col = 0
+            elif op in "ST":
+                lo, hi = region
+                part = rows[lo:hi + 1]
+                n = nums[0]
+                if op == "S":
+                    part = part[n:] + [""] * n
+                else:
+                    part = [""] * n + part[:-n]
+                rows[lo:hi + 1] = part
+        return rows
+
+    def test_less_jumps_to_end(self):
+        self.write_file("big.txt", "".join(f"line{i}\n" for i in range(1, 201)))
+        self._keys("G", "q")
+        out, _ = self.run_cmd("less big.txt")
+        rows = self._render(out)
+        self.assertEqual(rows[:9], [f"line{i}" for i in range(192, 201)])
+        self.assertEqual(rows[9], ":  lines 192-200/200 (100%)  q to quit")
+
+    def test_less_scroll_repaints_only_new_rows(self):
+        self.write_file("big.txt", "".join(f"line{i}\n" for i in range(1, 201)))
+        self._keys("j", "j", m.KEY_UP, "q")
+        out, _ = self.run_cmd("less big.txt")
+        first_page = out.index("q to quit") + len("q to quit")
+        scrolled = out[first_page:]
+        self.assertIn("\033[1S", scrolled)
+        self.assertNotIn("line5", scrolled)
+        self.assertIn("line11", scrolled)
+        rows = self._render(out)
+        self.assertEqual(rows[:9], [f"line{i}" for i in range(2, 11)])
+        self.assertEqual(rows[9], ":  lines 2-10/200+  q to quit")
+
+    def test_less_search(self):
+        self.write_file("big.txt", "".join(f"line{i}\n" for i in range(1, 201)))
+        self._keys("/", "e", "1", "5", m.KEY_CR, "n", "q")
+        out, _ = self.run_cmd("less big.txt")
+        self.assertEqual(self._render(out)[0], "line150")
+
+    def test_less_search_not_found(self):
+        self.write_file("big.txt", "".join(f"line{i}\n" for i in range(1, 201)))
+        self._keys("/", "x", "y", m.KEY_CR, "q")
+        out, _ = self.run_cmd("less big.txt")
+        rows = self._render(out)
+        self.assertEqual(rows[0], "line1")
+        self.assertEqual(rows[9], "Pattern not found")
+
+    def test_less_reads_input_lazily(self):
+        pulled = []
+        def lines():
+            for i in range(1, 100001):
+                pulled.append(i)
+                yield f"line{i}\n"
+        self._keys("q")
+        m.CmdLess()._page(self.shell, m._IterLines(lines()))
+        self.assertLess(len(pulled), 100)
+
+        self.write_file("big.txt", "".join(f"line{i}\n" for i in range(1, 10001)))
+        self.addCleanup(setattr, m._LineIndex, "CHUNK", m._LineIndex.CHUNK)
+        m._LineIndex.CHUNK = 1024
+        self._keys(" ", "q")
+        with open(os.path.join(self.tmpdir, "big.txt"), "rb") as f:
+            index = m._LineIndex.open(f, lazy=True)
+            m.CmdLess()._page(self.shell, m._FileLines(f, index))
+        self.assertFalse(index.complete)
+        self.assertLess(len(index), 1000)
+
 
 # ═════════════════════════════════════════════════════════════════════════════
 # 7. File operations: cp, mv, rm, touch, mkdir, rmdir
@@ -1254,6 +1975,44 @@ class TestCatHeadTail(ShellTestCase):
         self.assertEqual(out.replace("\r\n", "\n").replace("\r", "\n"),
                          "hello\nworld")
 
+    def test_cat_to_file_copies_raw_bytes(self):
+        self.write_file("a.bin", b"caf\xe9\r\n\x00\xff")
+        self.write_file("b.txt", b"second\n")
+        self.run_cmd("cat a.bin b.txt > merged")
+        self.assertEqual(self.read_file("merged"),
+                         b"caf\xe9\r\n\x00\xffsecond\n")
+
+    def test_cat_append_after_text(self):
+        self.write_file("a.txt", b"body\n")
+        self.run_cmd("print head > out.txt")
+        self.run_cmd("cat a.txt >> out.txt")
+        self.assertEqual(
+            self.read_file("out.txt").replace(b"\r\n", b"\n"), b"head\nbody\n"
+        )
+
+    def test_copy_to_fd_from_offset(self):
+        src = self.write_file("src.bin", bytes(range(256)) * 4096)
+        for target in ("file", "pipe"):
+            with open(src, "rb") as infile:
+                infile.seek(1000)
+                if target == "file":
+                    with open(os.path.join(self.tmpdir, "dst"), "wb") as out:
+                        m._copy_to_fd(infile, out.fileno())
+                    got = self.read_file("dst")
+                else:
+                    r, w = os.pipe()
+                    chunks = []
+                    reader = threading.Thread(target=lambda: chunks.extend(
+                        iter(lambda: os.read(r, 65536), b"")))
+                    reader.start()
+                    m._copy_to_fd(infile, w)
+                    os.close(w)
+                    reader.join()
+                    os.close(r)
+                    got = b"".join(chunks)
+                self.assertEqual(got, (bytes(range(256)) * 4096)[1000:])
+                self.assertEqual(infile.read(), b"")
+
     def test_cat_missing_file_gives_error(self):
         err = self.err("cat missing.txt")
         self.assertIn("ERR", err)
@@ -1329,6 +2088,121 @@ class TestCatHeadTail(ShellTestCase):
         expected = b"".join(f"line{i:05d}\n".encode() for i in range(1996, 2001))
         self.assertEqual(result, expected)
 
+    def test_tail_bytes_small_adaptive_chunks(self):
+        lines = [f"{'x' * (i % 7)}{i}\n".encode() for i in range(300)]
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b"".join(lines))
+        self.addCleanup(os.unlink, f.name)
+        tc = m.CmdTail()
+        tc.CHUNK = 4
+        tc.MAX_CHUNK = 64
+        with open(f.name, "rb") as fh:
+            for n in (1, 2, 17, 299, 300, 301):
+                self.assertEqual(tc._tail_bytes(fh, n), b"".join(lines[-n:]))
+
+    def test_tail_stdin(self):
+        out = self.out("cat twenty.txt | tail -n 2")
+        self.assertEqual(out.splitlines(), ["line19", "line20"])
+
+    def test_tail_stdin_zero(self):
+        out, _ = self.run_cmd("cat twenty.txt | tail -n 0")
+        self.assertEqual(out, "")
+
+    def test_tail_invalid_count(self):
+        self.assertEqual(
+            self.err("cat twenty.txt | tail -n -3"),
+            "ERR: tail: invalid number of lines '-3'",
+        )
+        self.assertIn("invalid number", self.err("tail --lines=x twenty.txt"))
+        self.assertIn("requires an argument", self.err("tail -n"))
+        # A leading + is still accepted.
+        out = self.out("tail -n +2 twenty.txt")
+        self.assertEqual(out.splitlines(), ["line19", "line20"])
+
+    # tail -f / -F
+
+    def _start_follow(self, names, by_name=False):
+        tc = m.CmdTail()
+        tc.FOLLOW_INTERVAL = 0.05
+        tc.POLL_INTERVAL = 0.02
+        followed = []
+        for name in names:
+            path = os.path.join(self.tmpdir, name)
+            f = open(path, "rb")
+            f.seek(0, 2)
+            followed.append(m._FollowedFile(path, f, "utf8"))
+        done = threading.Event()
+        t = threading.Thread(
+            target=tc._follow,
+            args=(self.shell, followed, by_name, done.is_set),
+        )
+        t.start()
+        self.addCleanup(t.join)
+        self.addCleanup(done.set)
+        time.sleep(0.1)
+
+    def _wait_for(self, text, output=None):
+        output = output or self._out
+        deadline = time.monotonic() + 5
+        while text not in output.value() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn(text, output.value())
+
+    def _append(self, name, text):
+        with open(os.path.join(self.tmpdir, name), "a") as f:
+            f.write(text)
+
+    def test_tail_follow_appended_lines(self):
+        self.write_file("log.txt", "old\n")
+        self._start_follow(["log.txt"])
+        self._append("log.txt", "new1\n")
+        self._wait_for("new1\n")
+        self._append("log.txt", "new2\n")
+        self._wait_for("new1\nnew2\n")
+        self.assertNotIn("old", self._out.value())
+
+    def test_tail_follow_polling_fallback(self):
+        create = m._Inotify.__dict__["create"]
+        m._Inotify.create = classmethod(lambda cls: None)
+        self.addCleanup(setattr, m._Inotify, "create", create)
+        self.write_file("log.txt", "")
+        self._start_follow(["log.txt"])
+        self._append("log.txt", "polled\n")
+        self._wait_for("polled\n")
+
+    def test_tail_follow_truncation(self):
+        self.write_file("log.txt", "a long first line\n")
+        self._start_follow(["log.txt"])
+        self.write_file("log.txt", "short\n")
+        self._wait_for("short\n")
+        self._wait_for("file truncated", self._err)
+
+    def test_tail_follow_by_name_rotation(self):
+        self.write_file("log.txt", "before\n")
+        self._start_follow(["log.txt"], by_name=True)
+        self._append("log.txt", "last old\n")
+        os.rename(os.path.join(self.tmpdir, "log.txt"),
+                  os.path.join(self.tmpdir, "log.txt.1"))
+        self.write_file("log.txt", "first new\n")
+        self._wait_for("last old\nfirst new\n")
+        self._wait_for("has been replaced", self._err)
+
+    def test_tail_follow_multiple_files_headers(self):
+        self.write_file("a.log", "")
+        self.write_file("b.log", "")
+        self._start_follow(["a.log", "b.log"])
+        self._append("a.log", "from a\n")
+        self._wait_for("from a\n")
+        self._append("b.log", "from b\n")
+        self._wait_for("from b\n")
+        out = self._out.value()
+        a_path = os.path.join(self.tmpdir, "a.log")
+        b_path = os.path.join(self.tmpdir, "b.log")
+        self.assertEqual(
+            out,
+            f"\n==> {a_path} <==\nfrom a\n\n==> {b_path} <==\nfrom b\n",
+        )
+
     # lines
 
     def test_lines_single(self):
@@ -1385,6 +2259,68 @@ class TestCatHeadTail(ShellTestCase):
         out = self.out("cat twenty.txt | lines -2:")
         self.assertEqual(out.strip().splitlines(), ["line19", "line20"])
 
+    def test_line_index_offsets(self):
+        self.addCleanup(setattr, m._LineIndex, "CHUNK", m._LineIndex.CHUNK)
+        m._LineIndex.CHUNK = 4
+        for data, offsets in [
+            (b"", [0]),
+            (b"a\nbb\n\nccc\n", [0, 2, 5, 6, 10]),
+            (b"a\nbb\nlast", [0, 2, 5, 9]),
+            (b"\n\n\n\n\n", [0, 1, 2, 3, 4, 5]),
+        ]:
+            index = m._LineIndex.scan(io.BytesIO(data))
+            self.assertEqual(list(index.offsets), offsets, data)
+
+    def test_lines_index_is_cached(self):
+        cache = os.path.join(self.tmpdir, "cache")
+        self.shell.options["cache-dir"] = cache
+        self.addCleanup(
+            setattr, m._LineIndex, "CACHE_MIN_SIZE",
+            m._LineIndex.CACHE_MIN_SIZE,
+        )
+        m._LineIndex.CACHE_MIN_SIZE = 0
+        self.assertEqual(self.out("lines -2: twenty.txt"), "line19\nline20")
+        self.assertEqual(len(os.listdir(os.path.join(cache, "lines"))), 1)
+
+        scans = []
+        orig_scan_more = m._LineIndex.scan_more
+        def counting_scan_more(index, f):
+            scans.append(f.name)
+            return orig_scan_more(index, f)
+        m._LineIndex.scan_more = counting_scan_more
+        self.addCleanup(setattr, m._LineIndex, "scan_more", orig_scan_more)
+        self.assertEqual(self.out("lines -1 twenty.txt"), "line20")
+        self.assertEqual(scans, [])
+        # A changed file invalidates the cached index.
+        self.write_file("twenty.txt", "only\nthree\nlines\n")
+        self.assertEqual(self.out("lines -1 twenty.txt"), "lines")
+        self.assertTrue(scans)
+
+    def test_lines_index_cache_evicts_least_recently_used(self):
+        cache = os.path.join(self.tmpdir, "cache")
+        index_dir = os.path.join(cache, "lines")
+        self.shell.options["cache-dir"] = cache
+        for name in ("CACHE_MIN_SIZE", "CACHE_MAX_SIZE"):
+            self.addCleanup(
+                setattr, m._LineIndex, name, getattr(m._LineIndex, name)
+            )
+        m._LineIndex.CACHE_MIN_SIZE = 0
+        m._LineIndex.CACHE_MAX_SIZE = 250   # two indexes of 10 lines
+        indexes = {}
+        for i, name in enumerate(("a", "b")):
+            self.write_file(f"{name}.txt", "x\n" * 10)
+            self.run_cmd(f"lines -1 {name}.txt")
+            (new,) = set(os.listdir(index_dir)) - set(indexes.values())
+            indexes[name] = new
+            os.utime(os.path.join(index_dir, new), ns=(i, i))
+        self.run_cmd("lines -1 a.txt")      # a is used again, b is not
+        self.write_file("c.txt", "x\n" * 10)
+        self.run_cmd("lines -1 c.txt")
+        left = set(os.listdir(index_dir))
+        self.assertEqual(len(left), 2)
+        self.assertIn(indexes["a"], left)
+        self.assertNotIn(indexes["b"], left)
+
 
 # ═════════════════════════════════════════════════════════════════════════════
 # 9. grep, wc, diff
@@ -1479,12 +2415,35 @@ class TestGrepWcDiff(ShellTestCase):
         out = self.out("wc a.txt b.txt")
         self.assertIn("Total", out)
 
+    def test_wc_counts_words_chars_bytes(self):
+        self.write_file("u.txt", "héllo wörld\n  two words\nlast")
+        self.assertEqual(self.out("wc -lwmc u.txt"), "u.txt 3 5 28 30")
+        self.assertEqual(self.out("wc -c u.txt"), "u.txt 30")
+        self.assertEqual(self.out("wc -w -l u.txt"), "u.txt 3 5")
+
+    def test_wc_words_across_chunk_boundaries(self):
+        text = "alpha beta  gamma\ndelta\n" * 50
+        self.write_file("w.txt", text)
+        cmd = self.shell.env.get("wc")
+        cmd.CHUNK = 7
+        self.addCleanup(delattr, cmd, "CHUNK")
+        self.assertEqual(self.out("wc -lwm w.txt"), f"w.txt 100 200 {len(text)}")
+
+    def test_wc_parallel_matches_serial(self):
+        self.write_file("c.txt", "one two\n" * 10)
+        serial = self.out("wc -lw a.txt b.txt c.txt")
+        self.assertEqual(self.out("wc -j 2 -lw a.txt b.txt c.txt"), serial)
+        self.assertIn("Total", serial)
+
+    def test_wc_counts_piped_words(self):
+        self.assertEqual(self.out("cat a.txt | wc -lw"), "(stdin) 3 6")
+
     def test_diff_identical(self):
         self.write_file("x.txt", "same\n")
         self.write_file("y.txt", "same\n")
         out = self.out("diff x.txt y.txt")
-        # ndiff of identical files should have no + or - lines
-        self.assertNotRegex(out, r"^[+-]", msg="Expected no diff for identical files")
+        # Identical files produce no diff at all
+        self.assertEqual(out, "")
 
     def test_diff_different(self):
         self.write_file("x.txt", "aaa\n")
@@ -1497,6 +2456,172 @@ class TestGrepWcDiff(ShellTestCase):
         err = self.err("diff a.txt missing.txt")
         self.assertIn("ERR", err)
 
+    def test_diff_unified_hunks(self):
+        old = [f"l{i}" for i in range(1, 21)]
+        new = list(old)
+        new[2] = "changed"
+        new.insert(15, "added")
+        self.write_file("x.txt", "\n".join(old) + "\n")
+        self.write_file("y.txt", "\n".join(new) + "\n")
+        out = self.out("diff -u 1 x.txt y.txt")
+        self.assertEqual(out, textwrap.dedent("""\
+            --- x.txt
+            +++ y.txt
+            @@ -2,3 +2,3 @@
+             l2
+            -l3
+            +changed
+             l4
+            @@ -15,2 +15,3 @@
+             l15
+            +added
+             l16"""))
+        self.assertEqual(self.out("diff x.txt y.txt").count("\n@@ "), 2)
+        # With more context both changes share one hunk.
+        out = self.out("diff -u 6 x.txt y.txt")
+        self.assertEqual(out.count("\n@@ "), 1)
+        self.assertIn("\n@@ -1,20 +1,21 @@\n", out)
+
+    def test_diff_missing_newline(self):
+        self.write_file("x.txt", "a\nb\n")
+        self.write_file("y.txt", "a\nb")
+        out = self.out("diff x.txt y.txt")
+        self.assertEqual(
+            out.splitlines()[2:],
+            ["@@ -1,2 +1,2 @@", " a", "-b", "+b",
+             "\\ No newline at end of file"],
+        )
+
+    def test_diff_quiet(self):
+        self.write_file("x.txt", "same\n")
+        self.write_file("y.txt", "same\n")
+        self.write_file("z.txt", "diff\n")
+        self.assertEqual(self.out("diff -q x.txt y.txt"), "")
+        self.assertEqual(
+            self.out("diff -q x.txt z.txt"), "Files x.txt and z.txt differ"
+        )
+
+    def _diff_trees(self):
+        for root in ("d1", "d2"):
+            os.makedirs(os.path.join(self.tmpdir, root, "sub"))
+        for name, content in [
+            ("same.txt", "same\n"),
+            ("touched.txt", "same size\n"),
+            ("sub/changed.txt", "one\ntwo\n"),
+            ("only1.txt", "x\n"),
+            ("kind", "file\n"),
+        ]:
+            self.write_file(os.path.join("d1", name), content)
+        for name, content in [
+            ("same.txt", "same\n"),
+            ("touched.txt", "same size\n"),
+            ("sub/changed.txt", "one\n2\n"),
+            ("new/deep/file.txt", "y\n"),
+            ("new-file.txt", "z\n"),
+        ]:
+            os.makedirs(os.path.dirname(
+                os.path.join(self.tmpdir, "d2", name)), exist_ok=True)
+            self.write_file(os.path.join("d2", name), content)
+        os.makedirs(os.path.join(self.tmpdir, "d2", "kind"))
+        stat = os.stat(os.path.join(self.tmpdir, "d1", "same.txt"))
+        os.utime(os.path.join(self.tmpdir, "d2", "same.txt"),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.utime(os.path.join(self.tmpdir, "d2", "touched.txt"),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def test_diff_recursive(self):
+        self._diff_trees()
+        hashed = []
+        cmd = self.shell.env.get("diff")
+        def same_content(file1, file2, digest):
+            hashed.append(os.path.basename(file1))
+            return m.CmdDiff._same_content(cmd, file1, file2, digest)
+        cmd._same_content = same_content
+        self.addCleanup(delattr, cmd, "_same_content")
+        out = self.out("diff -r d1 d2")
+        join = os.path.join
+        self.assertEqual(out.splitlines(), [
+            f"File {join('d1', 'kind')} is a regular file while file "
+            f"{join('d2', 'kind')} is a directory",
+            "Only in d2: new",
+            "Only in d2: new-file.txt",
+            "Only in d1: only1.txt",
+            f"--- {join('d1', 'sub', 'changed.txt')}",
+            f"+++ {join('d2', 'sub', 'changed.txt')}",
+            "@@ -1,2 +1,2 @@",
+            " one",
+            "-two",
+            "+2",
+        ])
+        # Only the file with equal size but another mtime is hashed.
+        self.assertEqual(hashed, ["touched.txt"])
+
+    def test_diff_recursive_quiet(self):
+        self._diff_trees()
+        out = self.out("diff -r -q -j 1 d1 d2")
+        self.assertIn(
+            f"Files {os.path.join('d1', 'sub', 'changed.txt')} and "
+            f"{os.path.join('d2', 'sub', 'changed.txt')} differ",
+            out.splitlines(),
+        )
+
+    def test_diff_recursive_skips_special_files_and_errors(self):
+        self._diff_trees()
+        join = os.path.join
+        for d in ("d1", "d2"):
+            os.symlink(join(self.tmpdir, d, "sub"), join(self.tmpdir, d, "link"))
+            if hasattr(os, "mkfifo"):
+                os.mkfifo(join(self.tmpdir, d, "fifo"))
+        cmd = self.shell.env.get("diff")
+        bad = join(self.tmpdir, "d2", "sub", "changed.txt")
+        def binary(path):
+            if path == bad:
+                raise PermissionError(13, "Permission denied", path)
+            return False
+        cmd._binary = binary
+        self.addCleanup(delattr, cmd, "_binary")
+        self.write_file("d1/z.txt", "z\n")
+        self.write_file("d2/z.txt", "zz\n")
+        out, err = self.run_cmd("diff -r d1 d2")
+        self.assertEqual(
+            err, f"ERR: diff: {join('d2', 'sub', 'changed.txt')}: "
+            "Permission denied\n"
+        )
+        self.assertIn(f"+++ {join('d2', 'z.txt')}", out.splitlines())
+        self.assertNotIn("link", out)
+        self.assertNotIn("fifo", out)
+
+    def test_diff_directories_need_r(self):
+        self._diff_trees()
+        self.assertIn("use -r", self.err("diff d1 d2"))
+        self.assertIn("not both directories", self.err("diff d1 a.txt"))
+
+    def test_diff_blocks_are_minimal(self):
+        a = list("abcabba")
+        b = list("cbabac")
+        blocks = m._diff_blocks(a, b)
+        self.assertEqual(blocks[-1], (7, 6, 0))
+        self.assertEqual(sum(n for _, _, n in blocks), 4)
+        for i, j, n in blocks:
+            self.assertEqual(a[i:i + n], b[j:j + n])
+        # Items only in one sequence are dropped and mapped back.
+        self.assertEqual(
+            m._diff_blocks([1, 7, 2, 3, 8], [9, 1, 2, 3]),
+            [(0, 1, 1), (2, 2, 2), (5, 4, 0)],
+        )
+
+    def test_diff_blocks_cost_limit_stays_valid(self):
+        a = [i % 7 for i in range(300)]
+        b = [i % 5 for i in range(300)]
+        blocks = m._diff_blocks(a, b, max_cost=2)
+        i = j = 0
+        for bi, bj, n in blocks:
+            self.assertGreaterEqual(bi, i)
+            self.assertGreaterEqual(bj, j)
+            self.assertEqual(a[bi:bi + n], b[bj:bj + n])
+            i, j = bi + n, bj + n
+        self.assertEqual((i, j), (300, 300))
+
 
 # ═════════════════════════════════════════════════════════════════════════════
 # 10. Path utilities
@@ -2692,6 +3817,156 @@ class TestAwk(ShellTestCase):
         out = self.out("awk '$1 !~ /foo/' d.txt")
         self.assertEqual(out, "bar")
 
+    def test_match_dynamic_pattern(self):
+        self.write_file("d.txt", "foo x\nbar fo+\nfoooo y\n")
+        out = self.out("awk '$1 ~ \"^fo+$\" {print $2}' d.txt")
+        self.assertEqual(out, "x\ny")
+
+    def test_dynamic_pattern_cache_is_bounded(self):
+        ev = m._AwkEvaluator
+        self.addCleanup(setattr, ev, "REGEX_CACHE_SIZE", ev.REGEX_CACHE_SIZE)
+        ev.REGEX_CACHE_SIZE = 2
+        self.write_file("d.txt", "a abc\nb xyz\nc cc\na a\nd abc\n")
+        out = self.out("awk '$2 ~ $1 {print NR}' d.txt")
+        self.assertEqual(out, "1\n3\n4")
+
+    def test_invalid_regex_reported(self):
+        self.write_file("d.txt", "a\n")
+        _, err = self.run_cmd("awk '/(/' d.txt")
+        self.assertIn("ERR: awk", err)
+
+    def test_program_compiled_once(self):
+        tokens = m._awk_lex("BEGIN {n = 0}\n/x/ {n += 1}\nEND {print n}")
+        prog = m._AwkParser(tokens).parse_program()
+        out = []
+        ev = m._AwkEvaluator(prog, None, out.append, out.append)
+        self.assertEqual(len(ev.rules), 1)
+        ev.run_begin()
+        for line in ("x", "y", "xx"):
+            ev.run_line(line)
+        ev.run_end()
+        self.assertEqual(out, ["2"])
+
+    def _evaluator(self, text, fs=None):
+        prog = m._AwkParser(m._awk_lex(text)).parse_program()
+        out = []
+        return m._AwkEvaluator(prog, fs, out.append, out.append), out
+
+    def test_split_limited_to_highest_field(self):
+        ev, out = self._evaluator("{print $2}")
+        self.assertEqual(ev.split_limit, 2)
+        ev.run_line("a b c d")
+        self.assertEqual(out, ["b"])
+        self.assertEqual(ev.fields, ["a b c d", "a", "b"])
+
+    def test_split_skipped_when_fields_unused(self):
+        ev, out = self._evaluator("/b/ {print}")
+        ev.run_line("a b c")
+        self.assertEqual(out, ["a b c"])
+        self.assertIsNone(ev.fields)
+
+    def test_nf_and_dynamic_field_split_fully(self):
+        ev, out = self._evaluator("{print $1, NF, $NF}")
+        self.assertIsNone(ev.split_limit)
+        ev.run_line("a b c d")
+        self.assertEqual(out, ["a 4 d"])
+
+    def test_lazy_split_uses_fs(self):
+        self.write_file("d.txt", "a,b,c\nd,e,f\n")
+        out = self.out("awk -F , '{print $2}' d.txt")
+        self.assertEqual(out, "b\ne")
+
+    def test_assign_field_rebuilds_record(self):
+        self.write_file("d.txt", "a b c\n")
+        out = self.out("awk '{$2 = \"X\"; print; print NF}' d.txt")
+        self.assertEqual(out, "a X c\n3")
+
+    def test_array_aggregation(self):
+        self.write_file("d.txt", "a 1\nb 2\na 3\n")
+        out = self.out(
+            "awk '{c[$1] += $2} END {for (k in c) print k, c[k]}' d.txt"
+        )
+        self.assertEqual(sorted(out.splitlines()), ["a 4", "b 2"])
+
+    def test_increment_and_in(self):
+        self.write_file("d.txt", "a\nb\na\n")
+        out = self.out(
+            "awk '{n[$1]++} END {for (k in n) if (n[k] > 1) print k;"
+            " print (\"b\" in n), (\"z\" in n)}' d.txt"
+        )
+        self.assertEqual(out, "a\n1 0")
+
+    def test_loops_break_continue(self):
+        ev, out = self._evaluator(
+            "BEGIN { for (i = 1; i <= 5; i++) { if (i == 2) continue;"
+            " if (i == 4) break; s = s i }\n"
+            " while (j < 3) j++; do { j-- } while (j > 0); print s, j }"
+        )
+        ev.run_begin()
+        self.assertEqual(out, ["13 0"])
+
+    def test_split_and_delete(self):
+        ev, out = self._evaluator(
+            'BEGIN { n = split("a:b:c", p, ":"); delete p[2];'
+            " print n, p[1], length(p), (2 in p);"
+            ' split("x  y", w); print w[2]; delete w; print length(w) }'
+        )
+        ev.run_begin()
+        self.assertEqual(out, ["3 a 2 0", "y", "0"])
+
+    def test_sub_and_gsub(self):
+        self.write_file("d.txt", "foo lol\n")
+        out = self.out(
+            "awk '{n = gsub(/o/, \"0\"); sub(/l+/, \"[&]\", $2); print n, $0}' d.txt"
+        )
+        self.assertEqual(out, "3 f00 [l]0l")
+
+    def test_user_functions(self):
+        ev, out = self._evaluator(
+            "function fact(n) { if (n <= 1) return 1; return n * fact(n - 1) }\n"
+            "function fill(a, n,   i) { for (i = 1; i <= n; i++) a[i] = i * i }\n"
+            "BEGIN { fill(sq, 3); print fact(5), sq[3], length(sq), i }"
+        )
+        ev.run_begin()
+        self.assertEqual(out, ["120 9 3 "])
+
+    def test_deep_recursion_reported(self):
+        err = self.err(
+            "awk 'function f(n) { if (n) return f(n - 1); return 0 }"
+            " BEGIN { print f(100000) }'"
+        )
+        self.assertEqual(err, "ERR: awk: function call nesting too deep")
+
+    def test_array_in_scalar_context_rejected(self):
+        err = self.err("awk 'BEGIN { a[1] = 1; print a }'")
+        self.assertIn("can't use an array in a scalar context", err)
+
+    def test_array_reference_creates_element(self):
+        ev, out = self._evaluator(
+            'BEGIN { x = a["k"]; print ("k" in a), length(a) }'
+        )
+        ev.run_begin()
+        self.assertEqual(out, ["1 1"])
+
+    def test_multi_subscript(self):
+        ev, out = self._evaluator(
+            'BEGIN { a["x", 1] = 2; if (("x", 1) in a) print a["x", 1] }'
+        )
+        ev.run_begin()
+        self.assertEqual(out, ["2"])
+
+    def test_regex_rule_after_block(self):
+        ev, out = self._evaluator("BEGIN { n = 0 } /x/ { n++ } END { print n }")
+        for line in ("x", "y", "xx"):
+            ev.run_line(line)
+        ev.run_end()
+        self.assertEqual(out, ["2"])
+
+    def test_break_outside_loop_rejected(self):
+        self.write_file("d.txt", "a\n")
+        out = self.err("awk '{ break }' d.txt")
+        self.assertIn("break outside a loop", out)
+
     def test_ofs(self):
         self.write_file("d.txt", "a b c\n")
         out = self.out("awk 'BEGIN{OFS=\",\"} {print $1, $2, $3}' d.txt")
@@ -2745,6 +4020,161 @@ class TestAwk(ShellTestCase):
         _, err = self.run_cmd("awk 'BEGIN { print 1/0 }'")
         self.assertIn("division by zero", err)
 
+    def _parallel_data(self):
+        self.shell.env.get("awk").RANGE_SIZE = 40
+        self.addCleanup(delattr, self.shell.env.get("awk"), "RANGE_SIZE")
+        lines = [f"k{i % 3} {i}" for i in range(200)]
+        self.write_file("d.txt", "\n".join(lines) + "\n")
+
+    def test_parallel_filter_keeps_order(self):
+        self._parallel_data()
+        serial = self.out("awk '$2 % 7 == 0 { print $2, $1 }' d.txt")
+        out = self.out("awk -j 3 '$2 % 7 == 0 { print $2, $1 }' d.txt")
+        self.assertEqual(out, serial)
+        self.assertEqual(len(out.splitlines()), 29)
+
+    def test_parallel_merges_accumulators(self):
+        self._parallel_data()
+        program = (
+            "BEGIN { s = 1000 } { s += $2; n++; c[$1] += $2 }"
+            " END { print s, n, NR; for (k in c) print k, c[k] }"
+        )
+        serial = self.out(f"awk '{program}' d.txt")
+        out = self.out(f"awk -j 4 '{program}' d.txt")
+        self.assertEqual(out.splitlines()[0], "20900 200 200")
+        self.assertEqual(sorted(out.splitlines()), sorted(serial.splitlines()))
+
+    def test_parallel_min_max(self):
+        self._parallel_data()
+        program = (
+            "BEGIN { lo = 1000 } $2 > hi { hi = $2 }"
+            " { if ($2 < lo) lo = $2; if (m[$1] <= $2) { m[$1] = $2 } }"
+            " END { print lo, hi; for (k in m) print k, m[k] }"
+        )
+        serial = self.out(f"awk '{program}' d.txt")
+        out = self.out(f"awk -j 3 '{program}' d.txt")
+        self.assertEqual(out.splitlines()[0], "0 199")
+        self.assertEqual(sorted(out.splitlines()), sorted(serial.splitlines()))
+        err = self.err("awk -j 2 '{ if ($1 > x) x = $1 + x }' d.txt")
+        self.assertIn("'x' carries state", err)
+        err = self.err("awk -j 2 '{ if ($1 > x) x = $1; x += 1 }' d.txt")
+        self.assertIn("'x' is accumulated in different ways", err)
+
+    def test_parallel_scratch_variables(self):
+        self._parallel_data()
+        program = "{ x = $2 * 2; n = split($0, p); if (x > 390) print p[1], x }"
+        out = self.out(f"awk -j2 '{program}' d.txt")
+        self.assertEqual(out, "k1 392\nk2 394\nk0 396\nk1 398")
+
+    def test_parallel_rejects_order_dependent(self):
+        self.write_file("d.txt", "a\n")
+        for program, reason in [
+            ("{ print NR }", "NR"),
+            ("{ print prev; prev = $0 }", "'prev'"),
+            ("{ s += $1; print s }", "'s'"),
+            ("{ last = $1 } END { print last }", "'last'"),
+            ("END { print $0 }", "last record"),
+            ("!seen[$1]++", "'seen'"),
+            ("{ print c[$1]++ }", "'c'"),
+            ("{ print (c[$1] += 1) }", "'c'"),
+        ]:
+            err = self.err(f"awk -j 2 '{program}' d.txt")
+            self.assertIn("can't run in parallel", err)
+            self.assertIn(reason, err)
+
+    def test_parallel_needs_files(self):
+        err = self.err("print a | awk -j 2 '{ print }'")
+        self.assertIn("-j needs file arguments", err)
+
+
+# ═════════════════════════════════════════════════════════════════════════════
+# buffered terminal output
+# ═════════════════════════════════════════════════════════════════════════════
+
+class _CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestBufferedOutput(ShellTestCase):
+
+    def _buffer(self, delay=60):
+        stream = _CountingStream()
+        buf = m._StreamBuffer(stream)
+        buf.FLUSH_SIZE = 100
+        buf.FLUSH_DELAY = delay
+        return stream, buf
+
+    def test_buffers_until_size_threshold(self):
+        stream, buf = self._buffer()
+        for i in range(9):
+            buf.write(f"line {i:04d}\n")       # 10 chars each
+        self.assertEqual(stream.getvalue(), "")
+        buf.write("line 0009\n")
+        self.assertEqual(stream.getvalue().count("\n"), 10)
+        self.assertEqual(stream.flushes, 1)
+
+    def test_explicit_flush(self):
+        stream, buf = self._buffer()
+        buf.write("a\n")
+        buf.flush()
+        buf.flush()
+        self.assertEqual(stream.getvalue(), "a\n")
+        self.assertEqual(stream.flushes, 1)
+
+    def test_timer_flush(self):
+        stream, buf = self._buffer(delay=0.01)
+        buf.write("later\n")
+        deadline = time.monotonic() + 5
+        while not stream.getvalue() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(stream.getvalue(), "later\n")
+
+    def test_streams_stay_in_order(self):
+        combined = _CountingStream()
+        _, out = self._buffer()
+        _, err = self._buffer()
+        out.stream = err.stream = combined
+        out.write("one\n")
+        err.write("two\n")
+        out.write("three\n")
+        out.flush()
+        self.assertEqual(combined.getvalue(), "one\ntwo\nthree\n")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_fork_while_flusher_runs(self):
+        stream = _CountingStream()
+        buf = m._stream_buffer(stream)
+        self.addCleanup(m._STREAM_BUFFERS.pop, id(stream), None)
+        buf.FLUSH_DELAY = 60
+        buf.write("pending\n")
+        self.assertIsNotNone(buf._flusher)
+        pid = os.fork()
+        if pid == 0:
+            ok = buf._flusher is None and buf._lock.acquire(blocking=False)
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        # The parent's lock was released again.
+        buf.flush()
+        self.assertEqual(stream.getvalue(), "pending\n")
+
+    def test_flushed_after_command(self):
+        saved = sys.stdout
+        sys.stdout = stream = _CountingStream()
+        try:
+            outs = m.StdOutput()
+        finally:
+            sys.stdout = saved
+        outs._buffer.FLUSH_DELAY = 60
+        self.shell.outs = outs
+        self.shell.execute("print hello", history=False)
+        self.assertEqual(stream.getvalue(), "hello\n")
+
 
 # ═════════════════════════════════════════════════════════════════════════════
 # entry point